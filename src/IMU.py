@@ -85,4 +85,91 @@ def z_gyro(
     assert z_gyro_b.shape ==(
         3,), f"z_gyro: angular rate vector shape incorrect. Expected (3,), got {z_gyro_b.shape}"
     
-    return z_gyro_b
\ No newline at end of file
+    return z_gyro_b
+
+# %% Batch IMU model
+def _measure(true_b: np.ndarray,
+             rng: np.random.Generator,
+             bias_b,
+             noise_std,
+             scale_factor: np.ndarray,
+             decimals: int,
+             name: str) -> np.ndarray:
+    """scale_factor @ true_b + bias_b + noise for every sample of true_b (N,3)"""
+    assert true_b.ndim == 2 and true_b.shape[1] == 3, (
+        f"{name}: truth shape incorrect. Expected (N,3), got {true_b.shape}")
+    if scale_factor is not None:
+        assert scale_factor.shape == (3, 3), (
+            f"{name}: scale factor shape incorrect. Expected (3,3), got {scale_factor.shape}")
+        true_b = true_b @ scale_factor.T
+
+    z_b = true_b + bias_b + rng.normal(0, noise_std, true_b.shape)
+    if decimals is not None:
+        z_b = np.round(z_b, decimals)
+    return z_b
+
+
+def z_acc_batch(
+        acc_nb_n: np.ndarray,
+        g_nb_n: np.ndarray,
+        rng: np.random.Generator,
+        accel_bias_b=0.,
+        noise_std=0.001,
+        scale_factor: np.ndarray = None,
+        decimals: int = 7,
+        ) -> np.ndarray:
+    """
+    Accelerometer measurements of a whole log, the model of z_acc
+
+    Parameters
+    ----------
+    acc_nb_n : True acceleration vectors in NED (N,3)
+    g_nb_n : True gravity vector in NED (3,)
+    rng : Generator of the noise, e.g. np.random.default_rng(seed)
+    accel_bias_b : Accelerometer bias in Body, (3,) or per sample (N,3). The default is 0.
+    noise_std : Standard deviation of the white noise, float or per axis (3,).
+        The default is 0.001, as in z_acc.
+    scale_factor : Scale factor and misalignment matrix (3,3) applied to the
+        specific force, the inverse of the S_a the filter corrects with.
+        The default is None, no scale errors.
+    decimals : Decimals to round to, None for no rounding. The default is 7.
+
+    Returns
+    -------
+    Specific forces in body (N,3), noise drawn in one call of rng
+
+    """
+    return _measure(acc_nb_n - g_nb_n, rng, accel_bias_b, noise_std,
+                    scale_factor, decimals, "z_acc_batch")
+
+
+def z_gyro_batch(
+        omega_t_b: np.ndarray,
+        rng: np.random.Generator,
+        omega_bt_b=0.,
+        noise_std=0.00004,
+        scale_factor: np.ndarray = None,
+        decimals: int = 7,
+        ) -> np.ndarray:
+    """
+    Gyroscope measurements of a whole log, the model of z_gyro
+
+    Parameters
+    ----------
+    omega_t_b : True angular velocities (N,3)
+    rng : Generator of the noise, e.g. np.random.default_rng(seed)
+    omega_bt_b : Gyro bias, (3,) or per sample (N,3). The default is 0.
+    noise_std : Standard deviation of the white noise, float or per axis (3,).
+        The default is 0.00004, as in z_gyro.
+    scale_factor : Scale factor and misalignment matrix (3,3) applied to the
+        angular velocity, the inverse of the S_g the filter corrects with.
+        The default is None, no scale errors.
+    decimals : Decimals to round to, None for no rounding. The default is 7.
+
+    Returns
+    -------
+    Measured angular rates in XYZ [rad/s] (N,3), noise drawn in one call of rng
+
+    """
+    return _measure(omega_t_b, rng, omega_bt_b, noise_std,
+                    scale_factor, decimals, "z_gyro_batch")
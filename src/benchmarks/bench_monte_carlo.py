@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling of run_monte_carlo with the number of worker processes: wall time of
+a fixed number of runs per worker, the runs per second and the parallel
+efficiency against one worker, and the time of the same runs in a serial
+loop without the pool.
+
+Run from src/benchmarks: python bench_monte_carlo.py
+"""
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #benchmarks
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+sys.path.append(os.path.join(parentdir, "test"))  #synthetic_log
+
+import time
+
+import numpy as np
+
+from eskf_runner import run_eskf
+from monte_carlo import default_processes, run_monte_carlo
+from result_sinks import DiagonalSink
+from synthetic_log import make_data, run_arguments
+
+
+def main():
+    data = make_data(np.random.default_rng(0), T=30.)
+    arguments = dict(run_arguments(data), doGNSS=True, debug=False, sink=DiagonalSink())
+    runs_per_worker = 4
+    cores = default_processes()
+
+    start = time.perf_counter()
+    for _ in range(runs_per_worker):
+        run_eskf(loaded_data=data, **arguments)
+    serial = (time.perf_counter() - start) / runs_per_worker
+    print(f"cores: {cores}, serial run: {serial:.3f} s")
+
+    print(f"{'workers':>8} {'runs':>6} {'wall [s]':>10} {'runs/s':>8} {'efficiency':>11} {'mean run [s]':>13}")
+    processes = 1
+    while True:
+        runs = [arguments] * (runs_per_worker * processes)
+        start = time.perf_counter()
+        results = run_monte_carlo(data, runs, processes=processes)
+        wall = time.perf_counter() - start
+        rate = len(runs) / wall
+        if processes == 1:
+            rate_one = rate
+        mean = np.mean([run.elapsed for run in results])
+        print(f"{processes:>8} {len(runs):>6} {wall:>10.3f} {rate:>8.2f} "
+              f"{rate / (processes * rate_one):>11.2f} {mean:>13.3f}")
+        if processes >= cores:
+            break
+        processes = min(2 * processes, cores)
+
+
+if __name__ == '__main__': main()
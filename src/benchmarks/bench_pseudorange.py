@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of ESKF.batch_pseudorange against the previous loop based
+implementation with an explicit inverse of S, for 4, 15, 100 and 1000 beacons.
+
+Run from src/benchmarks: python bench_pseudorange.py
+"""
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #benchmarks
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import timeit
+
+import numpy as np
+import scipy.linalg as la
+
+from eskf_pseudoranges import ESKF, POS_IDX
+
+
+def batch_pseudorange_loops(x_nominal, z_GNSS_position, P, b_loc, R_beacons):
+    """The loop based batch_pseudorange this benchmark compares against"""
+    I = np.eye(*P.shape)
+    
+    num_beacons = len(b_loc)
+    est_ranges = np.zeros(num_beacons)
+    measured_ranges = np.zeros(num_beacons)
+    
+    pos_est = x_nominal[POS_IDX]  
+    pos_meas = z_GNSS_position
+    
+    for i in range(num_beacons):
+        est_ranges[i] = la.norm(-pos_est + b_loc[i])
+        measured_ranges[i] = la.norm(-pos_meas + b_loc[i])
+    v = measured_ranges - est_ranges
+    
+    H = np.zeros((num_beacons, 15))
+    for k in range(num_beacons):
+          for j in range(3):
+              H[k,j] = (b_loc[k,j] - pos_est[j])
+          H[k] = -(H[k])/est_ranges[k]
+
+    S = H @ P @ H.T + R_beacons[:num_beacons, :num_beacons]
+    W = P @ H.T @ la.inv(S)
+    delta_x = W @ v
+    Jo = I - W @ H
+    P_update = Jo @ P @ Jo.T + W @ R_beacons[:num_beacons, :num_beacons] @ W.T
+
+    return delta_x, P_update
+
+
+def make_case(num_beacons, rng):
+    x_nominal = np.zeros(16)
+    x_nominal[POS_IDX] = np.array([10, 40, 1])
+    x_nominal[6] = 1
+    
+    z_GNSS_position = x_nominal[POS_IDX] + rng.normal(0, 0.05, 3)
+    b_loc = rng.uniform([-30, -10, -1], [30, 70, 5], (num_beacons, 3))
+    
+    A = rng.normal(size=(15, 15))
+    P = A @ A.T * 1e-2 + np.eye(15) * 1e-3
+    
+    R_beacons = np.eye(num_beacons) * 0.03**2
+    return x_nominal, z_GNSS_position, P, b_loc, R_beacons
+
+
+def main():
+    rng = np.random.default_rng(0)
+    eskf = ESKF(0.0583, 2.2e-6, 2.4e-3, 1.7e-6, debug=False)
+
+    print(f"{'beacons':>8} {'loops [ms]':>12} {'vectorized [ms]':>16} {'speedup':>8} {'max |dP|':>10}")
+    for num_beacons in (4, 15, 100, 1000):
+        x_nominal, z_GNSS_position, P, b_loc, R_beacons = make_case(num_beacons, rng)
+        number = 200 if num_beacons <= 100 else 5
+
+        def loops():
+            return batch_pseudorange_loops(x_nominal, z_GNSS_position, P,
+                                           b_loc, R_beacons)
+
+        def vectorized():
+            return eskf.batch_pseudorange(x_nominal, z_GNSS_position, P,
+                                          None, b_loc, R_beacons)
+
+        t_loops = min(timeit.repeat(loops, number=number, repeat=3)) / number
+        t_vectorized = min(timeit.repeat(vectorized, number=number, repeat=3)) / number
+        dP = np.abs(loops()[1] - vectorized()[1]).max()
+
+        print(f"{num_beacons:>8} {t_loops*1e3:>12.4f} {t_vectorized*1e3:>16.4f} "
+              f"{t_loops/t_vectorized:>8.1f} {dP:>10.2e}")
+
+
+if __name__ == '__main__': main()
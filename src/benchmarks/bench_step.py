@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Step level benchmark of ESKF.predict and ESKF.inject: wall time and the peak
+of temporary memory per call, traced with tracemalloc, when the results are
+allocated by the filter and when they are written into preallocated arrays
+(x_out/P_out) as in run_eskf.
+
+Run from src/benchmarks: python bench_step.py
+"""
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #benchmarks
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import timeit
+import tracemalloc
+
+import numpy as np
+
+from eskf_pseudoranges import ESKF, POS_IDX, VEL_IDX, ATT_IDX
+
+
+def make_case(rng):
+    x_nominal = np.zeros(16)
+    x_nominal[POS_IDX] = np.array([10, 40, 1])
+    x_nominal[VEL_IDX] = np.array([1, 0, 0])
+    quaternion = rng.normal(size=4)
+    x_nominal[ATT_IDX] = quaternion / np.linalg.norm(quaternion)
+
+    A = rng.normal(size=(15, 15))
+    P = A @ A.T * 1e-2 + np.eye(15) * 1e-3
+
+    z_acc = rng.normal(0, 0.5, 3) + np.array([0, 0, -9.82])
+    z_gyro = rng.normal(0, 0.05, 3)
+    delta_x = rng.normal(0, 1e-3, 15)
+    return x_nominal, P, z_acc, z_gyro, delta_x
+
+
+def peak_memory(function, number=20):
+    """Largest traced memory above the starting point over number calls [bytes]"""
+    function()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for _ in range(number):
+        function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - start
+
+
+def main():
+    rng = np.random.default_rng(0)
+    x_nominal, P, z_acc, z_gyro, delta_x = make_case(rng)
+    Ts = 0.01
+
+    x_out = np.empty(16)
+    P_out = np.empty((15, 15))
+    number = 2000
+
+    print(f"{'kernel':>28} {'time [us]':>10} {'peak [B]':>10}")
+    for discretization in ("van_loan", "taylor"):
+        eskf = ESKF(0.0583, 2.2e-6, 2.4e-3, 1.7e-6, debug=False,
+                    discretization=discretization)
+
+        def allocating():
+            return eskf.predict(x_nominal, P, z_acc, z_gyro, Ts)
+
+        def in_place():
+            return eskf.predict(x_nominal, P, z_acc, z_gyro, Ts,
+                                x_out=x_out, P_out=P_out)
+
+        for name, function in (("allocating", allocating), ("x_out/P_out", in_place)):
+            time = min(timeit.repeat(function, number=number, repeat=3)) / number
+            print(f"{'predict ' + discretization + ' ' + name:>28} "
+                  f"{time*1e6:>10.1f} {peak_memory(function):>10}")
+
+    def inject():
+        return eskf.inject(x_nominal, delta_x, P)
+
+    time = min(timeit.repeat(inject, number=number, repeat=3)) / number
+    print(f"{'inject':>28} {time*1e6:>10.1f} {peak_memory(inject):>10}")
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the filter kernels and of end-to-end run_eskf runs, with
+JSON results and a comparison against a stored baseline.
+
+Each benchmark is timed with timeit over a number of calls, repeated, and
+the fastest repeat is the result, in seconds per call. A benchmark is
+flagged as a regression when it is more than tolerance slower than in the
+baseline. Baselines are machine specific, so record one on the machine the
+comparison runs on.
+
+Run from src/benchmarks:
+    python bench_suite.py --save-baseline baseline.json
+    python bench_suite.py --baseline baseline.json --output results.json
+The exit status is 1 when a benchmark regressed.
+"""
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #benchmarks
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+sys.path.append(os.path.join(parentdir, "test"))  #synthetic_log
+
+import argparse
+from dataclasses import dataclass
+import datetime
+import fnmatch
+import json
+import platform
+import timeit
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from eskf_pseudoranges import ESKF, POS_IDX, VEL_IDX, ATT_IDX
+from eskf_runner import run_eskf
+from quaternion import (
+    euler_to_quaternion,
+    euler_to_quaternions,
+    quaternion_product,
+    quaternion_products,
+    quaternion_to_euler,
+    quaternion_to_rotation_matrix,
+    quaternions_to_euler,
+    quaternions_to_rotation_matrices,
+)
+from synthetic_log import make_data, run_arguments
+
+
+@dataclass
+class Benchmark:
+    name: str
+    function: Callable
+    # Calls per timed repeat
+    number: int
+
+
+def make_state(rng):
+    x_nominal = np.zeros(16)
+    x_nominal[POS_IDX] = np.array([10, 40, 1])
+    x_nominal[VEL_IDX] = np.array([1, 0, 0])
+    quaternion = rng.normal(size=4)
+    x_nominal[ATT_IDX] = quaternion / np.linalg.norm(quaternion)
+
+    A = rng.normal(size=(15, 15))
+    P = A @ A.T * 1e-2 + np.eye(15) * 1e-3
+    return x_nominal, P
+
+
+def micro_benchmarks(rng) -> List[Benchmark]:
+    """Single calls of the ESKF kernels and the quaternion functions"""
+    x_nominal, P = make_state(rng)
+    acceleration = rng.normal(0, 0.5, 3) + np.array([0, 0, -9.82])
+    omega = rng.normal(0, 0.05, 3)
+    delta_x = rng.normal(0, 1e-3, 15)
+    Ts = 0.01
+    eskf = ESKF(0.0583, 2.2e-6, 2.4e-3, 1.7e-6, debug=False)
+    taylor_eskf = ESKF(0.0583, 2.2e-6, 2.4e-3, 1.7e-6, debug=False,
+                       discretization="taylor")
+
+    benchmarks = [
+        Benchmark("predict_nominal",
+                  lambda: eskf.predict_nominal(x_nominal, acceleration, omega, Ts), 2000),
+        Benchmark("discrete_error_matrices/van_loan",
+                  lambda: eskf.discrete_error_matrices(x_nominal, acceleration, omega, Ts), 1000),
+        Benchmark("discrete_error_matrices/taylor",
+                  lambda: taylor_eskf.discrete_error_matrices(x_nominal, acceleration, omega, Ts), 1000),
+        Benchmark("predict_covariance/taylor",
+                  lambda: taylor_eskf.predict_covariance(x_nominal, P, acceleration, omega, Ts), 1000),
+        Benchmark("inject",
+                  lambda: eskf.inject(x_nominal, delta_x, P), 2000),
+    ]
+
+    for num_beacons in (4, 15):
+        b_loc = rng.uniform([-30, -10, -1], [30, 70, 5], (num_beacons, 3))
+        z_GNSS_position = x_nominal[POS_IDX] + rng.normal(0, 0.05, 3)
+        R_beacons = np.eye(num_beacons) * 0.03**2
+        arguments = (x_nominal, z_GNSS_position, P, None, b_loc, R_beacons)
+        benchmarks += [
+            Benchmark(f"batch_pseudorange/{num_beacons}",
+                      lambda arguments=arguments: eskf.batch_pseudorange(*arguments), 1000),
+            Benchmark(f"iterative_pseudorange/{num_beacons}",
+                      lambda arguments=arguments: eskf.iterative_pseudorange(*arguments), 200),
+        ]
+
+    quaternion = x_nominal[ATT_IDX]
+    other = rng.normal(size=4)
+    other /= np.linalg.norm(other)
+    euler_angles = quaternion_to_euler(quaternion)
+    benchmarks += [
+        Benchmark("quaternion_product",
+                  lambda: quaternion_product(quaternion, other), 5000),
+        Benchmark("quaternion_to_rotation_matrix",
+                  lambda: quaternion_to_rotation_matrix(quaternion, debug=False), 5000),
+        Benchmark("quaternion_to_euler",
+                  lambda: quaternion_to_euler(quaternion), 5000),
+        Benchmark("euler_to_quaternion",
+                  lambda: euler_to_quaternion(euler_angles), 5000),
+    ]
+
+    # Whole trajectories, 100 s at 100 Hz
+    quaternions = rng.normal(size=(10000, 4))
+    quaternions /= np.linalg.norm(quaternions, axis=1, keepdims=True)
+    trajectory_euler = quaternions_to_euler(quaternions)
+    benchmarks += [
+        Benchmark("quaternion_products/N=10000",
+                  lambda: quaternion_products(quaternions, quaternions[::-1]), 20),
+        Benchmark("quaternions_to_rotation_matrices/N=10000",
+                  lambda: quaternions_to_rotation_matrices(quaternions), 20),
+        Benchmark("quaternions_to_euler/N=10000",
+                  lambda: quaternions_to_euler(quaternions), 20),
+        Benchmark("euler_to_quaternions/N=10000",
+                  lambda: euler_to_quaternions(trajectory_euler), 20),
+    ]
+    return benchmarks
+
+
+def end_to_end_benchmarks(rng, durations=(10., 60.), beacon_counts=(4, 15)) -> List[Benchmark]:
+    """run_eskf on simulated logs of the durations [s], 100 Hz IMU and 1 Hz GNSS"""
+    benchmarks = []
+    for duration in durations:
+        data = make_data(rng, T=duration)
+        N = data["timeIMU"].shape[1]
+        for num_beacons in beacon_counts:
+            data = dict(data, beacon_location=rng.uniform([-30, -10, -1], [30, 70, 5],
+                                                          (num_beacons, 3)))
+
+            def run(data=data, arguments=run_arguments(data, num_beacons)):
+                return run_eskf(loaded_data=data, **arguments, doGNSS=True, debug=False)
+
+            benchmarks.append(Benchmark(f"run_eskf/N={N}/beacons={num_beacons}", run, 1))
+    return benchmarks
+
+
+def measure(benchmark: Benchmark, repeat: int = 5) -> Dict[str, float]:
+    """Fastest and median time per call [s] over repeat repeats"""
+    benchmark.function()
+    times = np.array(timeit.repeat(benchmark.function, number=benchmark.number,
+                                   repeat=repeat)) / benchmark.number
+    return {"min": float(times.min()),
+            "median": float(np.median(times)),
+            "number": benchmark.number,
+            "repeat": repeat}
+
+
+def environment() -> Dict[str, str]:
+    """What the results depend on besides the code"""
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__}
+
+
+def run_suite(benchmarks: List[Benchmark], repeat: int = 5, verbose: bool = True) -> Dict:
+    """Results of the benchmarks in the JSON layout of the suite"""
+    results = {}
+    for benchmark in benchmarks:
+        results[benchmark.name] = measure(benchmark, repeat)
+        if verbose:
+            print(f"{benchmark.name:>40} {results[benchmark.name]['min']*1e6:>14.1f} us")
+    return {"environment": environment(), "results": results}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = 0.25) -> List[Dict]:
+    """Benchmarks of both results whose fastest time grew by more than
+    tolerance, as dicts of name, baseline, current and ratio"""
+    regressions = []
+    for name, current in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        ratio = current["min"] / baseline["results"][name]["min"]
+        if ratio > 1 + tolerance:
+            regressions.append({"name": name,
+                                "baseline": baseline["results"][name]["min"],
+                                "current": current["min"],
+                                "ratio": ratio})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--save-baseline", help="JSON file to write the results to as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Relative slowdown flagged as a regression, default 0.25")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="*",
+                        help="Only run the benchmarks whose name matches this pattern")
+    parser.add_argument("--quick", action="store_true",
+                        help="Only the shortest end-to-end runs")
+    arguments = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    benchmarks = micro_benchmarks(rng)
+    if arguments.quick:
+        benchmarks += end_to_end_benchmarks(rng, durations=(10.,), beacon_counts=(4,))
+    else:
+        benchmarks += end_to_end_benchmarks(rng)
+    benchmarks = [benchmark for benchmark in benchmarks
+                  if fnmatch.fnmatch(benchmark.name, arguments.filter)]
+
+    print(f"{'benchmark':>40} {'time per call':>17}")
+    results = run_suite(benchmarks, arguments.repeat)
+
+    for path in (arguments.output, arguments.save_baseline):
+        if path:
+            with open(path, "w") as file:
+                json.dump(results, file, indent=2)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, arguments.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['name']}: {regression['baseline']*1e6:.1f} us -> "
+                  f"{regression['current']*1e6:.1f} us ({regression['ratio']:.2f}x)")
+        if not regressions:
+            print(f"No regressions against {arguments.baseline} "
+                  f"(tolerance {arguments.tolerance:.0%})")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main())
@@ -32,3 +32,41 @@ class CatSlice(np.ndarray):
         prod_list = [self.copy() for i in range(value)]
         return np.ix_(*prod_list)
 
+
+
+# %% Compiled indices
+def compile_index(index: Union[np.ndarray, tuple]) -> Union[slice, tuple, np.ndarray]:
+    """Compile a CatSlice, or a product of CatSlices from * or **, into the
+    cheapest equivalent numpy index
+
+    A contiguous (constant positive step) index becomes a basic slice, so
+    indexing with it gives a view instead of a copy, and a product of such
+    indices becomes a tuple of slices. Other indices are kept as a plain
+    integer array or np.ix_ tuple, which is then at least only built once.
+    """
+    if isinstance(index, tuple):
+        axes = [np.ravel(axis) for axis in index]
+        compiled = tuple(compile_index(axis) for axis in axes)
+        if all(isinstance(axis, slice) for axis in compiled):
+            return compiled
+        return np.ix_(*axes)
+
+    index = np.asarray(index).view(np.ndarray)
+    if len(index) == 1:
+        return slice(int(index[0]), int(index[0]) + 1)
+    steps = np.diff(index)
+    if len(index) > 1 and steps[0] > 0 and np.all(steps == steps[0]):
+        return slice(int(index[0]), int(index[-1]) + 1, int(steps[0]))
+    return index
+
+
+class IndexPlan:
+    """Named indices compiled with compile_index once, when the plan is made
+
+    Meant for module level plans built at import, e.g.
+        IDX = IndexPlan(pos=POS_IDX, pos_vel=POS_IDX * VEL_IDX)
+        x[IDX.pos], A[IDX.pos_vel]
+    """
+    def __init__(self, **indices):
+        for name, index in indices.items():
+            setattr(self, name, compile_index(index))
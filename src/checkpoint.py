@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of long filter runs.
+
+stream_eskf (and run_eskf) can write the filter state between two blocks to
+a checkpoint file every checkpoint_interval seconds of data, and continue a
+run from it with resume=True. The file is a small .npz of about 4 kB,
+written to a temporary file first and moved into place, so a crash while
+writing leaves the previous checkpoint intact.
+"""
+from dataclasses import dataclass
+import json
+import os
+
+import numpy as np
+
+
+@dataclass
+class ESKFCheckpoint:
+    """Filter state at the start of a block of stream_eskf"""
+    # First IMU sample of the next block, and its time to check a resume
+    # against the data
+    sample: int
+    time: float
+    # Next GNSS epoch to use
+    GNSSk: int
+
+    # Nominal state and error state covariance predicted for sample (16,)
+    # and (15,15). In the square-root mode P_pred is the Cholesky factor
+    x_pred: np.ndarray
+    P_pred: np.ndarray
+
+    # numpy.random.Generator.bit_generator.state of the caller, or None
+    rng_state: dict = None
+
+
+def save_checkpoint(path: str, checkpoint: ESKFCheckpoint) -> None:
+    """Write a checkpoint atomically, replacing the one at path"""
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        np.savez(file,
+                 sample=checkpoint.sample,
+                 time=checkpoint.time,
+                 GNSSk=checkpoint.GNSSk,
+                 x_pred=checkpoint.x_pred,
+                 P_pred=checkpoint.P_pred,
+                 rng_state=json.dumps(checkpoint.rng_state))
+    os.replace(temporary, path)
+
+
+def load_checkpoint(path: str) -> ESKFCheckpoint:
+    """Read a checkpoint written by save_checkpoint"""
+    with np.load(path) as data:
+        return ESKFCheckpoint(sample=int(data["sample"]),
+                              time=float(data["time"]),
+                              GNSSk=int(data["GNSSk"]),
+                              x_pred=data["x_pred"],
+                              P_pred=data["P_pred"],
+                              rng_state=json.loads(str(data["rng_state"])))
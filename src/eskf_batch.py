@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Batched error state kalman filter for Monte Carlo runs.
+
+BatchESKF advances M filters at once. Nominal states are stacked as (M,16) and
+error state covariances as (M,15,15), and every step is a handful of
+broadcasted NumPy calls over the whole stack instead of M rounds of small
+15x15 calls.
+"""
+from typing import Tuple
+from dataclasses import dataclass
+
+import numpy as np
+
+from eskf_pseudoranges import (
+    ESKF,
+    IDX,
+    van_loan_discretization,
+    taylor_discretization,
+)
+from quaternion import (
+    cross_product_matrices,
+    quaternion_products,
+    quaternions_to_rotation_matrices,
+)
+
+
+# %% Batched filter
+@dataclass
+class BatchESKF(ESKF):
+    """ESKF operating on stacks of M nominal states (M,16) and covariances (M,15,15)
+
+    Uses the same parameters and noise model as ESKF. The IMU samples, the GNSS
+    position and the beacon locations are either shared by all filters, (3,),
+    or given per filter, (M,3).
+    """
+
+    def correct_imu(self,
+                    x_nominal: np.ndarray,
+                    z_acc: np.ndarray,
+                    z_gyro: np.ndarray,
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Correct the IMU measurements for scale/misalignment and biases, (M,3) each"""
+        acceleration = z_acc @ self.S_a.T - x_nominal[:, IDX.acc_bias]
+        omega = z_gyro @ self.S_g.T - x_nominal[:, IDX.gyro_bias]
+        return acceleration, omega
+
+    def predict_nominal(self,
+                        x_nominal: np.ndarray,
+                        acceleration_b: np.ndarray,
+                        omega: np.ndarray,
+                        Ts: float
+                        ) -> np.ndarray:
+        """Discrete time prediction of the stacked nominal states, see ESKF.predict_nominal"""
+        assert x_nominal.ndim == 2 and x_nominal.shape[1] == 16, (
+            f"BatchESKF.predict_nominal: x_nominal incorrect shape {x_nominal.shape}"
+        )
+
+        acceleration_world = acceleration_b + self.g
+
+        x_nominal_predicted = np.empty_like(x_nominal)
+        x_nominal_predicted[:, IDX.pos] = (x_nominal[:, IDX.pos]
+                                           + Ts * x_nominal[:, IDX.vel]
+                                           + (Ts ** 2) / 2 * acceleration_world)
+        x_nominal_predicted[:, IDX.vel] = (x_nominal[:, IDX.vel]
+                                           + Ts * acceleration_world)
+
+        omega_step = Ts * omega
+        omega_step_norm = np.linalg.norm(omega_step, axis=-1)
+
+        #Same small angle handling as ESKF.predict_nominal
+        divisor = np.where(omega_step_norm > 1e-15, omega_step_norm, 1)
+        delta_quat = np.empty((len(x_nominal), 4))
+        delta_quat[:, 0] = np.cos(omega_step_norm / 2)
+        delta_quat[:, 1:] = (np.sin(omega_step_norm / 2) / divisor)[:, None] * omega_step
+
+        quaternion_prediction = quaternion_products(x_nominal[:, IDX.att], delta_quat)
+        x_nominal_predicted[:, IDX.att] = (
+            quaternion_prediction
+            / np.linalg.norm(quaternion_prediction, axis=-1, keepdims=True)
+        )
+
+        x_nominal_predicted[:, IDX.acc_bias] = ((1 - Ts * self.p_acc)
+                                                * x_nominal[:, IDX.acc_bias])
+        x_nominal_predicted[:, IDX.gyro_bias] = ((1 - Ts * self.p_gyro)
+                                                 * x_nominal[:, IDX.gyro_bias])
+        return x_nominal_predicted
+
+    def Aerr(self,
+             x_nominal: np.ndarray,
+             acceleration: np.ndarray,
+             omega: np.ndarray,
+             ) -> np.ndarray:
+        """Stacked continous time error state dynamics Jacobians (M,15,15), see ESKF.Aerr"""
+        R = quaternions_to_rotation_matrices(x_nominal[:, IDX.att])
+
+        A = np.zeros((len(x_nominal), 15, 15))
+        A[:, 0:3, 3:6] = np.eye(3)
+        A[:, 3:6, 6:9] = -R @ cross_product_matrices(acceleration)
+        A[:, 3:6, 9:12] = -cross_product_matrices(omega) @ self.S_a
+        A[:, 6:9, 12:15] = -self.S_g
+        A[:, 9:12, 9:12] = -self.p_acc * np.eye(3)
+        A[:, 12:15, 12:15] = -self.p_gyro * np.eye(3)
+        return A
+
+    def GQGT(self,
+             x_nominal: np.ndarray,
+             ) -> np.ndarray:
+        """Continous time process noise, (15,15) when isotropic else (M,15,15)"""
+        if self.GQGT_isotropic is not None:
+            return self.GQGT_isotropic
+
+        G = np.zeros((len(x_nominal), 15, 12))
+        G[:, 3:6, 0:3] = -quaternions_to_rotation_matrices(x_nominal[:, IDX.att])
+        G[:, 6:15, 3:12] = np.eye(9)
+        return G @ self.Q_err @ np.swapaxes(G, -1, -2)
+
+    def discrete_error_matrices(
+            self,
+            x_nominal: np.ndarray,
+            acceleration: np.ndarray,
+            omega: np.ndarray,
+            Ts: float,
+            ) -> Tuple[np.ndarray, np.ndarray]:
+        """Stacked discrete error matrices (Ad, GQGd), each (M,15,15)"""
+        A = self.Aerr(x_nominal, acceleration, omega)
+        GQGT = self.GQGT(x_nominal)
+
+        if self.discretization == "taylor":
+            return taylor_discretization(A, GQGT, Ts, self.discretization_order)
+        return van_loan_discretization(A, GQGT, Ts)
+
+    def predict_covariance(
+            self,
+            x_nominal: np.ndarray,
+            P: np.ndarray,
+            acceleration: np.ndarray,
+            omega: np.ndarray,
+            Ts: float,
+            ) -> np.ndarray:
+        """Predict the stacked error state covariances Ts time units ahead, (M,15,15)"""
+        Ad, GQGd = self.discrete_error_matrices(x_nominal, acceleration, omega, Ts)
+        return Ad @ P @ np.swapaxes(Ad, -1, -2) + GQGd
+
+    def predict(self,
+                x_nominal: np.ndarray,
+                P: np.ndarray,
+                z_acc: np.ndarray,
+                z_gyro: np.ndarray,
+                Ts: float,
+                ) -> Tuple[np.ndarray, np.ndarray]:
+        """Predict M nominal states (M,16) and error state covariances (M,15,15)
+
+        Parameters
+        ----------
+        x_nominal : np.ndarray
+            Nominal states to predict, (M,16).
+        P : np.ndarray
+            Error state covariances to predict (M,15,15).
+        z_acc : np.ndarray
+            Measured acceleration for prediction interval, (3,) or (M,3).
+        z_gyro : np.ndarray
+            Measured rotation rate for the prediction interval, (3,) or (M,3).
+        Ts : float
+            The sampling time.
+
+        Returns
+        -------
+        Tuple[np.array, np.array]: Prediction Tuple(x_nominal_predicted, P_predicted)
+
+        """
+        assert P.shape == (
+            len(x_nominal),
+            15,
+            15,
+            ), f"BatchESKF.predict: P matrix shape incorrect {P.shape}"
+
+        acceleration, omega = self.correct_imu(x_nominal, z_acc, z_gyro)
+
+        x_nominal_predicted = self.predict_nominal(x_nominal, acceleration, omega, Ts)
+        P_predicted = self.predict_covariance(x_nominal, P, acceleration, omega, Ts)
+
+        return x_nominal_predicted, P_predicted
+
+    def inject(self,
+               x_nominal: np.ndarray,
+               delta_x: np.ndarray,
+               P: np.ndarray,
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """Inject M error states (M,15) into the nominal states, see ESKF.inject"""
+        x_injected = x_nominal.copy()
+        x_injected[:, IDX.additive] += delta_x[:, IDX.err_additive]
+
+        #Inject attitude, same error state slice as ESKF.inject
+        delta_quat = np.ones((len(x_nominal), 4))
+        delta_quat[:, 1:] = delta_x[:, IDX.err_acc_bias] / 2
+
+        quaternion = quaternion_products(x_nominal[:, IDX.att], delta_quat)
+        x_injected[:, IDX.att] = (quaternion
+                                  / np.linalg.norm(quaternion, axis=-1, keepdims=True))
+
+        #Covariance reset eq 3.20
+        G_injected = np.broadcast_to(np.eye(15), P.shape).copy()
+        G_injected[:, 6:9, 6:9] -= cross_product_matrices(delta_x[:, IDX.err_att] / 2)
+        P_injected = G_injected @ P @ np.swapaxes(G_injected, -1, -2)
+
+        return x_injected, P_injected
+
+    def update_GNSS_position(
+        self,
+        x_nominal: np.ndarray,
+        P: np.ndarray,
+        z_GNSS_position: np.ndarray,
+        R_GNSS: np.ndarray,
+        R_beacons: np.ndarray,
+        beacon_location: np.ndarray,
+        use_batch_pseudoranges,
+        use_iterative_pseudoranges,
+        lever_arm: np.ndarray = np.zeros(3),
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Update and inject M filters from a pseudorange epoch, see ESKF.update_GNSS_position"""
+        if (use_batch_pseudoranges):
+            delta_x, P_update = self.batch_pseudorange(x_nominal,
+                                                       z_GNSS_position,
+                                                       P,
+                                                       R_GNSS,
+                                                       beacon_location,
+                                                       R_beacons)
+        elif(use_iterative_pseudoranges):
+            delta_x, P_update = self.iterative_pseudorange(x_nominal,
+                                                           z_GNSS_position,
+                                                           P,
+                                                           R_GNSS,
+                                                           beacon_location,
+                                                           R_beacons)
+
+        return self.inject(x_nominal, delta_x, P_update)
+
+    def batch_pseudorange(self,
+                          x_nominal: np.ndarray,
+                          z_GNSS_position: np.ndarray,
+                          P: np.ndarray,
+                          R_GNSS: np.ndarray,
+                          b_loc: np.ndarray,
+                          R_beacons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Pseudorange update of all beacons at once for M filters, see ESKF.batch_pseudorange
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]: (delta_x (M,15), P_update (M,15,15))
+
+        """
+        num_beacons = len(b_loc)
+        R = R_beacons[:num_beacons, :num_beacons]
+
+        #Line of sight vectors and ranges, (M,num_beacons,3) and (M,num_beacons)
+        los_est = b_loc - x_nominal[:, None, IDX.pos]
+        est_ranges = np.linalg.norm(los_est, axis=-1)
+        measured_ranges = np.linalg.norm(b_loc - z_GNSS_position[..., None, :], axis=-1)
+
+        #Pseudorange measurement residual
+        v = np.broadcast_to(measured_ranges, est_ranges.shape) - est_ranges
+
+        #Position columns of the geometry matrix, the rest of H is zero
+        H_pos = -los_est / est_ranges[..., None]
+
+        PH_T = P[..., :3] @ np.swapaxes(H_pos, -1, -2)
+        S = H_pos @ PH_T[:, :3] + R
+
+        #W = P H^T S^-1, S symmetric
+        W = np.swapaxes(np.linalg.solve(S, np.swapaxes(PH_T, -1, -2)), -1, -2)
+
+        delta_x = (W @ v[..., None])[..., 0]
+
+        #Joseph form as low rank terms of WH, the nonzero columns of W @ H
+        WH = W @ H_pos
+        WH_T = np.swapaxes(WH, -1, -2)
+        P_update = (P - WH @ P[:, :3] - P[..., :3] @ WH_T
+                    + WH @ P[:, :3, :3] @ WH_T
+                    + W @ R @ np.swapaxes(W, -1, -2))
+
+        return delta_x, P_update
+
+    def iterative_pseudorange(self,
+                              x_nominal: np.ndarray,
+                              z_GNSS_position: np.ndarray,
+                              P: np.ndarray,
+                              R_GNSS: np.ndarray,
+                              b_loc: np.ndarray,
+                              R_beacons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Sequential pseudorange update, one beacon at a time, for M filters,
+        see ESKF.iterative_pseudorange
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]: (delta_x (M,15), P_update (M,15,15))
+
+        """
+        num_beacons = len(b_loc)
+        pos_est = x_nominal[:, IDX.pos]
+        pos_meas = z_GNSS_position
+
+        delta_x = np.zeros((len(x_nominal), 15))
+        R = 1
+
+        def joseph(P, H_pos, W):
+            """(I - W H) P (I - W H).T + W R W.T as rank one updates"""
+            PH_T = np.einsum('mij,mj->mi', P[..., :3], H_pos)
+            HP = np.einsum('mj,mji->mi', H_pos, P[:, :3])
+            S = np.einsum('mi,mi->m', H_pos, PH_T[:, :3]) + R
+            return (P - W[:, :, None] * HP[:, None, :]
+                    - PH_T[:, :, None] * W[:, None, :]
+                    + S[:, None, None] * W[:, :, None] * W[:, None, :])
+
+        for i in range(num_beacons):
+            z_hat_temp = np.linalg.norm(pos_est - b_loc[i], axis=-1)
+            H_pos = (pos_est - b_loc[i]) / z_hat_temp[:, None]
+            z_hat = z_hat_temp + np.sum(H_pos * delta_x[:, :3], axis=-1)
+
+            z = np.linalg.norm(pos_meas - b_loc[i], axis=-1)
+
+            PH_T = np.einsum('mij,mj->mi', P[..., :3], H_pos)
+            S = np.sum(H_pos * PH_T[:, :3], axis=-1) + R
+            W = PH_T / S[:, None]
+
+            delta_x = delta_x + W * (z - z_hat)[:, None]
+
+            P = joseph(P, H_pos, W)
+
+        #The last beacon's Joseph form applied once more, as in ESKF.iterative_pseudorange
+        P_update = joseph(P, H_pos, W)
+
+        P_update = (P_update + np.swapaxes(P_update, -1, -2)) / 2
+
+        return delta_x, P_update
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Error state kalman filter with compiled (Numba) kernels.
+
+NumbaESKF runs the same equations as ESKF, but the prediction, the pseudorange
+updates and the injection are done in njit compiled functions, and
+predict_segment runs the whole stretch of IMU samples between two GNSS epochs
+in one compiled call. Per sample this replaces dozens of small NumPy calls on
+3-vectors and 15x15 matrices, where the interpreter and dispatch overhead is
+much larger than the arithmetic.
+
+Numba is optional. Check NUMBA_AVAILABLE before using NumbaESKF; without
+Numba the kernels are plain (slow) Python, and run_eskf falls back to the
+NumPy ESKF instead.
+"""
+from typing import Tuple
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from eskf_pseudoranges import ESKF, IDX
+from numba_support import NUMBA_AVAILABLE, njit
+from profiling import profiled
+
+
+# %% Small kernels
+@njit(cache=True)
+def cross_product_matrix(n, out):
+    """Skew symmetric matrix S(n) (3,3), written into out"""
+    out[0, 0] = 0.
+    out[0, 1] = -n[2]
+    out[0, 2] = n[1]
+    out[1, 0] = n[2]
+    out[1, 1] = 0.
+    out[1, 2] = -n[0]
+    out[2, 0] = -n[1]
+    out[2, 1] = n[0]
+    out[2, 2] = 0.
+    return out
+
+
+@njit(cache=True)
+def quaternion_to_rotation_matrix(q, out):
+    """Rotation matrix (3,3) of a quaternion (4,), see quaternion.py"""
+    eta, x, y, z = q[0], q[1], q[2], q[3]
+    out[0, 0] = 1 - 2 * (y * y + z * z)
+    out[0, 1] = 2 * (x * y - eta * z)
+    out[0, 2] = 2 * (x * z + eta * y)
+    out[1, 0] = 2 * (x * y + eta * z)
+    out[1, 1] = 1 - 2 * (x * x + z * z)
+    out[1, 2] = 2 * (y * z - eta * x)
+    out[2, 0] = 2 * (x * z - eta * y)
+    out[2, 1] = 2 * (y * z + eta * x)
+    out[2, 2] = 1 - 2 * (x * x + y * y)
+    return out
+
+
+@njit(cache=True)
+def quaternion_product(ql, qr, out):
+    """Quaternion product ql * qr of two quaternions (4,), see quaternion.py"""
+    out[0] = ql[0] * qr[0] - ql[1] * qr[1] - ql[2] * qr[2] - ql[3] * qr[3]
+    out[1] = ql[0] * qr[1] + qr[0] * ql[1] + ql[2] * qr[3] - ql[3] * qr[2]
+    out[2] = ql[0] * qr[2] + qr[0] * ql[2] + ql[3] * qr[1] - ql[1] * qr[3]
+    out[3] = ql[0] * qr[3] + qr[0] * ql[3] + ql[1] * qr[2] - ql[2] * qr[1]
+    return out
+
+
+# %% Prediction kernels
+@njit(cache=True)
+def correct_imu(x_nominal, z_acc, z_gyro, S_a, S_g, prescaled, acceleration, omega):
+    """ESKF.correct_imu into acceleration and omega (3,)"""
+    for i in range(3):
+        if prescaled:
+            acceleration[i] = z_acc[i] - x_nominal[10 + i]
+            omega[i] = z_gyro[i] - x_nominal[13 + i]
+        else:
+            acceleration[i] = (S_a[i, 0] * z_acc[0] + S_a[i, 1] * z_acc[1]
+                               + S_a[i, 2] * z_acc[2] - x_nominal[10 + i])
+            omega[i] = (S_g[i, 0] * z_gyro[0] + S_g[i, 1] * z_gyro[1]
+                        + S_g[i, 2] * z_gyro[2] - x_nominal[13 + i])
+
+
+@njit(cache=True)
+def predict_nominal(x_nominal, acceleration, omega, Ts, p_acc, p_gyro, out):
+    """ESKF.predict_nominal into out (16,)"""
+    gravity = np.array([0., 0., 9.82])
+    for i in range(3):
+        acceleration_world = acceleration[i] + gravity[i]
+        out[3 + i] = x_nominal[3 + i] + Ts * acceleration_world
+        out[i] = (x_nominal[i] + Ts * x_nominal[3 + i]
+                  + (Ts ** 2) / 2 * acceleration_world)
+
+    omega_step_norm = Ts * np.sqrt(omega[0] ** 2 + omega[1] ** 2 + omega[2] ** 2)
+    delta_quat = np.empty(4)
+    delta_quat[0] = np.cos(omega_step_norm / 2)
+    scale = np.sin(omega_step_norm / 2) * Ts
+    if omega_step_norm > 1e-15:
+        scale /= omega_step_norm
+    for i in range(3):
+        delta_quat[1 + i] = scale * omega[i]
+
+    quaternion = quaternion_product(x_nominal[6:10], delta_quat, np.empty(4))
+    norm = np.sqrt(np.sum(quaternion ** 2))
+    for i in range(4):
+        out[6 + i] = quaternion[i] / norm
+
+    for i in range(3):
+        out[10 + i] = (1 - Ts * p_acc) * x_nominal[10 + i]
+        out[13 + i] = (1 - Ts * p_gyro) * x_nominal[13 + i]
+
+
+@njit(cache=True)
+def Aerr(x_nominal, acceleration, omega, S_a, A_constant, out):
+    """ESKF.Aerr into out (15,15), A_constant holds the state independent blocks"""
+    out[:] = A_constant
+    R = quaternion_to_rotation_matrix(x_nominal[6:10], np.empty((3, 3)))
+    S = cross_product_matrix(acceleration, np.empty((3, 3)))
+    out[3:6, 6:9] = -(R @ S)
+    cross_product_matrix(omega, S)
+    out[3:6, 9:12] = -(S @ S_a)
+
+
+@njit(cache=True)
+def GQGT(x_nominal, Q_err, out):
+    """G @ Q_err @ G.T (15,15) for attitude dependent process noise"""
+    G = np.zeros((15, 12))
+    R = quaternion_to_rotation_matrix(x_nominal[6:10], np.empty((3, 3)))
+    G[3:6, 0:3] = -R
+    for i in range(9):
+        G[6 + i, 3 + i] = 1.
+    out[:] = G @ Q_err @ G.T
+
+
+@njit(cache=True)
+def taylor_discretization(A, GQGT, Ts, order, Ad, GQGd):
+    """eskf_pseudoranges.taylor_discretization into Ad and GQGd (15,15)"""
+    ATs = A * Ts
+    ATs_T = np.ascontiguousarray(ATs.T)
+    term = np.eye(A.shape[0])
+    Ad[:] = term
+
+    noise_term = GQGT * Ts
+    GQGd[:] = noise_term
+
+    for k in range(1, order + 1):
+        term = term @ ATs / k
+        Ad += term
+
+        noise_term = (ATs @ noise_term + noise_term @ ATs_T) / (k + 1)
+        GQGd += noise_term
+
+
+@njit(cache=True)
+def predict(x_nominal, P, z_acc, z_gyro, Ts, prescaled, S_a, S_g, p_acc, p_gyro,
+            A_constant, Q_err, GQGT_isotropic, isotropic, order, x_out, P_out):
+    """ESKF.predict into x_out (16,) and P_out (15,15)"""
+    acceleration = np.empty(3)
+    omega = np.empty(3)
+    correct_imu(x_nominal, z_acc, z_gyro, S_a, S_g, prescaled, acceleration, omega)
+    predict_nominal(x_nominal, acceleration, omega, Ts, p_acc, p_gyro, x_out)
+
+    A = np.empty((15, 15))
+    Aerr(x_nominal, acceleration, omega, S_a, A_constant, A)
+    if isotropic:
+        noise = GQGT_isotropic
+    else:
+        noise = np.empty((15, 15))
+        GQGT(x_nominal, Q_err, noise)
+
+    Ad = np.empty((15, 15))
+    GQGd = np.empty((15, 15))
+    taylor_discretization(A, noise, Ts, order, Ad, GQGd)
+    P_out[:] = Ad @ P @ Ad.T + GQGd
+
+
+@njit(cache=True)
+def predict_segment(x_est, P_est, x_pred, P_pred, z_acc, z_gyro, Ts_IMU,
+                    start, stop, prescaled, S_a, S_g, p_acc, p_gyro,
+                    A_constant, Q_err, GQGT_isotropic, isotropic, order):
+    """The run_eskf loop over the samples start, ..., stop - 1 without updates
+
+    x_est[start], P_est[start] must already be set. Every later sample takes
+    the estimate from the prediction, and every sample before the last one of
+    the arrays is predicted one step ahead, with z_acc[k] and z_gyro[k + 1]
+    as in run_eskf.
+    """
+    N = P_est.shape[0]
+    for k in range(start, stop):
+        if k > start:
+            x_est[k] = x_pred[k]
+            P_est[k] = P_pred[k]
+        if k < N - 1:
+            predict(x_est[k], P_est[k], z_acc[k], z_gyro[k + 1], Ts_IMU[k],
+                    prescaled, S_a, S_g, p_acc, p_gyro, A_constant, Q_err,
+                    GQGT_isotropic, isotropic, order, x_pred[k + 1], P_pred[k + 1])
+
+
+# %% Update kernels
+@njit(cache=True)
+def batch_pseudorange(pos_est, z_GNSS_position, P, b_loc, R):
+    """ESKF.batch_pseudorange, returns (delta_x (15,), P_update (15,15))"""
+    num_beacons = b_loc.shape[0]
+    H_pos = np.empty((num_beacons, 3))
+    v = np.empty(num_beacons)
+    for i in range(num_beacons):
+        los_est = b_loc[i] - pos_est
+        est_range = np.sqrt(np.sum(los_est ** 2))
+        v[i] = np.sqrt(np.sum((b_loc[i] - z_GNSS_position) ** 2)) - est_range
+        H_pos[i] = -los_est / est_range
+
+    P_pos = np.ascontiguousarray(P[:, :3])
+    PH_T = P_pos @ np.ascontiguousarray(H_pos.T)
+    S = H_pos @ np.ascontiguousarray(PH_T[:3]) + R
+
+    # W = P @ H.T @ inv(S), with S symmetric
+    W = np.ascontiguousarray(np.linalg.solve(S, np.ascontiguousarray(PH_T.T)).T)
+    delta_x = W @ v
+
+    WH = W @ H_pos
+    PHW_T = P_pos @ np.ascontiguousarray(WH.T)
+    P_update = (P - WH @ (np.ascontiguousarray(P[:3]) - PHW_T[:3]) - PHW_T
+                + W @ R @ np.ascontiguousarray(W.T))
+    return delta_x, P_update
+
+
+@njit(cache=True)
+def iterative_pseudorange(pos_est, z_GNSS_position, P, b_loc):
+    """ESKF.iterative_pseudorange, returns (delta_x (15,), P_update (15,15))"""
+    num_beacons = b_loc.shape[0]
+    delta_x = np.zeros(15)
+    P = P.copy()
+    R = 1.
+
+    H_pos = np.zeros(3)
+    W = np.zeros(15)
+    for i in range(num_beacons):
+        los = pos_est - b_loc[i]
+        z_hat_temp = np.sqrt(np.sum(los ** 2))
+        H_pos = los / z_hat_temp
+        z_hat = z_hat_temp + np.sum(H_pos * delta_x[:3])
+
+        z = np.sqrt(np.sum((z_GNSS_position - b_loc[i]) ** 2))
+
+        PH_T = np.ascontiguousarray(P[:, :3]) @ H_pos
+        HP = H_pos @ np.ascontiguousarray(P[:3])
+        S = np.sum(H_pos * PH_T[:3]) + R
+        W = PH_T / S
+
+        delta_x += W * (z - z_hat)
+        P = P - np.outer(W, HP - S * W) - np.outer(PH_T, W)
+
+    # The last beacon's Joseph form applied once more to the updated P
+    PH_T = np.ascontiguousarray(P[:, :3]) @ H_pos
+    HP = H_pos @ np.ascontiguousarray(P[:3])
+    S = np.sum(H_pos * PH_T[:3]) + R
+    P_update = P - np.outer(W, HP - S * W) - np.outer(PH_T, W)
+
+    return delta_x, (P_update + P_update.T) / 2
+
+
+@njit(cache=True)
+def inject(x_nominal, delta_x, P):
+    """ESKF.inject, returns (x_injected (16,), P_injected (15,15))"""
+    x_injected = x_nominal.copy()
+    for i in range(6):
+        x_injected[i] += delta_x[i]
+        x_injected[10 + i] += delta_x[9 + i]
+
+    # Same error state slice for the attitude as ESKF.inject
+    delta_quat = np.empty(4)
+    delta_quat[0] = 1.
+    delta_quat[1:] = delta_x[9:12] / 2
+    quaternion = quaternion_product(x_nominal[6:10], delta_quat, np.empty(4))
+    x_injected[6:10] = quaternion / np.sqrt(np.sum(quaternion ** 2))
+
+    G_injected = np.eye(15)
+    G_injected[6:9, 6:9] -= cross_product_matrix(delta_x[6:9] / 2, np.empty((3, 3)))
+    P_injected = G_injected @ P @ np.ascontiguousarray(G_injected.T)
+    return x_injected, P_injected
+
+
+# %% Filter
+@dataclass
+class NumbaESKF(ESKF):
+    """ESKF with the prediction, the pseudorange updates and the injection in
+    compiled kernels, and predict_segment for the IMU samples between updates
+
+    The error state dynamics are always discretized with the truncated Taylor
+    series (discretization_order), since Van Loan's matrix exponential is not
+    available in compiled code.
+    """
+    discretization: str = "taylor"
+
+    # GQGT_isotropic, or zeros when the process noise depends on the attitude
+    GQGT_constant: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        super().__post_init__()
+        assert self.discretization == "taylor", (
+            f"NumbaESKF: only the taylor discretization is compiled, got {self.discretization}"
+        )
+        self.S_a = np.ascontiguousarray(self.S_a, dtype=np.float64)
+        self.S_g = np.ascontiguousarray(self.S_g, dtype=np.float64)
+
+        if self.GQGT_isotropic is not None:
+            self.GQGT_constant = np.ascontiguousarray(self.GQGT_isotropic)
+        else:
+            self.GQGT_constant = np.zeros((15, 15))
+
+    def _model(self) -> tuple:
+        """The model arguments shared by the compiled prediction kernels"""
+        return (self.S_a, self.S_g, float(self.p_acc), float(self.p_gyro),
+                self.workspace.A_constant, self.Q_err, self.GQGT_constant,
+                self.GQGT_isotropic is not None, self.discretization_order)
+
+    def predict(self,
+                x_nominal: np.ndarray,
+                P: np.ndarray,
+                z_acc: np.ndarray,
+                z_gyro: np.ndarray,
+                Ts: float,
+                x_out: np.ndarray = None,
+                P_out: np.ndarray = None,
+                prescaled: bool = False,
+                validate: bool = True,
+                ) -> Tuple[np.ndarray, np.ndarray]:
+        """ESKF.predict in one compiled call"""
+        if x_out is None:
+            x_out = np.empty(16)
+        if P_out is None:
+            P_out = np.empty((15, 15))
+        predict(x_nominal, P, z_acc, z_gyro, float(Ts), prescaled, *self._model(),
+                x_out, P_out)
+        if validate:
+            self.validate_predictions(x_out[None], P_out[None], 0, 1)
+        return x_out, P_out
+
+    def predict_segment(self,
+                        x_est: np.ndarray,
+                        P_est: np.ndarray,
+                        x_pred: np.ndarray,
+                        P_pred: np.ndarray,
+                        z_acc: np.ndarray,
+                        z_gyro: np.ndarray,
+                        Ts_IMU: np.ndarray,
+                        start: int,
+                        stop: int,
+                        prescaled: bool = False,
+                        ) -> None:
+        """Run the samples start, ..., stop - 1 without updates in place,
+        see the predict_segment kernel
+
+        Parameters
+        ----------
+        x_est, x_pred : np.ndarray
+            Nominal state estimates and predictions (N,16), C contiguous.
+        P_est, P_pred : np.ndarray
+            Error state covariance estimates and predictions (N,15,15), C contiguous.
+        z_acc, z_gyro : np.ndarray
+            IMU measurements (N,3).
+        Ts_IMU : np.ndarray
+            Sampling times (N,).
+        start, stop : int
+            The samples to run. x_est[start] and P_est[start] must be set.
+        prescaled : bool, optional
+            z_acc and z_gyro are already multiplied by S_a and S_g, see
+            ESKF.correct_imu. The default is False.
+        """
+        predict_segment(x_est, P_est, x_pred, P_pred, z_acc, z_gyro, Ts_IMU,
+                        start, stop, prescaled, *self._model())
+        self.validate_predictions(x_pred, P_pred, start + 1, min(stop, len(P_est) - 1) + 1)
+
+    def batch_pseudorange(self,
+                          x_nominal: np.ndarray,
+                          z_GNSS_position: np.ndarray,
+                          P: np.ndarray,
+                          R_GNSS: np.ndarray,
+                          b_loc: np.ndarray,
+                          R_beacons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ESKF.batch_pseudorange in one compiled call"""
+        num_beacons = len(b_loc)
+        return batch_pseudorange(np.ascontiguousarray(x_nominal[IDX.pos]),
+                                 np.asarray(z_GNSS_position, dtype=np.float64),
+                                 P,
+                                 np.ascontiguousarray(b_loc, dtype=np.float64),
+                                 np.ascontiguousarray(R_beacons[:num_beacons, :num_beacons]))
+
+    def iterative_pseudorange(self,
+                              x_nominal: np.ndarray,
+                              z_GNSS_position: np.ndarray,
+                              P: np.ndarray,
+                              R_GNSS: np.ndarray,
+                              b_loc: np.ndarray,
+                              R_beacons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ESKF.iterative_pseudorange in one compiled call"""
+        return iterative_pseudorange(np.ascontiguousarray(x_nominal[IDX.pos]),
+                                     np.asarray(z_GNSS_position, dtype=np.float64),
+                                     P,
+                                     np.ascontiguousarray(b_loc, dtype=np.float64))
+
+    @profiled("inject")
+    def inject(self,
+               x_nominal: np.ndarray,
+               delta_x: np.ndarray,
+               P: np.ndarray,
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """ESKF.inject in one compiled call"""
+        return inject(x_nominal, np.ascontiguousarray(np.reshape(delta_x, (15,))), P)
@@ -14,8 +14,9 @@ Created on Tue Apr 13 12:05:48 2021
 # %% imports
 from typing import Tuple, Sequence, Any
 from dataclasses import dataclass, field
-from cat_slice import CatSlice
+from cat_slice import CatSlice, IndexPlan
 
+import math
 import numpy as np
 import scipy.linalg as la
 
@@ -30,9 +31,8 @@ from quaternion import (
 
 
 # from state import NominalIndex, ErrorIndex
-from utils import cross_product_matrix
 
-from timer import*
+from profiling import profiled
 
 # %% indices
 POS_IDX = CatSlice(start=0, stop=3)
@@ -44,6 +44,279 @@ ERR_ATT_IDX = CatSlice(start=6, stop=9)
 ERR_ACC_BIAS_IDX = CatSlice(start=9, stop=12)
 ERR_GYRO_BIAS_IDX = CatSlice(start=12, stop=15)
 
+# The indices and index products used in the filter kernels, compiled once.
+# Contiguous ones are basic slices, which index by view instead of by copy
+IDX = IndexPlan(
+    pos=POS_IDX,
+    vel=VEL_IDX,
+    att=ATT_IDX,
+    acc_bias=ACC_BIAS_IDX,
+    gyro_bias=GYRO_BIAS_IDX,
+    err_att=ERR_ATT_IDX,
+    err_acc_bias=ERR_ACC_BIAS_IDX,
+    err_gyro_bias=ERR_GYRO_BIAS_IDX,
+    # Nominal states injected by addition and the matching error states
+    additive=POS_IDX + VEL_IDX + ACC_BIAS_IDX + GYRO_BIAS_IDX,
+    err_additive=POS_IDX + VEL_IDX + ERR_ACC_BIAS_IDX + ERR_GYRO_BIAS_IDX,
+    # Blocks of Aerr
+    pos_vel=POS_IDX * VEL_IDX,
+    vel_err_att=VEL_IDX * ERR_ATT_IDX,
+    vel_err_acc_bias=VEL_IDX * ERR_ACC_BIAS_IDX,
+    err_att_err_gyro_bias=ERR_ATT_IDX * ERR_GYRO_BIAS_IDX,
+    err_acc_bias_err_acc_bias=ERR_ACC_BIAS_IDX * ERR_ACC_BIAS_IDX,
+    err_gyro_bias_err_gyro_bias=ERR_GYRO_BIAS_IDX * ERR_GYRO_BIAS_IDX,
+    err_att_err_att=ERR_ATT_IDX * ERR_ATT_IDX,
+    )
+
+DISCRETIZATION_METHODS = ("van_loan", "taylor")
+
+# Levels of ESKF.validation:
+#   "off"    no numeric checks
+#   "cheap"  finite values, normalized quaternions, and covariances with
+#            variances of at least min_variance that are symmetric within
+#            symmetry_tolerance
+#   "full"   also that the attitudes give proper rotation matrices, through
+#            the determinant and inverse of quaternion_to_rotation_matrix
+VALIDATION_LEVELS = ("off", "cheap", "full")
+
+# Gravity used by the nominal state prediction
+GRAVITY = np.array([0, 0, 9.82])
+
+# %% Discretization
+def van_loan_discretization(
+        A: np.ndarray,
+        GQGT: np.ndarray,
+        Ts: float,
+        out: Tuple[np.ndarray, np.ndarray] = None,
+        V: np.ndarray = None,
+        GQGT_Ts: np.ndarray = None,
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    """Discretize the error state dynamics with Van Loan's method (matrix exponential)
+
+    Parameters
+    ----------
+    A : np.ndarray
+        Continous time error state dynamics Jacobian (15,15), or a stack (M,15,15).
+    GQGT : np.ndarray
+        Continous time process noise G @ Q_err @ G.T (15,15), or a stack (M,15,15).
+    Ts : float
+        The sampling time.
+    out : Tuple[np.ndarray, np.ndarray], optional
+        Arrays (Ad, GQGd) to write the result into. The default is None.
+    V : np.ndarray, optional
+        Buffer for the Van Loan matrix, (30,30) or (M,30,30). The default is None.
+    GQGT_Ts : np.ndarray, optional
+        GQGT * Ts if already at hand. The default is None, which computes it.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]: Discrete error matrices (Tuple, Ad, GQGd)
+
+    """
+    n = A.shape[-1]
+    if V is None:
+        V = np.zeros((*A.shape[:-2], 2 * n, 2 * n))
+    else:
+        V[..., n:, :n] = 0
+    np.multiply(A, -Ts, out=V[..., :n, :n])
+    if GQGT_Ts is None:
+        np.multiply(GQGT, Ts, out=V[..., :n, n:])
+    else:
+        V[..., :n, n:] = GQGT_Ts
+    np.multiply(np.swapaxes(A, -1, -2), Ts, out=V[..., n:, n:])
+    
+    assert V.shape[-2:] == (
+        30,
+        30,
+        ), f"van_loan_discretization: Van Loan matrix shape incorrect {V.shape}"
+    VanLoanMatrix = la.expm(V)
+    # VanLoanMatrix = np,identity(V.shape[0]) + V #Fast but unsafe
+    
+    if out is None:
+        Ad = np.swapaxes(VanLoanMatrix[..., n:, n:], -1, -2)
+        GQGd = Ad @ VanLoanMatrix[..., :n, n:]
+    else:
+        Ad, GQGd = out
+        Ad[...] = np.swapaxes(VanLoanMatrix[..., n:, n:], -1, -2)
+        np.matmul(Ad, VanLoanMatrix[..., :n, n:], out=GQGd)
+    
+    return Ad, GQGd
+
+
+def taylor_discretization(
+        A: np.ndarray,
+        GQGT: np.ndarray,
+        Ts: float,
+        order: int = 4,
+        out: Tuple[np.ndarray, np.ndarray] = None,
+        work: np.ndarray = None,
+        GQGT_Ts: np.ndarray = None,
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    """Discretize the error state dynamics with truncated Taylor series
+
+        Ad = sum_k (A Ts)^k / k!
+        GQGd = sum_k Ts^(k+1) / (k+1)! M_k,
+        M_0 = GQGT,  M_k = A M_(k-1) + M_(k-1) A.T
+
+    These are the series of exp(A Ts) and int_0^Ts exp(A t) GQGT exp(A.T t) dt,
+    i.e. the quantities Van Loan's method computes, truncated after k = order.
+    
+    Error bound against the Van Loan result, with a = ||A|| Ts in any induced
+    norm (see taylor_discretization_error_bound):
+        ||Ad - Ad_vl||     <= a^(K+1) / (K+1)! * exp(a)
+        ||GQGd - GQGd_vl|| <= Ts ||GQGT|| (2a)^(K+1) / (K+2)! * exp(2a)
+    
+    With p_acc = p_gyro = 0, Aerr is nilpotent (A^4 = 0), so order >= 3 gives
+    Ad exactly and order >= 6 gives GQGd exactly. For the 100 Hz IMU in this
+    project a is around 0.1, which bounds the Ad error of the default order 4
+    by about 1e-6; the observed difference is at round-off level.
+
+    Parameters
+    ----------
+    A : np.ndarray
+        Continous time error state dynamics Jacobian (15,15), or a stack (M,15,15).
+    GQGT : np.ndarray
+        Continous time process noise G @ Q_err @ G.T (15,15), or a stack (M,15,15).
+    Ts : float
+        The sampling time.
+    order : int, optional
+        Highest power of A Ts kept in the series. The default is 4.
+    out : Tuple[np.ndarray, np.ndarray], optional
+        Arrays (Ad, GQGd) to write the result into. The default is None.
+    work : np.ndarray, optional
+        Scratch buffer of shape (5, *A.shape). The default is None.
+    GQGT_Ts : np.ndarray, optional
+        GQGT * Ts if already at hand. The default is None, which computes it.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]: Discrete error matrices (Tuple, Ad, GQGd)
+
+    """
+    if out is None:
+        Ad = np.empty(A.shape)
+        GQGd = np.empty(A.shape)
+    else:
+        Ad, GQGd = out
+    if work is None:
+        work = np.empty((5, *A.shape))
+    ATs, term, noise_term, ATs_noise, noise_ATs_T = work
+    
+    np.multiply(A, Ts, out=ATs)
+    ATs_T = np.swapaxes(ATs, -1, -2)
+    term[...] = 0
+    np.einsum('...ii->...i', term)[...] = 1
+    Ad[...] = term
+    
+    #k = 0 term of the noise integral
+    if GQGT_Ts is None:
+        np.multiply(GQGT, Ts, out=noise_term)
+    else:
+        noise_term[...] = GQGT_Ts
+    GQGd[...] = noise_term
+    
+    for k in range(1, order + 1):
+        # term = term @ ATs / k, through a scratch buffer since matmul
+        # can not write into one of its inputs
+        np.matmul(term, ATs, out=ATs_noise)
+        np.divide(ATs_noise, k, out=term)
+        Ad += term
+        
+        np.matmul(ATs, noise_term, out=ATs_noise)
+        np.matmul(noise_term, ATs_T, out=noise_ATs_T)
+        np.add(ATs_noise, noise_ATs_T, out=noise_term)
+        noise_term /= k + 1
+        GQGd += noise_term
+    
+    return Ad, GQGd
+
+
+def taylor_discretization_error_bound(
+        A: np.ndarray,
+        GQGT: np.ndarray,
+        Ts: float,
+        order: int = 4,
+        ) -> Tuple[float, float]:
+    """Upper bounds, in the induced 1-norm, on the difference between
+    taylor_discretization and van_loan_discretization
+
+    Returns
+    -------
+    Tuple[float, float]: (bound on Ad error, bound on GQGd error)
+
+    """
+    a = la.norm(A, 1) * Ts
+    Ad_bound = a ** (order + 1) / math.factorial(order + 1) * np.exp(a)
+    GQGd_bound = (Ts * la.norm(GQGT, 1) * (2 * a) ** (order + 1)
+                  / math.factorial(order + 2) * np.exp(2 * a))
+    return Ad_bound, GQGd_bound
+
+
+def _cross_product_matrix(n: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Skew symmetric matrix S(n) with S(n) @ v == np.cross(n, v), written into out (3,3)"""
+    out[0, 0] = 0
+    out[0, 1] = -n[2]
+    out[0, 2] = n[1]
+    out[1, 0] = n[2]
+    out[1, 1] = 0
+    out[1, 2] = -n[0]
+    out[2, 0] = -n[1]
+    out[2, 1] = n[0]
+    out[2, 2] = 0
+    return out
+
+
+@dataclass
+class StepKinematics:
+    """Quantities of one prediction step shared by the predict kernels
+
+    Made by ESKF.kinematics from the nominal state and the bias corrected IMU
+    samples, so the rotation matrix (with its debug checks) and the cross
+    product matrices are computed once per step instead of once per kernel.
+    """
+    # Bias corrected IMU samples (3,)
+    acceleration: np.ndarray = field(default_factory=lambda: np.zeros(3))
+    omega: np.ndarray = field(default_factory=lambda: np.zeros(3))
+    
+    # Rotation matrix of the nominal attitude (3,3)
+    R: np.ndarray = field(default_factory=lambda: np.eye(3))
+    
+    # cross_product_matrix of acceleration and omega (3,3)
+    acceleration_cross: np.ndarray = field(default_factory=lambda: np.zeros((3, 3)))
+    omega_cross: np.ndarray = field(default_factory=lambda: np.zeros((3, 3)))
+
+
+@dataclass
+class ESKFWorkspace:
+    """Preallocated buffers for the ESKF predict and inject kernels
+
+    Owned by an ESKF instance. Every call into the filter overwrites the
+    buffers, so nothing read from here is valid after the next call.
+    """
+    # Kinematics of the current prediction step
+    kinematics: StepKinematics = field(default_factory=StepKinematics)
+    
+    # Nominal state kernels
+    R: np.ndarray = field(default_factory=lambda: np.zeros((3, 3)))
+    delta_quat: np.ndarray = field(default_factory=lambda: np.zeros(4))
+    quaternion: np.ndarray = field(default_factory=lambda: np.zeros(4))
+    
+    # Error state kernels
+    cross: np.ndarray = field(default_factory=lambda: np.zeros((3, 3)))
+    block: np.ndarray = field(default_factory=lambda: np.zeros((3, 3)))
+    A: np.ndarray = field(default_factory=lambda: np.zeros((15, 15)))
+    # Entries of Aerr that do not depend on the state, set by the ESKF
+    A_constant: np.ndarray = field(default_factory=lambda: np.zeros((15, 15)))
+    G: np.ndarray = field(default_factory=lambda: np.zeros((15, 12)))
+    V: np.ndarray = field(default_factory=lambda: np.zeros((30, 30)))
+    taylor: np.ndarray = field(default_factory=lambda: np.zeros((5, 15, 15)))
+    Ad: np.ndarray = field(default_factory=lambda: np.zeros((15, 15)))
+    GQGd: np.ndarray = field(default_factory=lambda: np.zeros((15, 15)))
+    AdP: np.ndarray = field(default_factory=lambda: np.zeros((15, 15)))
+    G_injected: np.ndarray = field(default_factory=lambda: np.eye(15))
+    GP: np.ndarray = field(default_factory=lambda: np.zeros((15, 15)))
+
+
 @dataclass
 class ESKF:
     sigma_acc: float #acc_std
@@ -60,18 +333,66 @@ class ESKF:
     debug: bool = True
     use_pseudorange: bool = True
 
+    # Discretization of the error state dynamics, see DISCRETIZATION_METHODS
+    discretization: str = "van_loan"
+    discretization_order: int = 4
+
+    # Numeric health checks, see VALIDATION_LEVELS. Predictions are checked
+    # every validation_interval-th step, updates every time. The default is
+    # None, which is "full" in debug mode and "off" otherwise
+    validation: str = None
+    validation_interval: int = 1
+    min_variance: float = 0.
+    # Largest |P - P.T| relative to the largest variance of P
+    symmetry_tolerance: float = 1e-9
+
     g: np.ndarray = np.array([0, 0,9.82])
 
     Q_err: np.array = field(init=False, repr=False)
     
     Q_err: np.array = field(init=False, repr=False)
+    
+    # G @ Q_err @ G.T when it does not depend on the attitude, else None
+    GQGT_isotropic: np.ndarray = field(init=False, repr=False)
+    
+    # GQGT_isotropic * GQGT_Ts_step, the k = 0 term of the discrete noise
+    # integral, kept for the next step with the same sampling time
+    GQGT_Ts: np.ndarray = field(init=False, repr=False)
+    GQGT_Ts_step: float = field(init=False, repr=False)
+    
+    # Reusable buffers for the predict and inject kernels
+    workspace: ESKFWorkspace = field(init=False, repr=False)
+
+    # Number of steps predicted, to sample the checks of the predictions
+    validation_step: int = field(init=False, repr=False)
 
     def __post_init__(self):
         if self.debug:
             print(
                 "ESKF in debug mode, some numeric properties are checked at the expense of calculation speed"
             )
-        
+        assert self.discretization in DISCRETIZATION_METHODS, (
+            f"ESKF: unknown discretization {self.discretization}, expected one of {DISCRETIZATION_METHODS}"
+        )
+        assert self.discretization_order > 0, (
+            f"ESKF: discretization_order must be a positive integer: {self.discretization_order}"
+        )
+        if self.validation is None:
+            self.validation = "full" if self.debug else "off"
+        assert self.validation in VALIDATION_LEVELS, (
+            f"ESKF: unknown validation {self.validation}, expected one of {VALIDATION_LEVELS}"
+        )
+        assert self.validation_interval > 0, (
+            f"ESKF: validation_interval must be a positive integer: {self.validation_interval}"
+        )
+        self.validation_step = 0
+
+        self.workspace = ESKFWorkspace()
+        A_constant = self.workspace.A_constant
+        A_constant[IDX.pos_vel] = np.eye(3)
+        A_constant[IDX.err_att_err_gyro_bias] = -self.S_g
+        A_constant[IDX.err_acc_bias_err_acc_bias] = -self.p_acc * np.eye(3)
+        A_constant[IDX.err_gyro_bias_err_gyro_bias] = -self.p_gyro * np.eye(3)
 
         self.Q_err = (
             la.block_diag(
@@ -82,12 +403,29 @@ class ESKF:
             )
             ** 2
         )
+        
+        # The attitude only enters G through the -R block acting on the
+        # accelerometer noise. With isotropic accelerometer noise q*I we get
+        # R (q*I) R.T = q*I, so G @ Q_err @ G.T is the same for every nominal state
+        Q_acc = self.Q_err[:3, :3]
+        if np.array_equal(Q_acc, Q_acc[0, 0] * np.eye(3)):
+            x_identity = np.zeros(16)
+            x_identity[IDX.att] = np.array([1, 0, 0, 0])
+            G = self.Gerr(x_identity)
+            self.GQGT_isotropic = G @ self.Q_err @ G.T
+        else:
+            self.GQGT_isotropic = None
+        self.GQGT_Ts = np.zeros((15, 15))
+        self.GQGT_Ts_step = None
             
+    @profiled("predict_nominal")
     def predict_nominal(self,
                          x_nominal: np.ndarray,
                          acceleration_b: np.ndarray,
                          omega: np.ndarray,
-                         Ts: float
+                         Ts: float,
+                         out: np.ndarray = None,
+                         kinematics: StepKinematics = None,
                          ) -> np.ndarray:
         
         """Discrete time prediction,
@@ -99,6 +437,8 @@ class ESKF:
             acceleration (np.ndarray): The estimated acceleration in body for the predicted interval, shape (3,)
             omega (np.ndarray): The estimated rotation rate in body for the prediction interval, shape (3,)
             Ts (float): The sampling time
+            out (np.ndarray, optional): Array (16,) to write the predicted state into, must not be x_nominal
+            kinematics (StepKinematics, optional): Kinematics of this step, whose R was already checked in debug mode
 
         Raises:
         -----------
@@ -120,66 +460,58 @@ class ESKF:
         ), f"ESKF.predict_nominal: omega incorrect shape {omega.shape}"
         
         # Extract states
-        position = x_nominal[POS_IDX]
-        velocity = x_nominal[VEL_IDX]
-        quaternion = x_nominal[ATT_IDX]
-        acceleration_bias = x_nominal[ACC_BIAS_IDX]
-        gyroscope_bias = x_nominal[GYRO_BIAS_IDX]
+        position = x_nominal[IDX.pos]
+        velocity = x_nominal[IDX.vel]
+        quaternion = x_nominal[IDX.att]
+        acceleration_bias = x_nominal[IDX.acc_bias]
+        gyroscope_bias = x_nominal[IDX.gyro_bias]
         
-        if self.debug:
+        if self.debug and kinematics is None:
           assert np.allclose(
               np.linalg.norm(quaternion), 1, rtol=0, atol=1e-15
           ), "ESKF.predict_nominal: Quaternion not normalized."
           assert np.allclose(
               np.sum(quaternion ** 2), 1, rtol=0, atol=1e-15
           ), "ESKF.predict_nominal: Quaternion not normalized and norm failed to catch it."
+          quaternion_to_rotation_matrix(quaternion, debug=True, out=self.workspace.R)
 
 
-        R = quaternion_to_rotation_matrix(quaternion, debug=self.debug)
-        g = np.array([0,0,9.82 ])
-
-        acceleration_world = acceleration_b + g #acceleration_b = specific_force, 
+        if out is None:
+            out = np.empty(16)
+        x_nominal_predicted = out
+        
+        acceleration_world = acceleration_b + GRAVITY #acceleration_b = specific_force, 
 
-        velocity_prediction = velocity + Ts * acceleration_world
+        x_nominal_predicted[IDX.vel] = velocity + Ts * acceleration_world
         
-        position_prediction = position + Ts * velocity + (Ts **2)/2 * acceleration_world
+        x_nominal_predicted[IDX.pos] = position + Ts * velocity + (Ts **2)/2 * acceleration_world
         omega_step = Ts * omega
-        omega_step_norm = la.norm(omega_step)
+        omega_step_norm = math.sqrt(omega_step @ omega_step)
         
+        delta_quat = self.workspace.delta_quat
+        delta_quat[0] = math.cos(omega_step_norm/2)
         if omega_step_norm > 1e-15:
-            delta_quat = np.array([np.cos(omega_step_norm/2 ),
-                                *(np.sin(omega_step_norm/2 )* omega_step.T / omega_step_norm)])
-        
+            delta_quat[1:] = math.sin(omega_step_norm/2) * omega_step / omega_step_norm
         else:
-            delta_quat = np.array([np.cos(omega_step_norm/2 ),
-                                *(np.sin(omega_step_norm/2 )* omega_step.T / 1)])
+            delta_quat[1:] = math.sin(omega_step_norm/2) * omega_step
 
 
-        quaternion_prediction = quaternion_product(quaternion, delta_quat)
+        quaternion_prediction = quaternion_product(quaternion,
+                                                   delta_quat,
+                                                   out=self.workspace.quaternion)
         
         #Quaternion normalization
-        quaternion_prediction = (quaternion_prediction
-                                 / la.norm(quaternion_prediction))
+        x_nominal_predicted[IDX.att] = (quaternion_prediction
+                                        / math.sqrt(quaternion_prediction @ quaternion_prediction))
         
         #1. Ordens approx
         # Cont eq: acc_bias_dot = -p_acc*I*acc_bias
         # Disc eq: acc_bias_k+1 = acc_bias_k - p_acc*Ts*acc_bias_true, => acc_bt = acc_est at best
-        acceleration_bias_prediction = ((1 - Ts * self.p_acc)
-                                        * acceleration_bias) 
-        
-        gyroscope_bias_prediction = ((1 - Ts * self.p_gyro)
-                                     * gyroscope_bias)
-        
+        x_nominal_predicted[IDX.acc_bias] = ((1 - Ts * self.p_acc)
+                                             * acceleration_bias) 
         
-        x_nominal_predicted = np.concatenate(
-            (
-                position_prediction,
-                velocity_prediction,
-                quaternion_prediction,
-                acceleration_bias_prediction,
-                gyroscope_bias_prediction,
-            )
-        )
+        x_nominal_predicted[IDX.gyro_bias] = ((1 - Ts * self.p_gyro)
+                                              * gyroscope_bias)
         
         assert x_nominal_predicted.shape == (
             16,
@@ -191,6 +523,8 @@ class ESKF:
             x_nominal: np.ndarray,
             acceleration: np.ndarray,
             omega: np.ndarray,
+            out: np.ndarray = None,
+            kinematics: StepKinematics = None,
             ) -> np.ndarray:
         """Calculates the continous time error state dynamics jacobian
 
@@ -202,6 +536,11 @@ class ESKF:
             Estimated acceleration in body for prediction interval, (3,).
         omega : np.ndarray
             Estimated rotation rate in body for prediction interval, (3,).
+        out : np.ndarray, optional
+            Array (15,15) to write the Jacobian into. The default is None.
+        kinematics : StepKinematics, optional
+            Kinematics of this step from ESKF.kinematics. The default is
+            None, which computes them.
             
         Raises
         -------
@@ -222,25 +561,25 @@ class ESKF:
             3,
         ), f"ESKF.Aerr: omega incorrect shape {omega.shape}"
         
-        #Rotation matrix
-        R = quaternion_to_rotation_matrix(x_nominal[ATT_IDX], debug = self.debug)
+        workspace = self.workspace
+        if kinematics is None:
+            kinematics = self.kinematics(x_nominal, acceleration, omega)
         
-        #Allocate matrix
-        A = np.zeros((15,15))
+        #Start from the state independent submatrices:
+        # I, -S_g (bias corrected) and the bias decay
+        if out is None:
+            out = np.empty((15,15))
+        A = out
+        A[...] = workspace.A_constant
         
-        #Set submatrices
-        A[POS_IDX * VEL_IDX] = np.eye(3)
-        A[VEL_IDX * ERR_ATT_IDX] = -R @ cross_product_matrix(acceleration)
-        A[VEL_IDX * ERR_ACC_BIAS_IDX] = -cross_product_matrix(omega)
-        A[ERR_ATT_IDX * ERR_GYRO_BIAS_IDX] = -np.eye(3)
-        A[ERR_ACC_BIAS_IDX * ERR_ACC_BIAS_IDX] = -self.p_acc * np.eye(3)
-        A[ERR_GYRO_BIAS_IDX * ERR_GYRO_BIAS_IDX] = -self.p_gyro * np.eye(3)
+        #Set the state dependent submatrices
+        block = workspace.block
+        np.matmul(kinematics.R, kinematics.acceleration_cross, out=block)
+        np.negative(block, out=A[IDX.vel_err_att])
         
         #Bias Correction
-        A[VEL_IDX * ERR_ACC_BIAS_IDX] = A[VEL_IDX * ERR_ACC_BIAS_IDX] @ self.S_a
-        A[ERR_ATT_IDX * ERR_GYRO_BIAS_IDX] = (
-            A[ERR_ATT_IDX * ERR_GYRO_BIAS_IDX] @ self.S_g
-        )
+        np.matmul(kinematics.omega_cross, self.S_a, out=block)
+        np.negative(block, out=A[IDX.vel_err_acc_bias])
     
         assert A.shape ==(
             15,
@@ -250,6 +589,8 @@ class ESKF:
     
     def Gerr(self,
              x_nominal: np.ndarray,
+             out: np.ndarray = None,
+             kinematics: StepKinematics = None,
              ) -> np.ndarray:
         """Calculate the continous time error state noise input matrix
     
@@ -260,6 +601,10 @@ class ESKF:
             Nominal state vector (16,)
          : TYPE
             np.ndarray.
+        out : np.ndarray, optional
+            Array (15,12) to write G into. The default is None.
+        kinematics : StepKinematics, optional
+            Kinematics of this step, to reuse its R. The default is None.
 
         Returns
         -------
@@ -271,10 +616,20 @@ class ESKF:
             16,
         ), f"ESKF.Gerr: x_nominal incorrect shape {x_nominal.shape}"
         
-        R = quaternion_to_rotation_matrix(x_nominal[ATT_IDX], debug=self.debug)
+        if out is None:
+            out = np.empty((15,12))
+        G = out
+        G[...] = 0
         
-        G = np.zeros((15,12))
-        G[3:] = la.block_diag(-R, np.eye(3), np.eye(3), np.eye(3))
+        # G[3:] = block_diag(-R, I, I, I)
+        if kinematics is None:
+            quaternion_to_rotation_matrix(x_nominal[IDX.att],
+                                          debug=self.debug,
+                                          out=G[3:6, :3])
+        else:
+            G[3:6, :3] = kinematics.R
+        G[3:6, :3] *= -1
+        np.fill_diagonal(G[6:, 3:], 1)
         
         assert G.shape == (
             15,
@@ -282,12 +637,43 @@ class ESKF:
             ), f"ESKF.Gerr: G-matrix shape incorrect {G.shape}"
         return G
     
+    def GQGT(self,
+             x_nominal: np.ndarray,
+             kinematics: StepKinematics = None,
+             ) -> np.ndarray:
+        """Calculate the continous time error state process noise G @ Q_err @ G.T
+
+        Uses the matrix precomputed in __post_init__ when the accelerometer
+        noise is isotropic, and falls back to Gerr for anisotropic noise.
+
+        Parameters
+        ----------
+        x_nominal : np.ndarray
+            Nominal state vector (16,)
+        kinematics : StepKinematics, optional
+            Kinematics of this step, to reuse its R. The default is None.
+
+        Returns
+        -------
+        GQGT : np.ndarray
+            Continous time process noise covariance (15,15)
+
+        """
+        if self.GQGT_isotropic is not None:
+            return self.GQGT_isotropic
+        
+        G = self.Gerr(x_nominal, out=self.workspace.G, kinematics=kinematics)
+        return G @ self.Q_err @ G.T
+    
+    @profiled("discrete_error_matrices")
     def discrete_error_matrices(
             self,
             x_nominal: np.ndarray,
             acceleration: np.ndarray,
             omega: np.ndarray,
             Ts: float,
+            out: Tuple[np.ndarray, np.ndarray] = None,
+            kinematics: StepKinematics = None,
             ) -> Tuple[np.ndarray, np.ndarray]:
         """Calculate the discrete time linearized error state transition and covariance matrix
         
@@ -302,6 +688,11 @@ class ESKF:
             Estimated rotation rate in body for prediction interval, (3,).
         Ts : float
             The ampling time.
+        out : Tuple[np.ndarray, np.ndarray], optional
+            Arrays (Ad, GQGd) to write the result into. The default is None.
+        kinematics : StepKinematics, optional
+            Kinematics of this step from ESKF.kinematics. The default is
+            None, which computes them.
         
         Raises
         -------
@@ -325,25 +716,43 @@ class ESKF:
         ), f"ESKF.discrete_error_matrices: omega incorrect shape {omega.shape}"
         
         
+        if kinematics is None:
+            kinematics = self.kinematics(x_nominal, acceleration, omega)
+        
         #Calculate continious time error state dynamics Jacobian
-        A = self.Aerr(x_nominal, acceleration, omega)
+        A = self.Aerr(x_nominal,
+                      acceleration,
+                      omega,
+                      out=self.workspace.A,
+                      kinematics=kinematics)
 
-        #Calculate continuous time error state noise input matrix
-        G = self.Gerr(x_nominal)
+        #Calculate continuous time error state noise
+        GQGT = self.GQGT(x_nominal, kinematics=kinematics)
+        
+        #With constant GQGT the first noise term only changes with Ts, which
+        #is fixed by the IMU rate
+        GQGT_Ts = None
+        if self.GQGT_isotropic is not None:
+            if self.GQGT_Ts_step != Ts:
+                np.multiply(GQGT, Ts, out=self.GQGT_Ts)
+                self.GQGT_Ts_step = Ts
+            GQGT_Ts = self.GQGT_Ts
 
-        
-        V = np.block([[-A, G @ self.Q_err @ G.T],
-                      [np.zeros_like(A), A.T]]) * Ts
-        
-        assert V.shape == (
-            30,
-            30,
-            ), f"ESKF.discrete_error_matrices: Van Loan matrix shape incorrect {V.shape}"
-        VanLoanMatrix = la.expm(V)
-        # VanLoanMatrix = np,identity(V.shape[0]) + V #Fast but unsafe
-        
-        Ad = VanLoanMatrix[CatSlice(15, 30)**2].T
-        GQGd = Ad @ VanLoanMatrix[CatSlice(0, 15) * CatSlice(15, 30)]
+        if self.discretization == "taylor":
+            Ad, GQGd = taylor_discretization(A,
+                                             GQGT,
+                                             Ts,
+                                             self.discretization_order,
+                                             out=out,
+                                             work=self.workspace.taylor,
+                                             GQGT_Ts=GQGT_Ts)
+        else:
+            Ad, GQGd = van_loan_discretization(A,
+                                               GQGT,
+                                               Ts,
+                                               out=out,
+                                               V=self.workspace.V,
+                                               GQGT_Ts=GQGT_Ts)
         
         assert Ad.shape == (
             15,
@@ -356,6 +765,7 @@ class ESKF:
         
         return Ad, GQGd
     
+    @profiled("predict_covariance")
     def predict_covariance(
             self,
             x_nominal: np.ndarray,
@@ -363,6 +773,8 @@ class ESKF:
             acceleration: np.ndarray,
             omega: np.ndarray,
             Ts: float,
+            out: np.ndarray = None,
+            kinematics: StepKinematics = None,
             ) -> np.ndarray:
         
         """Predicts the error state covariance Ts time units ahead using linearized
@@ -374,6 +786,8 @@ class ESKF:
             acceleration: Estimated acceleration for prediction interval (3,)
             omega: Estimated rotation rate for prediction interval (3,)
             Ts: Sampling time
+            out: Optional array (15,15) to write the result into, must not be P
+            kinematics: Optional kinematics of this step from ESKF.kinematics
         Raises:
             AssertionError: If inputs or output is wrong shape.
         Returns:
@@ -395,14 +809,24 @@ class ESKF:
         
 
         
+        workspace = self.workspace
+        
         #Compute discrete time linearized error state transition and covariance matrix
         Ad, GQGd = self.discrete_error_matrices(
             x_nominal,
             acceleration,
             omega,
-            Ts)
-        
-        P_predicted = Ad @ P @ Ad.T + GQGd
+            Ts,
+            out=(workspace.Ad, workspace.GQGd),
+            kinematics=kinematics)
+        
+        # P_predicted = Ad @ P @ Ad.T + GQGd
+        if out is None:
+            out = np.empty((15,15))
+        P_predicted = out
+        np.matmul(Ad, P, out=workspace.AdP)
+        np.matmul(workspace.AdP, Ad.T, out=P_predicted)
+        P_predicted += GQGd
         
         assert P_predicted.shape == (
             15,
@@ -410,6 +834,23 @@ class ESKF:
         ), f"ESKF.predict_covariance: P_predicted shape incorrect {P_predicted.shape}"
         
         return P_predicted
+
+    def propagate_covariance(self,
+                             P: np.ndarray,
+                             Ad: np.ndarray,
+                             GQGd: np.ndarray,
+                             ) -> np.ndarray:
+        """Error state covariance Ad @ P @ Ad.T + GQGd, for a transition
+        Ad and noise GQGd chained over several steps
+
+        Args:
+            P: Error state covariance (15,15)
+            Ad: Discrete error state transition matrix (15,15)
+            GQGd: Discrete process noise covariance (15,15)
+        Returns:
+            The propagated error state covariance (15,15)
+        """
+        return Ad @ P @ Ad.T + GQGd
     
     
     def predict(self,
@@ -418,6 +859,10 @@ class ESKF:
                 z_acc: np.ndarray,
                 z_gyro: np.ndarray,
                 Ts: float,
+                x_out: np.ndarray = None,
+                P_out: np.ndarray = None,
+                prescaled: bool = False,
+                validate: bool = True,
                 ) -> np.array:#Tuple [np.array, np.array]:
         """
         
@@ -433,6 +878,16 @@ class ESKF:
             Measured rotation rate for the prediction interval, (3,).
         Ts : float
             The sampling time.
+        x_out, P_out : np.ndarray, optional
+            Arrays (16,) and (15,15) to write the prediction into, e.g. the
+            next rows of preallocated result arrays. They must not be
+            x_nominal or P. The default is None, which allocates new arrays.
+        prescaled : bool, optional
+            z_acc and z_gyro are already multiplied by S_a and S_g, see
+            correct_imu. The default is False.
+        validate : bool, optional
+            Check the prediction with validate_predictions. The default is
+            True, predict_segment checks its steps together instead.
         Raises
         -------
         AssertionError: If any input or output is wrong shape
@@ -462,16 +917,16 @@ class ESKF:
             3,
             ), f"ESKF.predict: z_gyro shape incorrect {z_gyro.shape}"
 
-        #Correct measurement. In this case S_a = S_g = eye(3)
-        r_z_acc = self.S_a @ z_acc
-        r_z_gyro = self.S_g @ z_gyro
-        
-        #Debiased IMU measurements
-        acc_bias = x_nominal[ACC_BIAS_IDX]
-        gyro_bias = x_nominal[GYRO_BIAS_IDX]
-        
-        acceleration = r_z_acc - acc_bias
-        omega = r_z_gyro - gyro_bias
+        #Everything the kernels below share, computed once for this step
+        kinematics = self.workspace.kinematics
+        acceleration, omega = self.correct_imu(
+            x_nominal,
+            z_acc,
+            z_gyro,
+            out=(kinematics.acceleration, kinematics.omega),
+            prescaled=prescaled)
+        #The rotation matrix is checked with the predictions below
+        self.kinematics(x_nominal, acceleration, omega, out=kinematics, debug=False)
         
         #Predict:
         # print("ESKF.predict quaternion: ", x_nominal[ATT_IDX])
@@ -479,14 +934,18 @@ class ESKF:
                                                    acceleration,
                         
                                                    omega,
-                                                   Ts
+                                                   Ts,
+                                                   out=x_out,
+                                                   kinematics=kinematics
                                                    )
         
         P_predicted = self.predict_covariance(x_nominal,
                                               P,
                                               acceleration,
                                               omega,
-                                              Ts)
+                                              Ts,
+                                              out=P_out,
+                                              kinematics=kinematics)
         # print("x_nominal_predicted[k+1]: ", x_nominal_predicted[0:6])
         assert x_nominal_predicted.shape ==(
             16,
@@ -496,8 +955,217 @@ class ESKF:
             15
         ), f"ESKF.predict: P_predicted_nominal shape incorrect {P_predicted.shape}"
         
+        if validate:
+            self.validate_predictions(x_nominal_predicted[None], P_predicted[None], 0, 1)
         return x_nominal_predicted, P_predicted
+
+    def predict_segment(self,
+                        x_est: np.ndarray,
+                        P_est: np.ndarray,
+                        x_pred: np.ndarray,
+                        P_pred: np.ndarray,
+                        z_acc: np.ndarray,
+                        z_gyro: np.ndarray,
+                        Ts_IMU: np.ndarray,
+                        start: int,
+                        stop: int,
+                        prescaled: bool = False,
+                        ) -> None:
+        """Run the IMU samples start, ..., stop - 1 without updates in place
+
+        Every sample after start takes the estimate from the prediction, and
+        every sample before the last one of the arrays is predicted one step
+        ahead with z_acc[k] and z_gyro[k + 1], as in run_eskf.
+
+        Parameters
+        ----------
+        x_est, x_pred : np.ndarray
+            Nominal state estimates and predictions (N,16).
+        P_est, P_pred : np.ndarray
+            Error state covariance estimates and predictions (N,15,15).
+        z_acc, z_gyro : np.ndarray
+            IMU measurements (N,3).
+        Ts_IMU : np.ndarray
+            Sampling times (N,).
+        start, stop : int
+            The samples to run. x_est[start] and P_est[start] must be set.
+        prescaled : bool, optional
+            z_acc and z_gyro are already multiplied by S_a and S_g, see
+            correct_imu. The default is False.
+        """
+        N = len(P_est)
+        for k in range(start, stop):
+            if k > start:
+                x_est[k] = x_pred[k]
+                P_est[k] = P_pred[k]
+            if k < N - 1:
+                # Writes straight into the next rows of the result arrays
+                self.predict(x_est[k],
+                             P_est[k],
+                             z_acc[k], #Denne er k pga måten dataen er laget på (?)
+                             z_gyro[k+1],
+                             Ts_IMU[k],
+                             x_out=x_pred[k+1],
+                             P_out=P_pred[k+1],
+                             prescaled=prescaled,
+                             validate=False)
+        self.validate_predictions(x_pred, P_pred, start + 1, min(stop, N - 1) + 1)
+
+    def validate(self,
+                 x_nominal: np.ndarray,
+                 P: np.ndarray,
+                 where: str,
+                 ) -> None:
+        """Check nominal states and covariances at the level of validation
+
+        Parameters
+        ----------
+        x_nominal : np.ndarray
+            Nominal states, (16,) or stacked (M,16).
+        P : np.ndarray
+            Their error state covariances, (15,15) or (M,15,15).
+        where : str
+            Name of the caller, for the messages.
+
+        Raises
+        ------
+        AssertionError: If a check fails
+        """
+        if self.validation == "off" or len(P) == 0:
+            return
+        assert np.all(np.isfinite(x_nominal)), f"{where}: nominal state not finite"
+        quaternion = x_nominal[..., IDX.att]
+        norm_error = np.abs(np.sum(quaternion ** 2, axis=-1) - 1)
+        assert np.all(norm_error <= 1e-12), (
+            f"{where}: quaternion not normalized, |q|^2 - 1 = {norm_error.max()}")
+        self.validate_covariance(P, where)
+        
+        if self.validation == "full":
+            for q in quaternion.reshape(-1, 4):
+                quaternion_to_rotation_matrix(q, debug=True, out=self.workspace.R)
+
+    def validate_covariance(self, P: np.ndarray, where: str) -> None:
+        """The covariance checks of validate, (15,15) or (M,15,15)"""
+        assert np.all(np.isfinite(P)), f"{where}: covariance not finite"
+        variances = np.diagonal(P, axis1=-2, axis2=-1)
+        assert np.all(variances >= self.min_variance), (
+            f"{where}: variance {variances.min()} below min_variance {self.min_variance}")
+        asymmetry = np.abs(P - np.swapaxes(P, -1, -2)).max(axis=(-2, -1))
+        assert np.all(asymmetry <= self.symmetry_tolerance * variances.max(axis=-1)), (
+            f"{where}: covariance not symmetric, max |P - P.T| = {asymmetry.max()}")
+
+    def validate_predictions(self,
+                             x_pred: np.ndarray,
+                             P_pred: np.ndarray,
+                             first: int,
+                             stop: int,
+                             ) -> None:
+        """Check the predicted steps first, ..., stop - 1 of x_pred and P_pred
+        that fall on every validation_interval-th step of the filter
+
+        Called by predict for single steps, and by predict_segment for all
+        the steps of a segment at once, which costs much less per step.
+        """
+        steps = stop - first
+        if steps <= 0:
+            return
+        if self.validation != "off":
+            offset = -self.validation_step % self.validation_interval
+            rows = slice(first + offset, stop, self.validation_interval)
+            self.validate(x_pred[rows], P_pred[rows], "ESKF.predict")
+        self.validation_step += steps
+
+    def correct_imu(self,
+                    x_nominal: np.ndarray,
+                    z_acc: np.ndarray,
+                    z_gyro: np.ndarray,
+                    out: Tuple[np.ndarray, np.ndarray] = None,
+                    prescaled: bool = False,
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Correct the IMU measurements for scale/misalignment and the estimated biases
+
+        Parameters
+        ----------
+        x_nominal : np.ndarray
+            Nominal state holding the bias estimates, (16,).
+        z_acc : np.ndarray
+            Measured acceleration, (3,).
+        z_gyro : np.ndarray
+            Measured rotation rate, (3,).
+        out : Tuple[np.ndarray, np.ndarray], optional
+            Arrays (3,) to write (acceleration, omega) into. The default is None.
+        prescaled : bool, optional
+            z_acc and z_gyro are already multiplied by S_a and S_g, e.g. by
+            imu_preprocessing.preprocess_imu. The default is False.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]: (acceleration, omega), both (3,)
+
+        """
+        if out is None:
+            out = (np.empty(3), np.empty(3))
+        acceleration, omega = out
+        
+        #Correct measurement. In this case S_a = S_g = eye(3)
+        if prescaled:
+            acceleration[...] = z_acc
+            omega[...] = z_gyro
+        else:
+            np.matmul(self.S_a, z_acc, out=acceleration)
+            np.matmul(self.S_g, z_gyro, out=omega)
+        
+        #Debiased IMU measurements
+        acceleration -= x_nominal[IDX.acc_bias]
+        omega -= x_nominal[IDX.gyro_bias]
+        
+        return acceleration, omega
     
+    def kinematics(self,
+                   x_nominal: np.ndarray,
+                   acceleration: np.ndarray,
+                   omega: np.ndarray,
+                   out: StepKinematics = None,
+                   debug: bool = None,
+                   ) -> StepKinematics:
+        """Compute the quantities the predict kernels share for one step
+
+        Parameters
+        ----------
+        x_nominal : np.ndarray
+            Nominal state the step is linearized at, (16,).
+        acceleration : np.ndarray
+            Bias corrected acceleration, (3,).
+        omega : np.ndarray
+            Bias corrected rotation rate, (3,).
+        out : StepKinematics, optional
+            Context to write into, e.g. workspace.kinematics. The default is
+            None, which makes a new one.
+        debug : bool, optional
+            Check the rotation matrix. The default is None, which checks it
+            in debug mode.
+
+        Returns
+        -------
+        StepKinematics: The kinematics of the step
+
+        """
+        if out is None:
+            out = StepKinematics()
+        if debug is None:
+            debug = self.debug
+        
+        out.acceleration[...] = acceleration
+        out.omega[...] = omega
+        quaternion_to_rotation_matrix(x_nominal[IDX.att],
+                                      debug=debug,
+                                      out=out.R)
+        _cross_product_matrix(acceleration, out.acceleration_cross)
+        _cross_product_matrix(omega, out.omega_cross)
+        
+        return out
+    
+    @profiled("inject")
     def inject(self,
                x_nominal: np.ndarray,
                delta_x: np.ndarray,
@@ -544,37 +1212,32 @@ class ESKF:
         
         x_injected = x_nominal.copy()
         
-        x_injected[POS_IDX +
-                   VEL_IDX + 
-                   ACC_BIAS_IDX + 
-                   GYRO_BIAS_IDX] = (x_nominal[POS_IDX +
-                                              VEL_IDX + 
-                                              ACC_BIAS_IDX + 
-                                              GYRO_BIAS_IDX]
-                                               +
-                                   delta_x[POS_IDX +
-                                           VEL_IDX +
-                                           ERR_ACC_BIAS_IDX +
-                                           ERR_GYRO_BIAS_IDX]
+        x_injected[IDX.additive] = (x_nominal[IDX.additive]
+                                    +
+                                    delta_x[IDX.err_additive]
                                     )
                                                
         #Inject attitude                                               
-        delta_quat = np.array([1, *delta_x[ERR_ACC_BIAS_IDX]/2])
+        delta_quat = np.array([1, *delta_x[IDX.err_acc_bias]/2])
         
-        x_injected[ATT_IDX] = quaternion_product(x_nominal[ATT_IDX],
+        x_injected[IDX.att] = quaternion_product(x_nominal[IDX.att],
                                                  delta_quat)
         
         #Normalize quaternion
-        x_injected[ATT_IDX] = x_injected[ATT_IDX] / la.norm(x_injected[ATT_IDX])
+        x_injected[IDX.att] = x_injected[IDX.att] / la.norm(x_injected[IDX.att])
     
         #Covariance reset eq 3.20
         # Compensate for injection in the covariances
         
-        G_injected = (
-            la.block_diag(np.eye(6),
-                          np.eye(3) - cross_product_matrix(delta_x[ERR_ATT_IDX]/2),
-                          np.eye(6)))
-        P_injected = G_injected @ P @ G_injected.T
+        # G_injected = block_diag(I, I - S(delta_theta/2), I), only the attitude
+        # block of the workspace identity is rewritten
+        workspace = self.workspace
+        G_injected = workspace.G_injected
+        G_att = G_injected[IDX.err_att_err_att]
+        np.negative(_cross_product_matrix(delta_x[IDX.err_att]/2, workspace.cross), out=G_att)
+        np.einsum('ii->i', G_att)[...] = 1
+        np.matmul(G_injected, P, out=workspace.GP)
+        P_injected = workspace.GP @ G_injected.T
         
         assert x_injected.shape ==(
             16,
@@ -588,6 +1251,7 @@ class ESKF:
     
     
 
+    @profiled("update_GNSS_position")
     def update_GNSS_position(
         self,
         x_nominal: np.ndarray,
@@ -667,6 +1331,7 @@ class ESKF:
             15,
         ), f"ESKF.update_GNSS: P_injected shape incorrect {P_injected.shape}"
 
+        self.validate(x_injected, P_injected, "ESKF.update_GNSS_position")
         return x_injected, P_injected
   
     def batch_pseudorange(self,
@@ -690,56 +1355,40 @@ class ESKF:
         """
         #tic()
         
-        I = np.eye(*P.shape)
-        
         num_beacons = len(b_loc)
-        # num_beacons = 3
-        est_ranges = np.zeros(num_beacons)
-        measured_ranges = np.zeros(num_beacons)
-        delta_P = np.zeros(num_beacons)
+        R = R_beacons[:num_beacons, :num_beacons] #R_GNSS
         
-        pos_est = x_nominal[POS_IDX]  
+        pos_est = x_nominal[IDX.pos]  
         pos_meas = z_GNSS_position
         
-        #ranges/LOS vectors
-        for i in range(num_beacons):
-            est_ranges[i] = np.array(
-                [la.norm(-pos_est + b_loc[i])]
-                )
-            measured_ranges[i] = np.array(
-                [la.norm(-pos_meas + b_loc[i])]
-                )
+        #ranges/LOS vectors for all beacons at once, (num_beacons, 3)
+        los_est = b_loc - pos_est
+        est_ranges = la.norm(los_est, axis=1)
+        measured_ranges = la.norm(b_loc - pos_meas, axis=1)
                         
         #Pseudorange measurement residual
         v = measured_ranges - est_ranges
-        # print("delta_P: ", delta_P)
         
-        #Geometry matrix consisting of normalized LOS-vectors
-        H = np.zeros((num_beacons, 15))
-        for k in range(num_beacons):
-              for j in range(3):
-                  # print(j)
-                  # print("Range for this beacon: ", ranges[k])
-                 
-                  H[k,j] = (b_loc[k,j] - pos_est[j])#/ranges[k]
-              # print("H[k]: ", H[k])
-              H[k] = -(H[k])/est_ranges[k]
+        #Geometry matrix consisting of normalized LOS-vectors. H is zero
+        #outside the position columns, so only H_pos = H[:, :3] is formed
+        H_pos = -los_est / est_ranges[:, None]
 
-        # print(H)
-        S = H @ P @ H.T + R_beacons[:num_beacons, :num_beacons] #R_GNSS
-        # print(S.shape)
+        PH_T = P[:, :3] @ H_pos.T
+        S = H_pos @ PH_T[:3] + R
 
-        
-        W = P @ H.T @ la.inv(S)
-        # print(W,W.shape)
+        # W = P @ H.T @ inv(S), solved through a Cholesky factorization of S
+        W = la.cho_solve(la.cho_factor(S, check_finite=False), PH_T.T,
+                         check_finite=False).T
 
         delta_x = W @ v
         
-        Jo = I - W @ H  # for Joseph form
-        
-        # Update the error covariance
+        # Update the error covariance with the Joseph form
+        #   (I - W H) P (I - W H).T + W R W.T
+        # expanded into low rank terms of WH = W @ H_pos, the nonzero columns of W @ H
+        WH = W @ H_pos
+        PHW_T = P[:, :3] @ WH.T
 
-        P_update = Jo @ P @ Jo.T + W @ R_beacons[:num_beacons, :num_beacons] @ W.T
+        P_update = P - WH @ (P[:3] - PHW_T[:3]) - PHW_T + W @ R @ W.T
 
         return delta_x, P_update
     
@@ -766,30 +1415,38 @@ class ESKF:
         This is done in the functions Update_GNSS_position
         """
         num_beacons = len(b_loc)
-        pos_est = x_nominal[POS_IDX]
+        pos_est = x_nominal[IDX.pos]
         pos_meas = z_GNSS_position
         
-        H = np.zeros((1,15))
         delta_x = np.zeros((15,1))
         R = 1
-        I = np.eye(*P.shape)
         
-        #Geometry matrix consisting of normalized LOS-vectors
+        #Geometry row consisting of the normalized LOS-vector. The row of H is
+        #zero outside the position columns, so only H_pos = H[0, :3] is formed
         for i in range(num_beacons):
-            z_hat_temp = la.norm(pos_est - b_loc[i])
-            H[0,:3] = (pos_est - b_loc[i]).T/z_hat_temp
-            z_hat = la.norm(pos_est - b_loc[i]) + H @ delta_x
+            los = pos_est - b_loc[i]
+            z_hat_temp = la.norm(los)
+            H_pos = los/z_hat_temp
+            z_hat = z_hat_temp + H_pos @ delta_x[:3, 0]
             
             z = la.norm(pos_meas - b_loc[i])
- 
-            W = P @ H.T /(H @ P @ H.T + R)
             
-            delta_x = delta_x + W*(z-z_hat)
+            PH_T = P[:, :3] @ H_pos
+            HP = H_pos @ P[:3]
+            S = H_pos @ PH_T[:3] + R
+            W = PH_T / S
+            
+            delta_x = delta_x + W[:, None]*(z-z_hat)
             
-            Jo = I - W @ H
-            P = Jo @ P @ Jo.T + W * R * W.T
-     
-        P_update = Jo @ P @ Jo.T + W @  W.T * R
+            # Joseph form (I - W H) P (I - W H).T + W R W.T as rank one
+            # updates, with H P H.T + R = S
+            P = P - W[:, None] * (HP - S * W) - PH_T[:, None] * W
+        
+        # The last beacon's Joseph form applied once more to the updated P
+        PH_T = P[:, :3] @ H_pos
+        HP = H_pos @ P[:3]
+        S = H_pos @ PH_T[:3] + R
+        P_update = P - W[:, None] * (HP - S * W) - PH_T[:, None] * W
         
         P_update = (P_update + P_update.T)/2
             
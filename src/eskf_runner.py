@@ -4,10 +4,14 @@ Created on Thu Apr 29 12:39:06 2021
 
 @author: Andreas
 """
+from typing import Tuple
+from contextlib import nullcontext
+from dataclasses import dataclass
+import os
+
 import numpy as np
-from tqdm import trange
+from tqdm import tqdm, trange
 from tqdm import tqdm_notebook
-from timer import * 
 
 from eskf_pseudoranges import (
 # from eskf import (    
@@ -21,10 +25,457 @@ from eskf_pseudoranges import (
     ERR_ACC_BIAS_IDX,
     ERR_GYRO_BIAS_IDX,
 )
+from eskf_batch import BatchESKF
+from eskf_sqrt import SqrtESKF
+from eskf_numba import NumbaESKF, NUMBA_AVAILABLE
+from imu_preprocessing import preprocess_imu
+from preintegration import PreintegratedESKF
+from result_sinks import FullSink
+from checkpoint import ESKFCheckpoint, save_checkpoint, load_checkpoint
+from profiling import span
+
+BACKENDS = ("numpy", "numba", "preintegration")
 
 from IMU import z_acc, z_gyro
 
 
+@dataclass
+class ESKFBlock:
+    """Estimates of the IMU samples start, ..., stop - 1 of a run, from stream_eskf"""
+    start: int
+    stop: int
+    
+    # Nominal state predictions and estimates (n,16)
+    x_pred: np.ndarray
+    x_est: np.ndarray
+    # Error state covariance estimates (n,15,15)
+    P_est: np.ndarray
+    
+    # GNSS epoch of the update at start, None without an update
+    epoch: int
+    # Next GNSS epoch to use after the block
+    GNSSk: int
+
+
+def update_schedule(timeIMU: np.ndarray,
+                    timeGNSS: np.ndarray,
+                    N: int = None,
+                    first_epoch: int = 0,
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+    """IMU sample index of every GNSS update of a run
+
+    A GNSS epoch is used at the first IMU sample at or after its time, with at
+    most one update per sample, so an epoch that shares its sample with an
+    earlier one waits for the next sample.
+
+    Parameters
+    ----------
+    timeIMU : np.ndarray
+        IMU sample times of the run (N,).
+    timeGNSS : np.ndarray
+        GNSS epoch times (M,).
+    N : int, optional
+        Number of IMU samples run, later updates are dropped. The default is
+        None, which is all of timeIMU.
+    first_epoch : int, optional
+        First GNSS epoch to use. The default is 0.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]: (update_samples, update_epochs), the
+        strictly increasing IMU sample of every update and its GNSS epoch
+    """
+    if N is None:
+        N = len(timeIMU)
+    update_epochs = np.arange(first_epoch, len(timeGNSS))
+    update_samples = np.searchsorted(timeIMU, timeGNSS[first_epoch:])
+    
+    # Push epochs sharing a sample to the following samples
+    steps = np.arange(len(update_samples))
+    update_samples = np.maximum.accumulate(update_samples - steps) + steps
+    
+    in_run = update_samples < N
+    return update_samples[in_run], update_epochs[in_run]
+
+
+def _block_starts(update_samples: np.ndarray, N: int, block_size: int) -> np.ndarray:
+    """First sample of every block of a run: the first sample, the update
+    samples and every block_size samples after each of them"""
+    segment_starts = np.union1d([0], update_samples)
+    segment_stops = np.append(segment_starts[1:], N)
+    return np.concatenate([np.arange(start, stop, block_size)
+                           for start, stop in zip(segment_starts, segment_stops)])
+
+
+def _chain_transitions(Ad: np.ndarray, GQGd: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Transition and noise of the steps Ad, GQGd (n,15,15) taken in order,
+    such that Ad_chained @ P @ Ad_chained.T + GQGd_chained is the covariance
+    after the n steps of the per sample recursion
+
+    With Phi_j = Ad_n-1 ... Ad_j+1 the transition from the end of step j,
+    Ad_chained = Phi_0 Ad_0 and GQGd_chained = sum_j Phi_j GQGd_j Phi_j.T.
+    Only the Phi_j are a sequential product, the sum is one stacked product.
+    """
+    n = len(Ad)
+    Phi = np.empty_like(Ad)
+    Phi[n - 1] = np.eye(15)
+    for j in range(n - 2, -1, -1):
+        np.matmul(Phi[j + 1], Ad[j + 1], out=Phi[j])
+    GQGd_chained = np.sum(Phi @ GQGd @ np.swapaxes(Phi, 1, 2), axis=0)
+    return Phi[0] @ Ad[0], GQGd_chained
+
+
+def _predict_segment_intervals(eskf, batch, x_est, P_est, x_pred, P_pred,
+                               z_acc, z_gyro, Ts_IMU, start, stop,
+                               cov_interval, ends_in_update):
+    """ESKF.predict_segment with P propagated every cov_interval samples,
+    and right before the update ending the segment, see run_eskf
+
+    The discrete error matrices of the samples of an interval are computed
+    at once by the BatchESKF batch, each at its own nominal state and IMU
+    input, and chained, so P at the end of an interval is that of the per
+    sample recursion. Every sample is still discretized, only the Python
+    loop over the samples is replaced by stacked products, so the saving is
+    bounded by the nominal prediction, which stays per sample.
+    """
+    N = len(P_est)
+    last = min(stop, N - 1) # The last sample of the arrays is not predicted
+    
+    # Covariance interval bookkeeping
+    cov_start = start
+    accelerations = np.empty((cov_interval, 3))
+    omegas = np.empty((cov_interval, 3))
+    
+    for k in range(start, last):
+        if k > start:
+            x_est[k] = x_pred[k]
+        if k == cov_start and k > start:
+            P_est[k] = P_pred[k]
+        
+        acceleration, omega = eskf.correct_imu(x_est[k],
+                                               z_acc[k],
+                                               z_gyro[k+1],
+                                               prescaled=True)
+        eskf.predict_nominal(x_est[k],
+                             acceleration,
+                             omega,
+                             Ts_IMU[k],
+                             out=x_pred[k+1])
+        
+        j = k - cov_start
+        accelerations[j] = acceleration
+        omegas[j] = omega
+        
+        next_is_update = ends_in_update and k + 1 == stop
+        
+        if j + 1 == cov_interval or next_is_update:
+            steps = slice(cov_start, k + 1)
+            Ad, GQGd = batch.discrete_error_matrices(x_est[steps],
+                                                     accelerations[:j + 1],
+                                                     omegas[:j + 1],
+                                                     Ts_IMU[steps, None, None])
+            P_pred[k+1] = eskf.propagate_covariance(P_est[cov_start],
+                                                    *_chain_transitions(Ad, GQGd))
+            # P is held inside the interval, filled in once per interval
+            P_est[cov_start + 1:k + 1] = P_est[cov_start]
+            P_pred[cov_start + 1:k + 1] = P_est[cov_start]
+            cov_start = k + 1
+    
+    # The interval left open at the end of the segment, if any
+    if last < stop:
+        x_est[last] = x_pred[last]
+    if start < cov_start < stop:
+        P_est[cov_start] = P_pred[cov_start]
+    P_est[cov_start + 1:stop] = P_est[cov_start]
+    P_pred[cov_start + 1:last + 1] = P_est[cov_start]
+
+    eskf.validate_predictions(x_pred, P_pred, start + 1, min(stop, N - 1) + 1)
+
+
+def stream_eskf(N, loaded_data,
+                eskf_parameters,
+                x_pred_init, P_pred_init, p_std,
+                num_beacons,
+                use_batch_pseudoranges,
+                use_iterative_pseudoranges,
+                offset =0.,
+                use_GNSSaccuracy=False, doGNSS=False,
+                debug=False,
+                cov_interval=1,
+                sqrt_covariance=False,
+                covariance_dtype=np.float64,
+                backend="numpy",
+                block_size=1000,
+                checkpoint=None,
+                checkpoint_interval=10.,
+                resume=False,
+                rng=None,
+                validation=None,
+                validation_interval=1):
+    """
+    Description:
+        Runs the error state kalman filter like run_eskf, but yields the
+        estimates block by block instead of returning the full histories.
+        Only the current block is held in memory, so the memory use does not
+        grow with N, and a consumer can reduce, store or plot the blocks as
+        they come.
+
+    Parameters
+    ----------
+    N, loaded_data, eskf_parameters, ... backend, validation,
+    validation_interval : See run_eskf
+    block_size : int, optional
+        Largest number of IMU samples per block. The blocks also start at
+        every GNSS update, so with 1 Hz updates and a 100 Hz IMU the blocks
+        are the 100 samples between updates. Rounded up to a multiple of
+        cov_interval. The default is 1000.
+    checkpoint : str, optional
+        Checkpoint file, see checkpoint.py. The filter state is written to
+        it between two blocks, after the consumer has handled the first
+        one, every checkpoint_interval seconds of data. The default is None.
+    checkpoint_interval : float, optional
+        Seconds of IMU data between checkpoints. The default is 10.
+    resume : bool, optional
+        Continue from the checkpoint file, if it exists, instead of the
+        first sample. The other arguments must be those of the run that
+        wrote it. The default is False.
+    rng : np.random.Generator, optional
+        Random generator of the caller, whose state is checkpointed and
+        restored with the filter. The default is None.
+
+    Yields
+    ------
+    ESKFBlock: The samples start, ..., stop - 1, in order. The arrays are
+        views into buffers that are overwritten by the next block, copy
+        what should be kept.
+
+    """
+    
+    assert backend in BACKENDS, (
+        f"stream_eskf: unknown backend {backend}, expected one of {BACKENDS}")
+    if backend == "numba" and not NUMBA_AVAILABLE:
+        print("stream_eskf: numba is not installed, using the numpy backend")
+        backend = "numpy"
+    assert backend == "numpy" or not (sqrt_covariance or cov_interval > 1), (
+        f"stream_eskf: the {backend} backend runs the full covariance at every sample")
+    
+    # %% Read loaded data
+    if "x_true" in loaded_data:
+        x_true = loaded_data["x_true"].T
+    else:
+        x_true = None
+    z_acc = loaded_data["z_acc"].T
+    z_gyro = loaded_data["z_gyro"].T
+    z_GNSS = loaded_data["z_GNSS"].T
+#    acc_t = loaded_data["acc_t"].T
+    
+    if use_GNSSaccuracy:
+        GNSSaccuracy = loaded_data['GNSSaccuracy'].T
+    else:
+        GNSSaccuracy = None
+    
+    # S_a: np.ndarray = np.eye(3)
+    # S_g: np.ndarray = np.eye(3)
+    
+    S_a = loaded_data["S_a"]
+    S_g = loaded_data["S_g"]
+    
+    # %% Beacon stuff
+    # The matrix has 15 beacons implemented
+    beacon_location: np.ndarray = loaded_data["beacon_location"]
+    #To select x amount of beacons, use beacon_location = beacon_location[:x], x =[0,15]
+    beacon_location = beacon_location[:num_beacons]
+    R_beacons = np.zeros((num_beacons,num_beacons))
+    np.fill_diagonal(R_beacons, p_std**2)
+    # np.fill_diagonal(R_beacons,np.array([1,1,1])**2)
+    
+    # %% 
+    lever_arm = loaded_data["leverarm"].ravel()
+    
+    timeGNSS = loaded_data["timeGNSS"].ravel()
+    timeIMU = loaded_data["timeIMU"].ravel()
+    
+    # %% Initialize the block buffers, one row more than the longest block
+    # for the prediction of the first sample of the next block
+    block_size = int(np.ceil(block_size / cov_interval)) * cov_interval
+    rows = min(block_size, N) + 1
+    x_pred: np.ndarray = np.zeros((rows, 16))
+    x_pred[0] = x_pred_init
+
+    #In the square-root mode P_pred and P_est hold Cholesky factors in the loop
+    if not sqrt_covariance:
+        covariance_dtype = np.float64
+    P_pred = np.zeros((rows, 15, 15), dtype=covariance_dtype)
+    
+        #Initialize the kalman filter
+    if sqrt_covariance:
+        eskf = SqrtESKF(
+            *eskf_parameters,
+            S_a=S_a,  # set the accelerometer correction matrix
+            S_g=S_g,  # set the gyro correction matrix,
+            debug=debug,
+            validation=validation,
+            validation_interval=validation_interval,
+            dtype=covariance_dtype
+        )
+        P_pred[0] = SqrtESKF.factor(P_pred_init, covariance_dtype)
+    else:
+        eskf_class = {"numpy": ESKF,
+                      "numba": NumbaESKF,
+                      "preintegration": PreintegratedESKF}[backend]
+        eskf = eskf_class(
+            *eskf_parameters,
+            S_a=S_a,  # set the accelerometer correction matrix
+            S_g=S_g,  # set the gyro correction matrix,
+            debug=debug,
+            validation=validation,
+            validation_interval=validation_interval
+        )
+        P_pred[0] = P_pred_init
+    if cov_interval > 1:
+        # Discretizes the samples of a covariance interval at once
+        batch = BatchESKF(*eskf_parameters,
+                          S_a=S_a,
+                          S_g=S_g,
+                          debug=False,
+                          discretization=eskf.discretization,
+                          discretization_order=eskf.discretization_order)
+    R_GNSS = np.diag(p_std ** 2)
+    
+    x_est: np.ndarray  = np.zeros((rows, 16))
+    P_est = np.zeros((rows, 15, 15), dtype=covariance_dtype)
+    if sqrt_covariance:
+        P_covariance = np.zeros((rows, 15, 15))
+  
+     # keep track of current step in GNSS measurements
+    offset += timeIMU[0]
+    GNSSk_init = np.searchsorted(timeGNSS, offset)
+    offset_idx = np.searchsorted(timeIMU, offset)
+    
+    # Scale the IMU samples and compute the sampling times for the whole log
+    # in one pass, into contiguous arrays. The loop only removes the biases
+    imu = preprocess_imu(timeIMU, z_acc, z_gyro, S_a, S_g, start=offset_idx)
+    timeIMU = imu.time
+    z_acc = imu.acceleration
+    z_gyro = imu.rate
+    Ts_IMU = imu.Ts
+    
+    # %% Event schedule
+    # The IMU sample of every GNSS update. The data is run as blocks of pure
+    # prediction, each starting at an update, the first sample or every
+    # block_size samples without updates
+    if doGNSS:
+        update_samples, update_epochs = update_schedule(timeIMU, timeGNSS, N,
+                                                        first_epoch=GNSSk_init)
+    else:
+        update_samples = update_epochs = np.array([], dtype=int)
+    block_starts = _block_starts(update_samples, N, block_size)
+    block_stops = np.append(block_starts[1:], N)
+    num_updates = 0
+    GNSSk = GNSSk_init
+    
+    # %% Resume from a checkpoint
+    if resume and checkpoint is not None and os.path.exists(checkpoint):
+        state = load_checkpoint(checkpoint)
+        assert state.sample in block_starts and np.isclose(timeIMU[state.sample], state.time), (
+            f"stream_eskf: checkpoint {checkpoint} does not match this run")
+        x_pred[0] = state.x_pred
+        P_pred[0] = state.P_pred
+        GNSSk = state.GNSSk
+        num_updates = np.searchsorted(update_samples, state.sample)
+        block_stops = block_stops[block_starts >= state.sample]
+        block_starts = block_starts[block_starts >= state.sample]
+        if rng is not None:
+            rng.bit_generator.state = state.rng_state
+    checkpoint_time = timeIMU[block_starts[0]] if len(block_starts) else 0.
+
+    # %% 
+    with tqdm(total=N, initial=block_starts[0] if len(block_starts) else N) as progress:
+        for start, stop in zip(block_starts, block_stops):
+            epoch = None
+            if num_updates < len(update_samples) and update_samples[num_updates] == start:
+                epoch = update_epochs[num_updates]
+                if use_GNSSaccuracy:
+                    R_GNSS_scaled = R_GNSS * GNSSaccuracy[epoch]
+                else:
+                    R_GNSS_scaled = R_GNSS
+
+
+                # %% Test if range and LOS_matrix works
+                
+                x_est[0], P_est[0] = eskf.update_GNSS_position(x_pred[0],
+                                                               P_pred[0],
+                                                               z_GNSS[epoch],
+                                                               R_GNSS_scaled,
+                                                               R_beacons,
+                                                               beacon_location,
+                                                               use_batch_pseudoranges,
+                                                               use_iterative_pseudoranges,
+                                                               lever_arm
+                                                               )
+
+                #Ranges
+                assert np.all(np.isfinite(P_est[0])
+                              ), f"Not finite P_pred at index {start}"
+
+                num_updates += 1
+                GNSSk = epoch + 1
+            else:
+                # No updates, est = pred
+                x_est[0] = x_pred[0]
+                P_est[0] = P_pred[0]
+
+            # Row n predicts the first sample of the next block, the last
+            # sample of the run is not predicted
+            n = stop - start
+            block_rows = n + 1 if stop < N else n
+            block = slice(start, start + block_rows)
+            with span("predict_segment"):
+                if cov_interval == 1:
+                    eskf.predict_segment(x_est[:block_rows], P_est[:block_rows],
+                                         x_pred[:block_rows], P_pred[:block_rows],
+                                         z_acc[block], z_gyro[block], Ts_IMU[block],
+                                         0, n, prescaled=True)
+                else:
+                    # A covariance interval always ends at the end of a block
+                    ends_in_update = (num_updates < len(update_samples)
+                                      and update_samples[num_updates] == stop)
+                    _predict_segment_intervals(eskf, batch,
+                                               x_est[:block_rows], P_est[:block_rows],
+                                               x_pred[:block_rows], P_pred[:block_rows],
+                                               z_acc[block], z_gyro[block], Ts_IMU[block],
+                                               0, n, cov_interval, ends_in_update)
+
+            if sqrt_covariance:
+                L = P_est[:n].astype(np.float64)
+                P_block = np.matmul(L, np.swapaxes(L, 1, 2), out=P_covariance[:n])
+            else:
+                P_block = P_est[:n]
+            yield ESKFBlock(start=start,
+                            stop=stop,
+                            x_pred=x_pred[:n],
+                            x_est=x_est[:n],
+                            P_est=P_block,
+                            epoch=epoch,
+                            GNSSk=GNSSk)
+            progress.update(n)
+
+            x_pred[0] = x_pred[n]
+            P_pred[0] = P_pred[n]
+            
+            if (checkpoint is not None and stop < N
+                    and timeIMU[stop] - checkpoint_time >= checkpoint_interval):
+                checkpoint_time = timeIMU[stop]
+                save_checkpoint(checkpoint,
+                                ESKFCheckpoint(sample=stop,
+                                               time=timeIMU[stop],
+                                               GNSSk=GNSSk,
+                                               x_pred=x_pred[0],
+                                               P_pred=P_pred[0],
+                                               rng_state=None if rng is None
+                                               else rng.bit_generator.state))
+
+
 def run_eskf(N, loaded_data,
               eskf_parameters,
               x_pred_init, P_pred_init, p_std,
@@ -33,7 +484,18 @@ def run_eskf(N, loaded_data,
               use_iterative_pseudoranges,
               offset =0.,
               use_GNSSaccuracy=False, doGNSS=False,
-              debug=False ):
+              debug=False,
+              cov_interval=1,
+              sqrt_covariance=False,
+              covariance_dtype=np.float64,
+              backend="numpy",
+              sink=None,
+              checkpoint=None,
+              checkpoint_interval=10.,
+              resume=False,
+              profiler=None,
+              validation=None,
+              validation_interval=1):
     
 # def run_eskf(eskf_parameters, x_pred_init, P_pred_init_list, loaded_data,
 #              p_std, N, use_GNSSaccuracy=False, doGNSS=True,
@@ -58,42 +520,162 @@ def run_eskf(N, loaded_data,
         DESCRIPTION. The default is False.
     offset : TYPE, optional
         DESCRIPTION. The default is 0..
+    cov_interval : int, optional
+        Number of IMU samples between each covariance propagation. The
+        nominal state is still predicted at every sample, while P is
+        propagated once per interval and always right before an update
+        epoch, with the transition matrices of its samples chained, so the
+        propagated P is that of the per sample recursion, up to round-off.
+        Between propagations P_est holds the last propagated covariance,
+        so this is mainly a lower covariance reporting rate. Every sample
+        is still discretized, in one stacked call per interval, so the
+        run time drops moderately: on a 60 s, 100 Hz log a run takes
+        about 0.75 of the per sample run time with an interval of 10, and
+        0.6 with 100, where the nominal prediction dominates.
+        The default is 1, which propagates P at every sample.
+    sqrt_covariance : bool, optional
+        Run the SqrtESKF, which carries the Cholesky factor of P through
+        the loop instead of P. The returned P_est is converted back to
+        covariances. The default is False.
+    covariance_dtype : optional
+        dtype of the covariance factor in the square-root mode, e.g.
+        np.float32. The default is np.float64.
+    backend : str, optional
+        "numpy" or "numba". The numba backend runs the IMU samples between
+        GNSS epochs, the pseudorange updates and the injection in compiled
+        kernels (NumbaESKF), with the taylor discretization. Falls back to
+        "numpy" when numba is not installed. The "preintegration" backend
+        predicts the IMU samples between GNSS epochs in one call from the
+        preintegrated increments (PreintegratedESKF), which matches the
+        "numpy" results to round-off. The default is "numpy".
+    sink : optional
+        Result sink the blocks of the run are written to, see
+        result_sinks.py, e.g. DiagonalSink() to keep only the variances or
+        MemmapSink(directory) to stream the histories to disk. The default
+        is None, which keeps the full histories in memory (FullSink).
+    checkpoint, checkpoint_interval, resume : optional
+        Checkpoint the run to a file and continue it from there, see
+        stream_eskf. A resumed run only writes the samples from the
+        checkpoint on, so keep the earlier ones in a sink that survives the
+        crash, e.g. MemmapSink(directory, resume=True).
+    profiler : Profiler, optional
+        Records the time of the filter stages and of the run into this
+        profiler, see profiling.py. The default is None, which records
+        nothing unless a Profiler is active already.
+    validation : str, optional
+        Numeric health checks of the filter, "off", "cheap" or "full", see
+        VALIDATION_LEVELS in eskf_pseudoranges.py. The default is None,
+        which is "full" with debug and "off" without.
+    validation_interval : int, optional
+        Check every validation_interval-th predicted step, the updates are
+        always checked. E.g. "cheap" every 100th step keeps monitoring long
+        runs at a small cost. The default is 1.
 
     Returns
     -------
-    result : List of returns from ESKF
+    result : (x_pred, x_est, P_est, GNSSk)
+        x_pred, x_est and P_est as stored by the sink, the full histories
+        (N,16), (N,16) and (N,15,15) by default
 
     """
+    if sink is None:
+        sink = FullSink()
+    sink.open(N)
+    
+    with profiler if profiler is not None else nullcontext(), span("run_eskf"):
+        for block in stream_eskf(N, loaded_data,
+                                 eskf_parameters,
+                                 x_pred_init, P_pred_init, p_std,
+                                 num_beacons,
+                                 use_batch_pseudoranges,
+                                 use_iterative_pseudoranges,
+                                 offset=offset,
+                                 use_GNSSaccuracy=use_GNSSaccuracy, doGNSS=doGNSS,
+                                 debug=debug,
+                                 cov_interval=cov_interval,
+                                 sqrt_covariance=sqrt_covariance,
+                                 covariance_dtype=covariance_dtype,
+                                 backend=backend,
+                                 checkpoint=checkpoint,
+                                 checkpoint_interval=checkpoint_interval,
+                                 resume=resume,
+                                 validation=validation,
+                                 validation_interval=validation_interval):
+            with span("sink"):
+                sink.write(block)
+            GNSSk = block.GNSSk
+    x_pred, x_est, P_est = sink.result()
+
+    result = (
+              x_pred,
+              x_est,
+              P_est,
+              GNSSk,     
+              )
+
+
+    return result
+
+def run_eskf_batch(N, loaded_data,
+                   eskf_parameters,
+                   x_pred_init, P_pred_init, p_std,
+                   num_beacons,
+                   use_batch_pseudoranges,
+                   use_iterative_pseudoranges,
+                   num_runs=None,
+                   offset =0.,
+                   use_GNSSaccuracy=False, doGNSS=False,
+                   debug=False,
+                   discretization="taylor"):
+    """
+    Description:
+        Runs num_runs error state kalman filters side by side on the same
+        data with BatchESKF, e.g. for Monte Carlo runs over the initialization
+
+    Parameters
+    ----------
+    N :  Number of steps to run
+    loaded_data : Loaded data matrix
+    eskf_parameters : 
+    x_pred_init : State prediction initialization, (16,) shared or (M,16) per run
+    P_pred_init : Covariance initialization, (15,15) shared or (M,15,15) per run
+    num_runs : int, optional
+        Number of filters M. Defaults to the length of a stacked x_pred_init
+    use_GNSSaccuracy, doGNSS, debug, offset : See run_eskf
+    discretization : str, optional
+        ESKF.discretization of the filters. Defaults to "taylor", since
+        scipy's expm on a (M,30,30) stack costs about 3x the series
+
+    Returns
+    -------
+    result : (x_est (N,M,16), P_est_diag (N,M,15), GNSSk)
+        Only the covariance diagonals are kept, since the full (N,M,15,15)
+        history does not fit in memory for long Monte Carlo runs
+
+    """
+    x_pred_init = np.asarray(x_pred_init, dtype=float)
+    P_pred_init = np.asarray(P_pred_init, dtype=float)
+    if num_runs is None:
+        num_runs = len(x_pred_init) if x_pred_init.ndim == 2 else 1
     
     # %% Read loaded data
-    if "x_true" in loaded_data:
-        x_true = loaded_data["x_true"].T
-    else:
-        x_true = None
     z_acc = loaded_data["z_acc"].T
     z_gyro = loaded_data["z_gyro"].T
     z_GNSS = loaded_data["z_GNSS"].T
-#    acc_t = loaded_data["acc_t"].T
     
     if use_GNSSaccuracy:
         GNSSaccuracy = loaded_data['GNSSaccuracy'].T
     else:
         GNSSaccuracy = None
     
-    # S_a: np.ndarray = np.eye(3)
-    # S_g: np.ndarray = np.eye(3)
-    
     S_a = loaded_data["S_a"]
     S_g = loaded_data["S_g"]
     
     # %% Beacon stuff
-    # The matrix has 15 beacons implemented
     beacon_location: np.ndarray = loaded_data["beacon_location"]
-    #To select x amount of beacons, use beacon_location = beacon_location[:x], x =[0,15]
     beacon_location = beacon_location[:num_beacons]
     R_beacons = np.zeros((num_beacons,num_beacons))
     np.fill_diagonal(R_beacons, p_std**2)
-    # np.fill_diagonal(R_beacons,np.array([1,1,1])**2)
     
     # %% 
     lever_arm = loaded_data["leverarm"].ravel()
@@ -102,91 +684,78 @@ def run_eskf(N, loaded_data,
     timeIMU = loaded_data["timeIMU"].ravel()
     Ts_IMU = [0, *np.diff(timeIMU)]
     
-    steps = len(z_acc)
-    gnss_steps = len(z_GNSS)
-        
-    # %% Initialize state predictions, estimates and NEES   
-    x_pred: np.ndarray = np.zeros((steps, 16))
-    x_pred[0] = x_pred_init
-
-    P_pred = np.zeros((N, 15, 15))
-    P_pred[0] = P_pred_init
+    # %% Initialize the stacked filters
+    x_pred = np.broadcast_to(x_pred_init, (num_runs, 16)).copy()
+    P_pred = np.broadcast_to(P_pred_init, (num_runs, 15, 15)).copy()
     
-        #Initialize the kalman filter
-    eskf = ESKF(
+    eskf = BatchESKF(
         *eskf_parameters,
         S_a=S_a,  # set the accelerometer correction matrix
         S_g=S_g,  # set the gyro correction matrix,
-        debug=debug
+        debug=debug,
+        discretization=discretization
     )
     R_GNSS = np.diag(p_std ** 2)
     
-    x_est: np.ndarray  = np.zeros((N, 16))
-    P_est = np.zeros((N, 15, 15))
-  
-     # keep track of current step in GNSS measurements
+    x_est: np.ndarray = np.zeros((N, num_runs, 16))
+    P_est_diag = np.zeros((N, num_runs, 15))
+    
     offset += timeIMU[0]
     GNSSk_init = np.searchsorted(timeGNSS, offset)
-    GNSSk = GNSSk_init
     offset_idx = np.searchsorted(timeIMU, offset)
     timeIMU = timeIMU[offset_idx:]
     z_acc = z_acc[offset_idx:]
     z_gyro = z_gyro[offset_idx:]
     Ts_IMU = Ts_IMU[offset_idx:]
-    k = 0
-
-
+    
+    if doGNSS:
+        update_samples, update_epochs = update_schedule(timeIMU, timeGNSS, N,
+                                                        first_epoch=GNSSk_init)
+    else:
+        update_samples = update_epochs = np.array([], dtype=int)
+    num_updates = 0
+    
     # %% 
-    # print("Starting timer")
-    # tic()
     for k in trange(N):
-        if doGNSS and timeIMU[k] >= timeGNSS[GNSSk]:
+        if num_updates < len(update_samples) and update_samples[num_updates] == k:
+            GNSSk = update_epochs[num_updates]
             if use_GNSSaccuracy:
                 R_GNSS_scaled = R_GNSS * GNSSaccuracy[GNSSk]
             else:
                 R_GNSS_scaled = R_GNSS
-
-
-            # %% Test if range and LOS_matrix works
             
-            x_est[k], P_est[k] = eskf.update_GNSS_position(x_pred[k],
-                                                           P_pred[k],
-                                                           z_GNSS[GNSSk],
-                                                           R_GNSS_scaled,
-                                                           R_beacons,
-                                                           beacon_location,
-                                                           use_batch_pseudoranges,
-                                                           use_iterative_pseudoranges,
-                                                           lever_arm
-                                                           )
-
-            #Ranges
-            assert np.all(np.isfinite(P_est[k])
+            x_pred, P_pred = eskf.update_GNSS_position(x_pred,
+                                                       P_pred,
+                                                       z_GNSS[GNSSk],
+                                                       R_GNSS_scaled,
+                                                       R_beacons,
+                                                       beacon_location,
+                                                       use_batch_pseudoranges,
+                                                       use_iterative_pseudoranges,
+                                                       lever_arm
+                                                       )
+            assert np.all(np.isfinite(P_pred)
                           ), f"Not finite P_pred at index {k}"
-
-            GNSSk += 1
-        else:
-            # No updates, est = pred
-            x_est[k] = x_pred[k]
-            P_est[k] = P_pred[k]
-
             
+            num_updates += 1
+        
+        # No updates, est = pred
+        x_est[k] = x_pred
+        P_est_diag[k] = np.diagonal(P_pred, axis1=-2, axis2=-1)
+        
         if k < N - 1:
-            x_pred[k+1], P_pred[k+1] = eskf.predict(
-                                            x_est[k],
-                                            P_est[k],
-                                            # acc_t[k],
-                                            z_acc[k], #Denne er k pga måten dataen er laget på (?)
-                                            z_gyro[k+1],
-                                            Ts_IMU[k]
-                                             )
-
+            x_pred, P_pred = eskf.predict(x_pred,
+                                          P_pred,
+                                          z_acc[k],
+                                          z_gyro[k+1],
+                                          Ts_IMU[k]
+                                          )
+    GNSSk = GNSSk_init + num_updates
+    
     result = (
-              x_pred,
               x_est,
-              P_est,
-              GNSSk,     
+              P_est_diag,
+              GNSSk,
               )
-
-
-    return result
\ No newline at end of file
+    
+    return result
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Square-root error state kalman filter.
+
+SqrtESKF carries a lower triangular Cholesky factor L of the error state
+covariance, P = L @ L.T, instead of P itself. Prediction, update and injection
+are done with orthogonal (QR) transformations of the factor, so the implied
+covariance stays symmetric and positive semi-definite by construction, without
+the Joseph form or explicit symmetrization, and the factor can be kept in
+float32.
+"""
+from typing import Tuple
+from dataclasses import dataclass
+
+import numpy as np
+import scipy.linalg as la
+
+from eskf_pseudoranges import (
+    ESKF,
+    IDX,
+    StepKinematics,
+)
+from profiling import profiled
+from quaternion import cross_product_matrices
+
+
+# %% Factor helpers
+def tria(A: np.ndarray) -> np.ndarray:
+    """Lower triangular T with T @ T.T == A @ A.T, from a QR factorization of A.T
+
+    Parameters
+    ----------
+    A : np.ndarray
+        Matrix of shape (n, k), k >= n.
+
+    Returns
+    -------
+    T : np.ndarray
+        Lower triangular factor (n, n), in the dtype of A.
+    """
+    R = np.linalg.qr(A.T, mode='r')
+    return R[:A.shape[0], :].T
+
+
+def psd_sqrt(M: np.ndarray) -> np.ndarray:
+    """Square root factor F with F @ F.T == M of a positive semi-definite matrix
+
+    Uses the Cholesky factor when M is numerically positive definite, and falls
+    back to a clipped eigen decomposition otherwise.
+    """
+    try:
+        return la.cholesky(M, lower=True, check_finite=False)
+    except la.LinAlgError:
+        eigenvalues, eigenvectors = la.eigh(M, check_finite=False)
+        return eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+
+
+# %% Filter
+@dataclass
+class SqrtESKF(ESKF):
+    """ESKF where every P argument and return value is the Cholesky factor L of P
+
+    The nominal state and the public methods are the same as for ESKF, so
+    SqrtESKF can be used in place of ESKF as long as the caller passes and
+    stores factors. Use covariance(L) to get P back.
+    """
+    # dtype of the covariance factor, e.g. np.float32 to halve memory traffic
+    dtype: type = np.float64
+
+    @staticmethod
+    def factor(P: np.ndarray, dtype: type = np.float64) -> np.ndarray:
+        """Lower triangular Cholesky factor of a covariance matrix (15,15)"""
+        return la.cholesky(P, lower=True).astype(dtype)
+
+    @staticmethod
+    def covariance(L: np.ndarray) -> np.ndarray:
+        """Covariance matrix L @ L.T in float64 of a factor (15,15)"""
+        L = L.astype(np.float64)
+        return L @ L.T
+
+    def validate_covariance(self, L: np.ndarray, where: str) -> None:
+        """ESKF.validate_covariance of factors, (15,15) or (M,15,15), whose
+        covariances are symmetric by construction"""
+        assert np.all(np.isfinite(L)), f"{where}: covariance factor not finite"
+        variances = np.sum(L.astype(np.float64) ** 2, axis=-1)
+        assert np.all(variances >= self.min_variance), (
+            f"{where}: variance {variances.min()} below min_variance {self.min_variance}")
+
+    @profiled("predict_covariance")
+    def predict_covariance(
+            self,
+            x_nominal: np.ndarray,
+            P: np.ndarray,
+            acceleration: np.ndarray,
+            omega: np.ndarray,
+            Ts: float,
+            out: np.ndarray = None,
+            kinematics: StepKinematics = None,
+            ) -> np.ndarray:
+        """Predict the covariance factor Ts time units ahead
+
+        L_predicted = tria([Ad @ L, sqrt(GQGd)])
+
+        Args:
+            x_nominal: nominal state (16,)
+            P: Cholesky factor L of the error state covariance (15,15)
+            acceleration: Estimated acceleration for prediction interval (3,)
+            omega: Estimated rotation rate for prediction interval (3,)
+            Ts: Sampling time
+            out: Optional array (15,15) to write the factor into
+            kinematics: Optional kinematics of this step from ESKF.kinematics
+        Returns:
+            The predicted covariance factor (15,15)
+        """
+        assert P.shape ==(
+            15,
+            15,
+            ), f"SqrtESKF.predict_covariance: P shape incorrect {P.shape}"
+
+        Ad, GQGd = self.discrete_error_matrices(x_nominal,
+                                                acceleration,
+                                                omega,
+                                                Ts,
+                                                out=(self.workspace.Ad,
+                                                     self.workspace.GQGd),
+                                                kinematics=kinematics)
+
+        pre_array = np.hstack((Ad.astype(self.dtype) @ P,
+                               psd_sqrt(GQGd).astype(self.dtype)))
+        if out is None:
+            return tria(pre_array)
+        out[...] = tria(pre_array)
+        return out
+
+    def propagate_covariance(self,
+                             P: np.ndarray,
+                             Ad: np.ndarray,
+                             GQGd: np.ndarray,
+                             ) -> np.ndarray:
+        """Covariance factor tria([Ad @ L, sqrt(GQGd)]), see
+        ESKF.propagate_covariance, with P the Cholesky factor L"""
+        return tria(np.hstack((Ad.astype(self.dtype) @ P,
+                               psd_sqrt(GQGd).astype(self.dtype))))
+
+    @profiled("inject")
+    def inject(self,
+               x_nominal: np.ndarray,
+               delta_x: np.ndarray,
+               P: np.ndarray,
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """Inject the error state and reset the covariance factor
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]: (x_injected (16,), L_injected (15,15))
+        """
+        if delta_x.shape != (15,):
+            delta_x = np.reshape(delta_x, ((15,)))
+
+        #The nominal state injection is the same as for the full covariance
+        x_injected, _ = super().inject(x_nominal, delta_x, np.eye(15))
+
+        #Covariance reset eq 3.20, G_injected only differs from I in the attitude rows
+        G_att = np.eye(3) - cross_product_matrices(delta_x[IDX.err_att]/2)
+        GL = P.copy()
+        GL[6:9] = G_att.astype(self.dtype) @ P[6:9]
+
+        return x_injected, tria(GL)
+
+    def batch_pseudorange(self,
+                          x_nominal: np.ndarray,
+                          z_GNSS_position: np.ndarray,
+                          P: np.ndarray,
+                          R_GNSS: np.ndarray,
+                          b_loc: np.ndarray,
+                          R_beacons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Pseudorange update of all beacons at once in square-root form
+
+        With the lower triangular factorization
+
+            tria([[sqrt(R), H L],     [[sqrt(S), 0 ],
+                  [0,       L  ]]) =   [K,       L+]]
+
+        the gain is W = K @ inv(sqrt(S)) and L+ is the updated factor.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]: (delta_x (15,), L_update (15,15))
+        """
+        num_beacons = len(b_loc)
+        R = R_beacons[:num_beacons, :num_beacons]
+
+        pos_est = x_nominal[IDX.pos]
+        los_est = b_loc - pos_est
+        est_ranges = la.norm(los_est, axis=1)
+        measured_ranges = la.norm(b_loc - z_GNSS_position, axis=1)
+        v = measured_ranges - est_ranges
+
+        #Position columns of the geometry matrix, the rest of H is zero
+        H_pos = -los_est / est_ranges[:, None]
+
+        pre_array = np.zeros((num_beacons + 15, num_beacons + 15), dtype=self.dtype)
+        pre_array[:num_beacons, :num_beacons] = psd_sqrt(R)
+        pre_array[:num_beacons, num_beacons:] = H_pos.astype(self.dtype) @ P[:3]
+        pre_array[num_beacons:, num_beacons:] = P
+
+        post_array = tria(pre_array)
+        sqrt_S = post_array[:num_beacons, :num_beacons].astype(np.float64)
+        K = post_array[num_beacons:, :num_beacons].astype(np.float64)
+
+        #W = K @ inv(sqrt_S), sqrt_S lower triangular
+        W = la.solve_triangular(sqrt_S, K.T, lower=True, trans='T').T
+
+        delta_x = W @ v
+        L_update = post_array[num_beacons:, num_beacons:]
+
+        return delta_x, L_update
+
+    def iterative_pseudorange(self,
+                              x_nominal: np.ndarray,
+                              z_GNSS_position: np.ndarray,
+                              P: np.ndarray,
+                              R_GNSS: np.ndarray,
+                              b_loc: np.ndarray,
+                              R_beacons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Sequential pseudorange update, one beacon at a time, in square-root form
+
+        Uses the same unit measurement variance and final step as
+        ESKF.iterative_pseudorange.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]: (delta_x (15,), L_update (15,15))
+        """
+        num_beacons = len(b_loc)
+        pos_est = x_nominal[IDX.pos]
+        pos_meas = z_GNSS_position
+
+        delta_x = np.zeros(15)
+        R = 1
+
+        pre_array = np.zeros((16, 16), dtype=self.dtype)
+        for i in range(num_beacons):
+            los = pos_est - b_loc[i]
+            z_hat_temp = la.norm(los)
+            H_pos = los/z_hat_temp
+            z_hat = z_hat_temp + H_pos @ delta_x[:3]
+
+            z = la.norm(pos_meas - b_loc[i])
+
+            pre_array[0, 0] = np.sqrt(R)
+            pre_array[0, 1:] = H_pos.astype(self.dtype) @ P[:3]
+            pre_array[1:, 0] = 0
+            pre_array[1:, 1:] = P
+
+            post_array = tria(pre_array)
+            W = post_array[1:, 0].astype(np.float64) / float(post_array[0, 0])
+
+            delta_x = delta_x + W*(z-z_hat)
+            P = post_array[1:, 1:]
+
+        # The last beacon's Joseph form applied once more to the updated factor,
+        # tria([(I - W H) L, W sqrt(R)])
+        JoL = P - (np.outer(W, H_pos) @ P[:3]).astype(self.dtype)
+        L_update = tria(np.hstack((JoL, (np.sqrt(R) * W)[:, None].astype(self.dtype))))
+
+        return delta_x, L_update
@@ -7,7 +7,6 @@ Created on Thu Apr 29 10:27:21 2021
 
 import numpy as np
 import scipy.io
-from tqdm import trange
 
 import os, sys
 currentdir = os.path.dirname(os.path.realpath(__file__)) #test
@@ -15,8 +14,8 @@ parentdir = os.path.dirname(currentdir)  #src
 sys.path.append(parentdir)
 
 from cat_slice import CatSlice
-from IMU import z_acc, z_gyro
-from quaternion import transf_mat, euler_to_quaternion
+from IMU import z_acc_batch, z_gyro_batch
+from quaternion import euler_to_quaternions, integrate_euler_rates
 
 POS_IDX = CatSlice(start=0, stop=3)
 VEL_IDX = CatSlice(start=3, stop=6)
@@ -61,239 +60,114 @@ r = 10
 omega = 1/10
 z_ampl = 1
 
-# %% Attitude
-euler_angles: np.ndarray = np.zeros(3)
-eul_att: np.ndarray = np.zeros((N+1,3))
-quat_t: np.ndarray = np.zeros((N,4))
-x_true[0,ATT_IDX] = np.array([1,0,0,0])
-
-rollVelTrue = np.zeros((N+1, 3)) #rad/s
-
-z_acc_vector: np.ndarray = np.zeros((N+1,3))#m/s^2
-z_acc_vector[0] = np.array([0  , 0.   , 0])
-
-z_gyro_vector: np.ndarray = np.zeros((N, 3))
-z_gyro_vector[0,:] = np.array([0,0,0]) #rad/s
-
-# %% Biases
-a_bt = np.zeros(3)
-# a_bt = np.array([1,1,1,])
-omega_bt = np.zeros(3)
-# 
-# %% Noises
-
-a_n: np.ndarray = np.zeros(3)
-omega_n = np.zeros(3)
-
 g_t: np.ndarray = np.array([0, 0, 9.82 ])
 
-# %% NED Acceleration: v_dot = a
+# Initial velocity and position of the prediction test
+vel_pred_init = np.array([0, 2.0, 0])
+pos_pred_init = np.array([10,0,1])
+tmc = 20 #time for maneuver change
+
+# %% Biases and noises
+acc_bias_nominal = np.array([-0.00875, -0.00875, 0.00690])
+gyro_bias_nominal = np.array([-9.5e-4, -7.3e-4, 3.7e-4])
+# Accelerometer bias is typically measured in milli-g's (m/s^2). The biases
+# are redrawn around the nominal values every sample but the first
+acc_bias_std = 0.004
+gyro_bias_std = 0.00005
+acc_noise_std = 0.001
+gyro_noise_std = 0.00004
 
-acc_t: np.ndarray = np.zeros((N,3))
-# acc_t = acc_t.astype('float32')
+seed = None # Set for reproducible data
+rng = np.random.default_rng(seed)
 
 # %%  GNSS measurements
+print("Generating GNSS-ranges without noise")
 z_GNSS = np.zeros((M,3))
-# %% Kalman prediction testing
-vel_pred_test = np.zeros((N+1,3))
-pos_pred_test = np.zeros((N+1,3))
-
-vel_pred_test[0] = np.array([0, 2.0, 0])
-pos_pred_test[0] = np.array([10,0,1])
-t = 0
-rot_t = 0
-tmc = 20 #time for maneuver change
-
-# %% 
-# x_true[:,ACC_BIAS_IDX] = temp[:,ACC_BIAS_IDX]
-# x_true[:,GYRO_BIAS_IDX] = temp[:,GYRO_BIAS_IDX]
+# Move east for the first 20 seconds (no noise)
+early = timeGNSS <= tmc
+z_GNSS[early, 0] = 10
+z_GNSS[early, 1] = 2*timeGNSS[early]
+z_GNSS[early, 2] = 1
+# Then the 8 curve from [10,40,1]
+late = timeGNSS > tmc
+t_late = timeGNSS[np.flatnonzero(late) - tmc]
+z_GNSS[late, 0] = r * np.cos(omega * t_late)
+z_GNSS[late, 1] = 1/10 *(r ** 2) * np.sin(2 * omega * t_late) + 40
+z_GNSS[late, 2] = 1/z_ampl * r * omega * np.cos((omega / z_ampl ) * t_late)
 
-print("Generating GNSS-ranges without noise")
-for i in trange(M): #M = len(timeGNSS)
-    # Generate range for first 20 seconds (no noise)    
-    if timeGNSS[i] <= tmc:
-        z_GNSS[i, 0] = 10
-        z_GNSS[i, 1] = 2*timeGNSS[i]
-        z_GNSS[i, 2] = 1 
-        
-    if timeGNSS[i] > tmc:
-        
-        z_GNSS[i, 0] = (r * np.cos(omega * timeGNSS[i-tmc]) 
-                        )
-        
-        z_GNSS[i, 1] = (1/10 *(r ** 2) * np.sin(2 * omega * timeGNSS[i-tmc])
-                        + 40
-                        )
-        
-        z_GNSS[i, 2] = (1/z_ampl * r * omega * np.cos((omega / z_ampl ) * timeGNSS[i-tmc]))
-        
-        
 print("Generating true POS, VEL, ACC, ACC_BIAS, GYRO_BIAS and gyro/acc-measurements. \n")
-for k in trange(N): #N = len(timeIMU)
+# %% Biases
+x_true[:, ACC_BIAS_IDX] = acc_bias_nominal + rng.normal(0, acc_bias_std, (N,3))
+x_true[:, GYRO_BIAS_IDX] = gyro_bias_nominal + rng.normal(0, gyro_bias_std, (N,3))
+x_true[0, ACC_BIAS_IDX] = acc_bias_nominal
+x_true[0, GYRO_BIAS_IDX] = gyro_bias_nominal
 
-    x_true[k, ACC_BIAS_IDX] = np.array([-0.00875,
-                                        -0.00875,
-                                        0.00690])
-    
-    x_true[k, GYRO_BIAS_IDX] = np.array([-9.5e-4 ,
-                                          -7.3e-4,
-                                          3.7e-4])
-    
-    
-    # # #Accelerometer bias is typically measured in milli-g's (m/s^2)
-    
-    # #Skal det modelleres som dette? Dette er det som er brukt i den lange matrisen?
-    # if k > 0:
-    #     x_true[k, ACC_BIAS_IDX] =  x_true[k-1, ACC_BIAS_IDX] + np.array(
-    #         [np.random.normal(0, 0.001),
-    #          np.random.normal(0, 0.001),
-    #          np.random.normal(0, 0.001)]
-    #         )
-        
-    #     x_true[k, GYRO_BIAS_IDX] = x_true[k-1, GYRO_BIAS_IDX] + np.array(
-    #             [np.random.normal(0, 0.000001),
-    #              np.random.normal(0, 0.000001),
-    #              np.random.normal(0, 0.000001)]
-    #             )
-    
-    #Accelerometer bias is typically measured in milli-g's (m/s^2)
-    if k > 0:
-        x_true[k, ACC_BIAS_IDX] =  np.array([-0.00875 + np.random.normal(0, 0.004),
-                                              -0.00875 + np.random.normal(0, 0.004),
-                                              0.00690 + np.random.normal(0, 0.004)])
-        
-        x_true[k, GYRO_BIAS_IDX] = np.array([-9.5e-4 + np.random.normal(0, 0.00005),
-                                              -7.3e-4 + np.random.normal(0, 0.00005),
-                                              3.7e-4 + np.random.normal(0, 0.00005)])
-
-
-
-    #Move east for 20 seconds with 2m/s
-    if timeIMU[k] <= tmc:
-        x_true[k, 0] = 10
-        x_true[k, 1] = 2*timeIMU[k]
-        x_true[k, 2] = 1
-        
-        # %%  # %% NED Velocity p_dot = v
-        x_true[k, 3] = 0 #Constant value
-        x_true[k, 4] = 2
-        x_true[k, 5] = 0
-        
-        acc_t[k,0] = 0
-        acc_t[k,1] = 0
-        acc_t[k,2] = 0
-        
-                
-        
-    # %% Initialize path for 8 curve
-    # if timeIMU[k] == 20:
-    #     x_true[k, 0] = 10
-    #     x_true[k, 1] = 40
-    #     x_true[k, 2] = 1
-        
-    #     x_true[k, 3] = 0 #Constant value
-    #     x_true[k, 4] = 2
-    #     x_true[k, 5] = 0
-        
-    #     acc_t[k, 0] = -0.1
-    #     acc_t[k, 1] = 0
-    #     acc_t[k, 2] = -0.01
-        
-    # %% Start 8 curve at [10,40,1]
-    if timeIMU[k] > tmc: 
-        # x_true[k, 0] = 1*timeIMU[k]-60
-        # x_true[k, 1] = x_true[k-1,1]
-        # x_true[k, 2] = 0*timeIMU[k]
-
-        x_true[k, 0] = (r * np.cos(omega * timeIMU[t]) 
-                        )
-        
-        x_true[k, 1] = (1/10 *(r ** 2) * np.sin(2 * omega * timeIMU[t])
-                        + 40
-                        )
-        
-        x_true[k, 2] = (1/z_ampl * r * omega * np.cos((omega / z_ampl ) * timeIMU[t])
-                        )
-        
-            # Velocity       
-        x_true[k, 3] = (- omega * r * np.sin(omega * timeIMU[t])
-                        )
-        
-        x_true[k, 4] = (1/5 * omega * (r ** 2) *np.cos(2 * omega * timeIMU[t] )
-                      )
-        
-        x_true[k, 5] = (-1/(z_ampl**2) * r * (omega **2) * np.sin((omega / z_ampl ) * timeIMU[t] )
-                         )
-
-        acc_t[k,0] = (- (omega ** 2) * r * np.cos(omega * timeIMU[t])
-                     )
-        
-        acc_t[k,1] = (- 2/5 * (omega ** 2) * (r**2) * np.sin(2* omega * timeIMU[t])
-                      )
-        
-        acc_t[k,2] = (-1/(z_ampl**3) * (omega ** 3) * r *np.cos((omega / z_ampl ) * timeIMU[t])
-                     )
-        t += 1
-        
-    vel_pred_test[k+1] = vel_pred_test[k] + Ts * (acc_t[k])
-    pos_pred_test[k+1] = pos_pred_test[k] + Ts * vel_pred_test[k] + (Ts **2)/2 * (acc_t[k])
-    
-    # %% Gyro rate input
-    
-    #over 10 seconds, pitch 45 degrees (np.pi/4 = 0.7853981633974483 rad)
-    if (timeIMU[k] >= 10) and (timeIMU[k] <100 ):
-        rollVelTrue[k,:] = np.round(np.array([4.5,0,0])*np.pi/180,7) #rad/s
-        # print("i >5000")
-        
-    #over 10 seconds, roll 45 degrees (np.pi/4 = 0.7853981633974483 rad)   
-    if (timeIMU[k] >= 100) and (timeIMU[k] <200 ):
-        # print(i>12500)
-        rollVelTrue[k,:] = np.round(np.array([0,4.5,0])*np.pi/180,7)
-        
-    #over 10 seconds, yaw  45 degrees (np.pi/4 = 0.7853981633974483 rad)
-    if (timeIMU[k] >= 200) and (timeIMU[k] < 300 ):
-        rollVelTrue[k,:] = np.round(np.array([0, 0 , 4.5])*np.pi/180,7)
-        
-    if (timeIMU[k] >= 300):
-        rollVelTrue[k,:] = np.round(np.array([5*np.sin(1/10000 *rot_t),
-                                              5*np.sin(1/10000 *rot_t),
-                                              5*np.sin(1/10000 *rot_t)])*np.pi/180,7)
-        rot_t +=1
-    if (i> 20000):
-        print(rollVelTrue[:,i])
+# %% NED position, velocity p_dot = v and acceleration v_dot = a
+acc_t: np.ndarray = np.zeros((N,3))
+
+#Move east for 20 seconds with 2m/s
+early = timeIMU <= tmc
+x_true[early, 0] = 10
+x_true[early, 1] = 2*timeIMU[early]
+x_true[early, 2] = 1
+x_true[early, 4] = 2
+
+# Start 8 curve at [10,40,1], with the time since the start of the curve
+late = timeIMU > tmc
+t_late = timeIMU[:np.count_nonzero(late)]
+x_true[late, 0] = r * np.cos(omega * t_late)
+x_true[late, 1] = 1/10 *(r ** 2) * np.sin(2 * omega * t_late) + 40
+x_true[late, 2] = 1/z_ampl * r * omega * np.cos((omega / z_ampl ) * t_late)
+
+x_true[late, 3] = - omega * r * np.sin(omega * t_late)
+x_true[late, 4] = 1/5 * omega * (r ** 2) *np.cos(2 * omega * t_late )
+x_true[late, 5] = -1/(z_ampl**2) * r * (omega **2) * np.sin((omega / z_ampl ) * t_late )
+
+acc_t[late, 0] = - (omega ** 2) * r * np.cos(omega * t_late)
+acc_t[late, 1] = - 2/5 * (omega ** 2) * (r**2) * np.sin(2* omega * t_late)
+acc_t[late, 2] = -1/(z_ampl**3) * (omega ** 3) * r *np.cos((omega / z_ampl ) * t_late)
+
+# %% Kalman prediction testing, the sums are sequential as in a loop
+vel_pred_test = np.cumsum(np.vstack((vel_pred_init, Ts * acc_t)), axis=0)
+pos_pred_test = np.cumsum(np.vstack((pos_pred_init,
+                                     Ts * vel_pred_test[:N] + (Ts **2)/2 * acc_t)),
+                          axis=0)
+
+# %% Gyro rate input
+rollVelTrue = np.zeros((N+1, 3)) #rad/s
+#over 10 seconds, pitch 45 degrees (np.pi/4 = 0.7853981633974483 rad)
+rollVelTrue[:N][(timeIMU >= 10) & (timeIMU < 100)] = np.round(np.array([4.5,0,0])*np.pi/180,7)
+#over 10 seconds, roll 45 degrees (np.pi/4 = 0.7853981633974483 rad)
+rollVelTrue[:N][(timeIMU >= 100) & (timeIMU < 200)] = np.round(np.array([0,4.5,0])*np.pi/180,7)
+#over 10 seconds, yaw  45 degrees (np.pi/4 = 0.7853981633974483 rad)
+rollVelTrue[:N][(timeIMU >= 200) & (timeIMU < 300)] = np.round(np.array([0,0,4.5])*np.pi/180,7)
+rotating = timeIMU >= 300
+rot_t = np.arange(np.count_nonzero(rotating))
+rollVelTrue[:N][rotating] = np.round(5*np.sin(1/10000 *rot_t)[:, None]*np.pi/180,7)
+
+# %% Gyroscope #Outputs in rad/s since input is in rad/s
+z_gyro_vector: np.ndarray = z_gyro_batch(rollVelTrue[:N], rng,
+                                          x_true[:, GYRO_BIAS_IDX], gyro_noise_std)
+
+# %% Attitude, integrated from the measured rates
+eul_att = integrate_euler_rates(np.zeros(3), z_gyro_vector, Ts)
+
+# %% Accelerometer, gravity is not rotated into body
+z_acc_vector: np.ndarray = np.zeros((N+1,3))#m/s^2
+z_acc_vector[:N] = z_acc_batch(acc_t, g_t, rng, x_true[:, ACC_BIAS_IDX], acc_noise_std)
 
-    
-    
-    # %% Gyroscope #Outputs in rad/s since input is in rad/s
-    z_gyro_vector[k,:]  = z_gyro(rollVelTrue[k,:],
-                                     x_true[k,GYRO_BIAS_IDX],
-                                    # omega_n
-                                     )
-    #Eq 2.39 Fossen 21
-    eul_att[k+1,:] = eul_att[k,:] + transf_mat(eul_att[k,:]) @ z_gyro_vector[k,:]*Ts
-
-     # %% Accelerometer
-    z_acc_vector[k,:] = z_acc(eul_att[k],
-                                g_t,
-                                acc_t[k,:],
-                                x_true[k, ACC_BIAS_IDX],
-                                #a_n
-                                )
 # %% 
 print("Rounding and adding measurements to a .mat file. \n")
 eul_att = eul_att[:N,:] 
-# z_acc_vector = z_acc_vector[:N+1,:] #Dette forskyver feilen ein indeks tidligere
-# z_acc_vector = z_acc_vector[:N,:]
-quat_t = np.zeros((N,4))
-quat_t = np.apply_along_axis(euler_to_quaternion,1,eul_att)
+quat_t = euler_to_quaternions(eul_att)
 # %% 
 x_true[:, ATT_IDX] = quat_t
 
-x_true = np.apply_along_axis(np.round,1 ,x_true,7)
-acc_t = np.apply_along_axis(np.round,1 ,acc_t,7)
-vel_pred_test = np.apply_along_axis(np.round,1 ,vel_pred_test,7)
-pos_pred_test = np.apply_along_axis(np.round,1 ,pos_pred_test,7)
-z_GNSS = np.apply_along_axis(np.round,1,z_GNSS,7)
+x_true = np.round(x_true, 7)
+acc_t = np.round(acc_t, 7)
+vel_pred_test = np.round(vel_pred_test, 7)
+pos_pred_test = np.round(pos_pred_test, 7)
+z_GNSS = np.round(z_GNSS, 7)
 
 # %% 
 leverarm = np.zeros(3)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized IMU preprocessing before the filter loop.
+
+preprocess_imu applies the accelerometer and gyro scale/misalignment
+matrices S_a and S_g and computes the sampling times for a whole IMU log in
+one pass, into contiguous float64 arrays. The filter loop then only has to
+remove the bias estimates from each sample (ESKF.predict(..., prescaled=True)).
+
+The sample pairing of run_eskf is kept: the prediction from sample k to k + 1
+uses acceleration[k], rate[k + 1] and Ts[k], and Ts[0] is 0.
+"""
+from typing import Sequence
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class PreprocessedIMU:
+    """Scaled IMU samples of a log, all arrays C contiguous float64"""
+    # Sample times (N,)
+    time: np.ndarray
+    # Sampling times, Ts[k] = time[k] - time[k - 1] and Ts[0] = 0 for a log
+    # starting at its first sample, (N,)
+    Ts: np.ndarray
+    # S_a @ z_acc[k], (N,3)
+    acceleration: np.ndarray
+    # S_g @ z_gyro[k], (N,3)
+    rate: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def increments(self) -> Sequence[np.ndarray]:
+        """Velocity and angle increments of every prediction step
+
+        Returns
+        -------
+        Sequence[np.ndarray]: (delta_velocity, delta_angle), both (N,3), with
+            delta_velocity[k] = acceleration[k] * Ts[k]
+            delta_angle[k] = rate[k + 1] * Ts[k]
+        The bias estimates are not removed. The last delta_angle is 0, as
+        there is no step after the last sample.
+        """
+        delta_velocity = self.acceleration * self.Ts[:, None]
+        delta_angle = np.zeros_like(self.rate)
+        delta_angle[:-1] = self.rate[1:] * self.Ts[:-1, None]
+        return delta_velocity, delta_angle
+
+    def interval_increments(self, boundaries: np.ndarray) -> Sequence[np.ndarray]:
+        """Sums of the step increments over the intervals between boundaries
+
+        Parameters
+        ----------
+        boundaries : np.ndarray
+            Increasing sample indices (M,). Interval i holds the steps
+            boundaries[i], ..., boundaries[i + 1] - 1, and the last interval
+            runs to the end of the log.
+
+        Returns
+        -------
+        Sequence[np.ndarray]: (Ts, delta_velocity, delta_angle) of each
+            interval, (M,), (M,3) and (M,3). These are plain sums, without the
+            attitude change inside the interval, see preintegration.py for that.
+        """
+        boundaries = np.asarray(boundaries)
+        delta_velocity, delta_angle = self.increments()
+        return (np.add.reduceat(self.Ts, boundaries),
+                np.add.reduceat(delta_velocity, boundaries),
+                np.add.reduceat(delta_angle, boundaries))
+
+
+def preprocess_imu(time: np.ndarray,
+                   z_acc: np.ndarray,
+                   z_gyro: np.ndarray,
+                   S_a: np.ndarray = np.eye(3),
+                   S_g: np.ndarray = np.eye(3),
+                   start: int = 0,
+                   ) -> PreprocessedIMU:
+    """Scale the IMU samples and compute the sampling times of a log
+
+    Parameters
+    ----------
+    time : np.ndarray
+        Sample times (N,).
+    z_acc : np.ndarray
+        Measured accelerations (N,3), in any memory layout.
+    z_gyro : np.ndarray
+        Measured rotation rates (N,3), in any memory layout.
+    S_a : np.ndarray, optional
+        Accelerometer scale/misalignment matrix. The default is np.eye(3).
+    S_g : np.ndarray, optional
+        Gyro scale/misalignment matrix. The default is np.eye(3).
+    start : int, optional
+        First sample to keep. Its Ts is still the time since the previous
+        sample, only the first sample of the log has Ts = 0. The default is 0.
+
+    Returns
+    -------
+    PreprocessedIMU: The samples start, ..., N - 1
+    """
+    time = np.asarray(time, dtype=np.float64).ravel()
+    assert z_acc.shape == (len(time), 3), (
+        f"preprocess_imu: z_acc shape incorrect {z_acc.shape}")
+    assert z_gyro.shape == (len(time), 3), (
+        f"preprocess_imu: z_gyro shape incorrect {z_gyro.shape}")
+
+    Ts = np.empty(len(time))
+    Ts[0] = 0
+    np.subtract(time[1:], time[:-1], out=Ts[1:])
+
+    # (S @ z.T).T for all samples at once
+    acceleration = np.ascontiguousarray(z_acc[start:] @ np.transpose(S_a),
+                                        dtype=np.float64)
+    rate = np.ascontiguousarray(z_gyro[start:] @ np.transpose(S_g),
+                                dtype=np.float64)
+
+    return PreprocessedIMU(time=np.ascontiguousarray(time[start:]),
+                           Ts=np.ascontiguousarray(Ts[start:]),
+                           acceleration=acceleration,
+                           rate=rate)
@@ -36,7 +36,10 @@ from cat_slice import CatSlice
 # from eskf import ESKF
 # from eskf import ESKF
 from eskf_pseudoranges import ESKF
-from eskf_runner import run_eskf
+from eskf_runner import run_eskf, run_eskf_batch
+from monte_carlo import default_processes, run_monte_carlo
+from result_sinks import DiagonalSink
+from sweep import parameter_grid, run_sweep
 from plotter import * #plot_error_v_sigma, plot_pos, plot_vel, plot_angle, plot_estimate, plot_3Dpath, plot_path, state_error_plots, plot_NEES, plot_NIS
 # from timer import * 
 
@@ -217,103 +220,141 @@ use_iterative_pseudoranges: bool = False
 num_beacons = 4
 num_sims = 20
 
-t_batch = np.zeros(num_sims)
-elapsed_batch = np.zeros(num_sims)
+# Keyword arguments of run_eskf for each simulation, everything but
+# loaded_data. Only the covariance diagonals are sent back from the workers
+run_arguments = dict(N=N,
+                     eskf_parameters=eskf_parameters,
+                     x_pred_init=x_pred_init, P_pred_init=P_pred_init, p_std=p_std,
+                     num_beacons=num_beacons,
+                     use_batch_pseudoranges=use_batch_pseudoranges,
+                     use_iterative_pseudoranges=use_iterative_pseudoranges,
+                     offset=0.0,
+                     use_GNSSaccuracy=False, doGNSS=True,
+                     debug=False,
+                     sink=DiagonalSink())
 
 print("Number of beacons used: ", num_beacons)
 print("Number of simulations ran through", num_sims)
 print("Simulation duration (seconds): ", N*dt) 
+print("Worker processes: ", min(default_processes(), num_sims))
 
-if (use_batch_pseudoranges):
+# The simulations run over a process pool, see monte_carlo.py. The guard
+# keeps the workers from running them again where they import this script
+if __name__ == "__main__":
     print("Using batch pseudoranges")
-elif(use_iterative_pseudoranges):
-    print("Using iterative pseudoranges")
 
-for i in range(num_sims):  
-    # timeit.timeit()
-    
-    t_batch[i] = time.time()
-    
+    t_batch = time.time()
+    batch_runs = run_monte_carlo(loaded_data, [run_arguments] * num_sims)
+    wall_time_batch = time.time() - t_batch
+
     (x_pred,
     x_est,
     P_est,
     GNSSk,
-    # toc
-    ) = run_eskf (N, loaded_data,
-                        eskf_parameters,
-                        x_pred_init, P_pred_init, p_std, 
-                        num_beacons,
-                        use_batch_pseudoranges,
-                        use_iterative_pseudoranges,
-                        offset =0.0, 
-                        use_GNSSaccuracy=False, doGNSS=True,
-                        debug=False  )
-          
-    elapsed_batch[i] = time.time() - t_batch[i] 
-    
-print("Ellapsed time: ", elapsed_batch)
+    ) = batch_runs[-1].result
+    elapsed_batch = np.array([run.elapsed for run in batch_runs])
 
-average_time_batch = np.average(elapsed_batch)
-max_time_batch = np.amax(elapsed_batch)
-min_time_batch = np.amin(elapsed_batch)
+    print("Ellapsed time: ", elapsed_batch)
 
+    average_time_batch = np.average(elapsed_batch)
+    max_time_batch = np.amax(elapsed_batch)
+    min_time_batch = np.amin(elapsed_batch)
 
-print("Average time elapsed: ", average_time_batch, "seconds")
-print("Max_time_batch elapsed: ", max_time_batch, "seconds")
-print("min_time_batch elapsed: ", min_time_batch, "seconds")
+
+    print("Average time elapsed: ", average_time_batch, "seconds")
+    print("Max_time_batch elapsed: ", max_time_batch, "seconds")
+    print("min_time_batch elapsed: ", min_time_batch, "seconds")
+    print("Wall time of all simulations: ", wall_time_batch, "seconds")
 
 
 # %% 
 use_batch_pseudoranges: bool = False
 use_iterative_pseudoranges: bool = True
 
-t_iterative = np.zeros(num_sims)
-elapsed_iterative = np.zeros(num_sims)
-
-print("Number of beacons used: ", num_beacons)
-print("Number of simulations ran through", num_sims)
-print("Simulation duration (seconds): ", N*dt) 
+run_arguments.update(use_batch_pseudoranges=use_batch_pseudoranges,
+                     use_iterative_pseudoranges=use_iterative_pseudoranges)
 
-if (use_batch_pseudoranges):
-    print("Using batch pseudoranges")
-elif(use_iterative_pseudoranges):
+if __name__ == "__main__":
     print("Using iterative pseudoranges")
 
-for i in range(num_sims):  
-    # timeit.timeit()
-    
-    t_iterative[i] = time.time()
+    t_iterative = time.time()
+    iterative_runs = run_monte_carlo(loaded_data, [run_arguments] * num_sims)
+    wall_time_iterative = time.time() - t_iterative
+
     (x_pred,
     x_est,
     P_est,
     GNSSk,
-    # toc
-    ) = run_eskf (N, loaded_data,
+    ) = iterative_runs[-1].result
+    elapsed_iterative = np.array([run.elapsed for run in iterative_runs])
+        
+    print("Ellapsed time: ", elapsed_iterative)
+
+    average_time_iterative = np.average(elapsed_iterative)
+    max_time_iterative = np.amax(elapsed_iterative)
+    min_time_iterative = np.amin(elapsed_iterative)
+
+    print("Average time iterative elapsed: ", average_time_iterative, "seconds")
+    print("Max_time_iterative elapsed: ", max_time_iterative, "seconds")
+    print("Min_time_iterative elapsed: ", min_time_iterative, "seconds")
+    print("Wall time of all simulations: ", wall_time_iterative, "seconds")
+
+    speed_up = (average_time_batch - average_time_iterative)/average_time_batch*100
+    print("Speed up time: ", speed_up, "secons")
+
+# %% Batched Monte Carlo
+"""
+Timing benchmark: runs num_sims filters side by side as one stack with
+BatchESKF, each from its own initial position and velocity drawn from
+P_pred_init around x_pred_init. Set do_batch_timing to run it
+"""
+do_batch_timing: bool = False
+
+use_batch_pseudoranges: bool = True
+use_iterative_pseudoranges: bool = False
+
+if __name__ == "__main__" and do_batch_timing:
+    rng = np.random.default_rng(0)
+    x_pred_init_mc = np.tile(x_pred_init, (num_sims, 1))
+    x_pred_init_mc[:, :6] += rng.multivariate_normal(np.zeros(6),
+                                                     P_pred_init[:6, :6],
+                                                     size=num_sims)
+
+    t_batched = time.time()
+    (x_est_mc,
+    P_est_diag_mc,
+    GNSSk,
+    ) = run_eskf_batch (N, loaded_data,
                         eskf_parameters,
-                        x_pred_init, P_pred_init, p_std, 
+                        x_pred_init_mc, P_pred_init, p_std,
                         num_beacons,
                         use_batch_pseudoranges,
                         use_iterative_pseudoranges,
-                        offset =0.0, 
+                        offset =0.0,
                         use_GNSSaccuracy=False, doGNSS=True,
                         debug=False  )
-          
-    elapsed_iterative[i] = time.time() - t_iterative[i] 
-    
-print("Ellapsed time: ", elapsed_iterative)
+    elapsed_batched = time.time() - t_batched
 
-average_time_iterative = np.average(elapsed_iterative)
-max_time_iterative = np.amax(elapsed_iterative)
-min_time_iterative = np.amin(elapsed_iterative)
+    print("Elapsed time batched Monte Carlo: ", elapsed_batched, "seconds")
+    print("Per simulation: ", elapsed_batched/num_sims, "seconds")
+# %% Parameter sweep
+"""
+Runs every combination of the values below through run_eskf in parallel, see
+sweep.py. The results are cached in cache_folder, so running the cell again
+after adding values only computes the new combinations
+"""
+do_sweep: bool = False
 
-print("Average time iterative elapsed: ", average_time_iterative, "seconds")
-print("Max_time_iterative elapsed: ", max_time_iterative, "seconds")
-print("Min_time_iterative elapsed: ", min_time_iterative, "seconds")
+sweep_configurations = parameter_grid(num_beacons=[4, 6, 8],
+                                      p_std=[np.array([.01, .01, .03]),
+                                             np.array([.1, .1, .3])])
 
-print("Average time iterative elapsed: ", average_time_iterative, "seconds")
+if __name__ == "__main__" and do_sweep:
+    sweep_points = run_sweep(loaded_data, sweep_configurations, run_arguments,
+                             os.path.join(cache_folder, "sweep"))
+    for point in sweep_points:
+        print(point.configuration, "cached" if point.cached else point.elapsed)
 
-speed_up = (average_time_batch - average_time_iterative)/average_time_batch*100
-print("Speed up time: ", speed_up, "secons")
 # %% Plots and stuff                           
 
 # plt.close("all")
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo runs of run_eskf over a process pool.
+
+run_monte_carlo puts the numpy arrays of loaded_data in shared memory once,
+and every worker of the pool maps them as read-only arrays instead of
+receiving a pickled copy per run. The workers are pinned to one BLAS thread
+each, since the 15x15 products of the filter gain nothing from BLAS threads
+and filters with several threads each only compete for the same cores.
+A forked worker has numpy's BLAS loaded already, so it can only be pinned
+with threadpoolctl. Without it the workers are spawned, and pinned through
+the BLAS thread variables of their environment.
+Only the run arguments and the results are pickled, so pass a compact sink,
+e.g. DiagonalSink(), for long runs.
+
+With the spawn start method (Windows, macOS) the workers import the calling
+script again, so the call has to be under if __name__ == "__main__".
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import get_all_start_methods, get_context, shared_memory
+import os
+import time
+import warnings
+from typing import Any, Callable, Dict, List, Sequence
+
+import numpy as np
+
+from eskf_runner import run_eskf
+
+try:
+    from threadpoolctl import threadpool_limits
+    THREADPOOLCTL_AVAILABLE = True
+except ImportError:
+    THREADPOOLCTL_AVAILABLE = False
+
+# Read by the BLAS and OpenMP runtimes when they are loaded
+BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS",
+                         "OPENBLAS_NUM_THREADS",
+                         "MKL_NUM_THREADS",
+                         "BLIS_NUM_THREADS",
+                         "VECLIB_MAXIMUM_THREADS",
+                         "NUMEXPR_NUM_THREADS")
+
+
+@dataclass
+class MonteCarloRun:
+    """Result of one run of run_monte_carlo"""
+    # Position of the run in runs
+    index: int
+    # What function returned, (x_pred, x_est, P_est, GNSSk) for run_eskf
+    result: Any
+    # Wall time of the run in the worker [s], without the transfer of the result
+    elapsed: float
+    # Process id of the worker
+    worker: int
+
+
+class SharedData:
+    """The numpy arrays of loaded_data copied to shared memory blocks
+
+    arrays maps the keys to (block name, shape, dtype) and values keeps the
+    other entries, e.g. the header strings of scipy.io.loadmat. Both are
+    small enough to send to the workers, which rebuild the dictionary with
+    attach_shared_data. close() frees the blocks.
+    """
+
+    def __init__(self, loaded_data: Dict[str, Any]):
+        self.blocks = []
+        self.arrays = {}
+        self.values = {}
+        for key, value in loaded_data.items():
+            if (isinstance(value, np.ndarray) and not value.dtype.hasobject
+                    and value.nbytes > 0):
+                block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+                self.blocks.append(block)
+                np.ndarray(value.shape, value.dtype, buffer=block.buf)[...] = value
+                self.arrays[key] = (block.name, value.shape, value.dtype.str)
+            else:
+                self.values[key] = value
+
+    def close(self) -> None:
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+def attach_shared_data(arrays, values):
+    """loaded_data with read-only views of the shared blocks of a SharedData,
+    and the blocks, which have to stay open while the views are used"""
+    loaded_data = dict(values)
+    blocks = []
+    for key, (name, shape, dtype) in arrays.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        array.flags.writeable = False
+        loaded_data[key] = array
+    return loaded_data, blocks
+
+
+@contextmanager
+def blas_threads_environment(threads: int):
+    """Sets the BLAS thread variables for the processes started inside"""
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+# State of a worker process, set by _initialize_worker
+_worker_data = None
+_worker_blocks = []
+_worker_function = None
+
+
+def _initialize_worker(arrays, values, function, blas_threads):
+    global _worker_data, _worker_blocks, _worker_function
+    # The variables only reach runtimes loaded after the start of the
+    # worker. A forked worker has numpy's BLAS from the parent already
+    if THREADPOOLCTL_AVAILABLE:
+        threadpool_limits(blas_threads)
+    _worker_data, _worker_blocks = attach_shared_data(arrays, values)
+    _worker_function = function
+
+
+def _run(task):
+    index, run_arguments = task
+    start = time.perf_counter()
+    result = _worker_function(loaded_data=_worker_data, **run_arguments)
+    elapsed = time.perf_counter() - start
+    return MonteCarloRun(index, result, elapsed, os.getpid())
+
+
+def default_processes() -> int:
+    """Number of cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def run_monte_carlo(loaded_data: Dict[str, Any],
+                    runs: Sequence[Dict[str, Any]],
+                    processes: int = None,
+                    function: Callable = run_eskf,
+                    blas_threads: int = 1,
+                    start_method: str = None) -> List[MonteCarloRun]:
+    """
+    Description:
+        Runs function(loaded_data=loaded_data, **run_arguments) for every
+        run_arguments in runs over a pool of processes, with loaded_data in
+        shared memory
+
+    Parameters
+    ----------
+    loaded_data : Loaded data matrix, as for run_eskf
+    runs : Keyword arguments of each run, everything but loaded_data, e.g.
+        [dict(N=N, eskf_parameters=..., ..., sink=DiagonalSink())] * num_sims
+    processes : int, optional
+        Number of worker processes. The default is None, which uses one per
+        core available to this process, at most one per run.
+    function : callable, optional
+        Module level function to run, e.g. run_eskf_batch. The default is
+        run_eskf.
+    blas_threads : int, optional
+        BLAS threads per worker. The default is 1.
+    start_method : str, optional
+        multiprocessing start method. The default is None, which uses
+        "fork" where available and threadpoolctl is installed, and "spawn"
+        otherwise. Other start methods than "spawn" warn when threadpoolctl
+        is missing, since their workers can not be pinned.
+
+    Returns
+    -------
+    runs : list of MonteCarloRun
+        In the order of runs, with the result and wall time of each run
+
+    """
+    runs = list(runs)
+    if processes is None:
+        processes = min(default_processes(), max(len(runs), 1))
+    assert processes > 0, f"run_monte_carlo: processes must be positive: {processes}"
+    if start_method is None:
+        start_method = ("fork" if THREADPOOLCTL_AVAILABLE
+                        and "fork" in get_all_start_methods() else "spawn")
+    context = get_context(start_method)
+    if not THREADPOOLCTL_AVAILABLE and context.get_start_method() != "spawn":
+        warnings.warn(f"run_monte_carlo: threadpoolctl is not installed, the workers "
+                      f"of start method {context.get_start_method()} are not pinned "
+                      f"to {blas_threads} BLAS threads", RuntimeWarning)
+
+    with SharedData(loaded_data) as shared:
+        # Pool starts all workers here, with the variables in their environment
+        with blas_threads_environment(blas_threads):
+            pool = context.Pool(
+                processes,
+                initializer=_initialize_worker,
+                initargs=(shared.arrays, shared.values, function, blas_threads))
+        with pool:
+            results = pool.map(_run, enumerate(runs), chunksize=1)
+            pool.close()
+            pool.join()
+    return results
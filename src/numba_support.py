@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+Optional Numba support for the compiled kernels.
+
+Check NUMBA_AVAILABLE before relying on compiled speed. Without Numba, njit
+is a stand-in that leaves the function as it is, so the kernels still run
+as plain (slow) Python.
+"""
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        """Stand in for numba.njit which leaves the function as it is"""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
@@ -14,7 +14,8 @@ from scipy.stats.distributions import chi2
 
 from utils import wrap_to_pi_from_euler, wrap_to_pi
 from cat_slice import CatSlice
-from quaternion import quaternion_to_euler
+from quaternion import quaternion_to_euler, quaternions_to_euler
+from result_sinks import covariance_diagonals
 
 POS_IDX = CatSlice(start=0, stop=3)
 VEL_IDX = CatSlice(start=3, stop=6)
@@ -28,6 +29,7 @@ ERR_GYRO_BIAS_IDX = CatSlice(start=12, stop=15)
 
 
 # %% Can be used to plot error covariance
+# P_est can be stored by any of the result sinks, see covariance_diagonals
 def plot_error_pos_sigma(x_est, x_true, P_est, N):
 
     fig13, ax = plt.subplots(nrows=3, ncols=1, sharex=True)
@@ -35,7 +37,7 @@ def plot_error_pos_sigma(x_est, x_true, P_est, N):
     #pose_err[:, 2] *= 180/np.pi
     ylabels = ['m', 'm', 'm']
     tags = ['North error', 'East error', 'Down error']
-    std = 3*np.sqrt(P_est[:N,POS_IDX,POS_IDX])
+    std = 3*np.sqrt(covariance_diagonals(P_est[:N])[:, POS_IDX])
     # three_std = 3*np.sqrt(np.vstack([P[np.diag_indices(3)] for P in P_est[:N,:3]]))
     # std[:, 2] *= 180/np.pi
     for ax, err, std, tag, ylabel, in zip(ax, pos_err.T, std.T, tags, ylabels):
@@ -59,7 +61,7 @@ def plot_error_vel_sigma(x_est, x_true, P_est, N):
     #pose_err[:, 2] *= 180/np.pi
     ylabels = ['m/s', 'm/s', 'm/s']
     tags = ['North vel error', 'East vel error', 'Down vel error']
-    std = 3*np.sqrt(P_est[:N,VEL_IDX,VEL_IDX])
+    std = 3*np.sqrt(covariance_diagonals(P_est[:N])[:, VEL_IDX])
     # three_std = 3*np.sqrt(np.vstack([P[np.diag_indices(3)] for P in P_est[:N,3:6]]))
     # std[:, 2] *= 180/np.pi
     for ax, err, std, tag, ylabel, in zip(ax, pos_err.T, std.T, tags, ylabels):
@@ -81,15 +83,15 @@ def plot_error_att_sigma(x_est, x_true, P_est, N):
     
     fig15, ax = plt.subplots(nrows=3, ncols=1, sharex=True
                              )
-    x_true = np.apply_along_axis(quaternion_to_euler, 1, x_true[:N, ATT_IDX])
-    x_est = np.apply_along_axis(quaternion_to_euler, 1, x_est[:N, ATT_IDX])
+    x_true = quaternions_to_euler(x_true[:N, ATT_IDX])
+    x_est = quaternions_to_euler(x_est[:N, ATT_IDX])
     
     att_err = x_true[:N] - x_est[:N]
     #pose_err[:, 2] *= 180/np.pi
     ylabels = ['deg', 'deg', 'deg']
     tags = ['Pitch error', 'Roll error', 'Yaw error']
     
-    std = 3*np.sqrt(P_est[:N,ERR_ATT_IDX,ERR_ATT_IDX])
+    std = 3*np.sqrt(covariance_diagonals(P_est[:N])[:, ERR_ATT_IDX])
     
     
     # three_std = 3*np.sqrt(np.vstack([P[np.diag_indices(3)] for P in P_est[:N,6:9]]))
@@ -121,7 +123,7 @@ def plot_error_acc_bias_sigma(x_est, x_true, P_est, N):
     ylabels = ['m/s^2', 'm/s^2', 'm/s^2']
     tags = ['North acc_bias error', 'East acc_bias error', 'Down acc_bias error']
     
-    std = 3*np.sqrt(P_est[:N,ERR_ACC_BIAS_IDX,ERR_ACC_BIAS_IDX])
+    std = 3*np.sqrt(covariance_diagonals(P_est[:N])[:, ERR_ACC_BIAS_IDX])
     
     
     # three_std = 3*np.sqrt(np.vstack([P[np.diag_indices(3)] for P in P_est[:N,6:9]]))
@@ -153,7 +155,7 @@ def plot_error_rate_bias_sigma(x_est, x_true, P_est, N):
     ylabels = ['deg', 'deg', 'deg']
     tags = ['Pitch gyro_bias error', 'Roll gyro_bias error', 'Yaw gyro_bias error']
     
-    std = 3*np.sqrt(P_est[:N,ERR_GYRO_BIAS_IDX,ERR_GYRO_BIAS_IDX])
+    std = 3*np.sqrt(covariance_diagonals(P_est[:N])[:, ERR_GYRO_BIAS_IDX])
     
     
     # three_std = 3*np.sqrt(np.vstack([P[np.diag_indices(3)] for P in P_est[:N,6:9]]))
@@ -341,8 +343,8 @@ def plot_angle(t,N, x_est, x_true=None):
     # measured_angle = wrap_to_pi(measured_angle)
     # pi_wrap_eul = np.apply_along_axis(wrap_to_pi, 1, euler_est)
     
-    x_true = np.apply_along_axis(quaternion_to_euler, 1, x_true[:N, ATT_IDX])
-    x_est = np.apply_along_axis(quaternion_to_euler, 1, x_est[:N, ATT_IDX])
+    x_true = quaternions_to_euler(x_true[:N, ATT_IDX])
+    x_est = quaternions_to_euler(x_est[:N, ATT_IDX])
     # eul = np.apply_along_axis(quaternion_to_euler, 1, x_est)
     
     fig5, axs5 = plt.subplots(4, 1, num=5, clear=True)
@@ -384,7 +386,7 @@ def plot_angle(t,N, x_est, x_true=None):
 def plot_estimate(t, N, x_est):
     fig6, axs6 = plt.subplots(5, 1, num=6, clear=True)
 
-    eul = np.apply_along_axis(quaternion_to_euler, 1, x_est[:N, ATT_IDX])
+    eul = quaternions_to_euler(x_est[:N, ATT_IDX])
 
     axs6[0].plot(t, x_est[:N, POS_IDX])
     axs6[0].set(ylabel="NED position [m]")
@@ -468,8 +470,8 @@ def state_error_plots(t, N, x_est, x_true, delta_x):
         print('coud not plot error as xtrue is None')
         return
     fig9, axs9 = plt.subplots(5, 1, num=9, clear=True)
-    eul = np.apply_along_axis(quaternion_to_euler, 1, x_est[:N, ATT_IDX])
-    eul_true = np.apply_along_axis(quaternion_to_euler, 1, x_true[:N, ATT_IDX])
+    eul = quaternions_to_euler(x_est[:N, ATT_IDX])
+    eul_true = quaternions_to_euler(x_true[:N, ATT_IDX])
 
     # TODO use this in legends
     delta_x_RMSE = np.sqrt(np.mean(delta_x[:N] ** 2, axis=0))
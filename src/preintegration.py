@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+IMU preintegration between aiding epochs.
+
+preintegrate accumulates the IMU samples between two aiding epochs into
+velocity, position and attitude increments relative to the nominal state at
+the start of the interval, with their Jacobians with respect to the bias
+estimates at the start. PreintegratedESKF uses it to predict every sample
+between two updates in one call.
+
+The increments follow the discrete nominal model of ESKF.predict_nominal, so
+a preintegrated interval reproduces the sample by sample prediction to
+round-off:
+    - The acceleration is not rotated by the attitude before gravity is
+      added, so velocity and position are linear in the accelerometer bias
+      and there is no sculling term to compensate.
+    - The attitude takes the same quaternion step per sample. With
+      coning=True a two-sample coning correction is added to the rotation
+      vectors, which follows the continuous rotation better under fast
+      maneuvers, but no longer matches the sample by sample filter.
+"""
+from typing import Sequence, Tuple
+from dataclasses import dataclass, field
+import math
+
+import numpy as np
+
+from eskf_pseudoranges import ESKF, IDX, GRAVITY
+from eskf_batch import BatchESKF
+from quaternion import (
+    cross_product_matrices,
+    quaternion_product,
+    quaternion_products,
+    quaternions_to_rotation_matrices,
+)
+
+
+# %% Increments
+def _integrate(acceleration: np.ndarray, Ts: np.ndarray) -> Sequence[np.ndarray]:
+    """Velocity and position increments of the steps
+        v_(j+1) = v_j + Ts_j a_j
+        p_(j+1) = p_j + Ts_j v_j + Ts_j^2 / 2 a_j
+    from v_0 = p_0 = 0, for acceleration (n,3) or scalars (n,)
+    """
+    Ts = Ts.reshape(-1, *(1,) * (acceleration.ndim - 1))
+    velocity = np.cumsum(Ts * acceleration, axis=0)
+
+    velocity_before = np.zeros_like(velocity)
+    velocity_before[1:] = velocity[:-1]
+    position = np.cumsum(Ts * velocity_before + Ts ** 2 / 2 * acceleration, axis=0)
+    return velocity, position
+
+
+def _rotation_vector_quaternions(rotation_vectors: np.ndarray) -> np.ndarray:
+    """Quaternions of a stack of rotation vectors (n,3) -> (n,4), with the
+    small angle handling of ESKF.predict_nominal"""
+    angles = np.linalg.norm(rotation_vectors, axis=-1)
+    divisor = np.where(angles > 1e-15, angles, 1)
+
+    quaternions = np.empty((*rotation_vectors.shape[:-1], 4))
+    quaternions[..., 0] = np.cos(angles / 2)
+    quaternions[..., 1:] = (np.sin(angles / 2) / divisor)[..., None] * rotation_vectors
+    return quaternions
+
+
+def _right_jacobians(rotation_vectors: np.ndarray) -> np.ndarray:
+    """Right Jacobians of SO(3) of a stack of rotation vectors (n,3) -> (n,3,3)
+
+        Jr(phi) = I - (1 - cos|phi|) / |phi|^2 S(phi)
+                    + (|phi| - sin|phi|) / |phi|^3 S(phi)^2
+    """
+    angles = np.linalg.norm(rotation_vectors, axis=-1)
+    small = angles < 1e-8
+    angles = np.where(small, 1, angles)
+    first = np.where(small, 1 / 2, (1 - np.cos(angles)) / angles ** 2)
+    second = np.where(small, 1 / 6, (angles - np.sin(angles)) / angles ** 3)
+
+    S = cross_product_matrices(rotation_vectors)
+    return (np.eye(3) - first[:, None, None] * S
+            + second[:, None, None] * S @ S)
+
+
+@dataclass
+class Preintegration:
+    """Increments of an interval of n prediction steps, relative to the
+    nominal state at the start of the interval
+
+    Row j holds the increment after step j, so the interval totals are the
+    last rows. The bias Jacobians are those of the totals.
+    """
+    # Sampling times of the steps (n,)
+    Ts: np.ndarray
+    # Bias corrected acceleration and rotation rate of each step (n,3)
+    acceleration: np.ndarray
+    omega: np.ndarray
+
+    # Velocity and position increments, gravity included (n,3)
+    delta_velocity: np.ndarray
+    delta_position: np.ndarray
+    # Attitude increments q_0^-1 * q_(j+1) (n,4)
+    delta_quaternion: np.ndarray
+
+    # Bias estimates after step j are decay[j] times those at the start (n,)
+    acc_bias_decay: np.ndarray
+    gyro_bias_decay: np.ndarray
+
+    # Jacobians wrt the bias estimates at the start of the interval (3,3)
+    velocity_acc_bias_jacobian: np.ndarray = field(repr=False)
+    position_acc_bias_jacobian: np.ndarray = field(repr=False)
+    # Of the attitude increment as a body frame rotation vector
+    angle_gyro_bias_jacobian: np.ndarray = field(repr=False)
+
+    def __len__(self) -> int:
+        return len(self.Ts)
+
+    def states(self,
+               x_nominal: np.ndarray,
+               out: np.ndarray = None,
+               ) -> np.ndarray:
+        """Nominal states after every step of the interval
+
+        Parameters
+        ----------
+        x_nominal : np.ndarray
+            Nominal state at the start of the interval, (16,). Its bias
+            estimates must be the ones the increments were made with.
+        out : np.ndarray, optional
+            Array (n,16) to write the states into. The default is None.
+
+        Returns
+        -------
+        np.ndarray: The predicted nominal states (n,16)
+        """
+        if out is None:
+            out = np.empty((len(self), 16))
+        time = np.cumsum(self.Ts)
+
+        out[:, IDX.pos] = (x_nominal[IDX.pos] + time[:, None] * x_nominal[IDX.vel]
+                           + self.delta_position)
+        out[:, IDX.vel] = x_nominal[IDX.vel] + self.delta_velocity
+
+        quaternions = quaternion_products(x_nominal[IDX.att], self.delta_quaternion)
+        out[:, IDX.att] = (quaternions
+                           / np.linalg.norm(quaternions, axis=-1, keepdims=True))
+
+        out[:, IDX.acc_bias] = self.acc_bias_decay[:, None] * x_nominal[IDX.acc_bias]
+        out[:, IDX.gyro_bias] = self.gyro_bias_decay[:, None] * x_nominal[IDX.gyro_bias]
+        return out
+
+    def corrected(self,
+                  delta_acc_bias: np.ndarray,
+                  delta_gyro_bias: np.ndarray,
+                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """First order interval totals for bias estimates changed by
+        delta_acc_bias and delta_gyro_bias (3,), without integrating again
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: (delta_velocity (3,),
+            delta_position (3,), delta_quaternion (4,))
+        """
+        delta_velocity = (self.delta_velocity[-1]
+                          + self.velocity_acc_bias_jacobian @ delta_acc_bias)
+        delta_position = (self.delta_position[-1]
+                          + self.position_acc_bias_jacobian @ delta_acc_bias)
+
+        correction = _rotation_vector_quaternions(
+            self.angle_gyro_bias_jacobian @ delta_gyro_bias)
+        delta_quaternion = quaternion_product(self.delta_quaternion[-1], correction)
+        delta_quaternion /= math.sqrt(delta_quaternion @ delta_quaternion)
+        return delta_velocity, delta_position, delta_quaternion
+
+
+def preintegrate(acceleration: np.ndarray,
+                 rate: np.ndarray,
+                 Ts: np.ndarray,
+                 acc_bias: np.ndarray,
+                 gyro_bias: np.ndarray,
+                 p_acc: float = 0,
+                 p_gyro: float = 0,
+                 coning: bool = False,
+                 ) -> Preintegration:
+    """Preintegrate the IMU samples of an interval of n prediction steps
+
+    Parameters
+    ----------
+    acceleration : np.ndarray
+        Scaled accelerations S_a @ z_acc of the steps, (n,3).
+    rate : np.ndarray
+        Scaled rotation rates S_g @ z_gyro of the steps, (n,3). With the
+        pairing of run_eskf, step j uses acceleration[j] and rate[j + 1] of a
+        PreprocessedIMU.
+    Ts : np.ndarray
+        Sampling times of the steps (n,).
+    acc_bias, gyro_bias : np.ndarray
+        Bias estimates at the start of the interval (3,).
+    p_acc, p_gyro : float, optional
+        Bias decay rates of the ESKF. The default is 0.
+    coning : bool, optional
+        Add the two-sample coning correction to the rotation vectors. The
+        default is False.
+
+    Returns
+    -------
+    Preintegration: The increments of the interval
+    """
+    Ts = np.asarray(Ts, dtype=np.float64)
+    n = len(Ts)
+    assert n > 0, "preintegrate: empty interval"
+    assert acceleration.shape == (n, 3), (
+        f"preintegrate: acceleration shape incorrect {acceleration.shape}")
+    assert rate.shape == (n, 3), (
+        f"preintegrate: rate shape incorrect {rate.shape}")
+
+    #Bias estimates decay by (1 - Ts p) every step, step j uses the ones
+    # from before its own decay
+    acc_bias_decay = np.cumprod(1 - Ts * p_acc)
+    gyro_bias_decay = np.cumprod(1 - Ts * p_gyro)
+    acc_bias_scale = np.concatenate(([1.], acc_bias_decay[:-1]))
+    gyro_bias_scale = np.concatenate(([1.], gyro_bias_decay[:-1]))
+
+    acceleration = acceleration - acc_bias_scale[:, None] * acc_bias
+    omega = rate - gyro_bias_scale[:, None] * gyro_bias
+
+    #Velocity and position. The same recursion on d a_j / d acc_bias gives
+    # the Jacobians, which are multiples of I
+    delta_velocity, delta_position = _integrate(acceleration + GRAVITY, Ts)
+    velocity_bias, position_bias = _integrate(-acc_bias_scale, Ts)
+
+    #Attitude
+    angles = omega * Ts[:, None]
+    rotation_vectors = angles.copy()
+    if coning:
+        rotation_vectors[1:] += np.cross(angles[:-1], angles[1:]) / 12
+    step_quaternions = _rotation_vector_quaternions(rotation_vectors)
+
+    delta_quaternion = np.empty((n, 4))
+    quaternion = np.array([1., 0, 0, 0])
+    for j in range(n):
+        quaternion = quaternion_product(quaternion, step_quaternions[j],
+                                        out=delta_quaternion[j])
+        quaternion /= math.sqrt(quaternion @ quaternion)
+
+    #d angle / d gyro_bias = -R_n.T sum_j R_(j+1) Jr(phi_j) Ts_j scale_j,
+    # with R_j the rotation of delta_quaternion after step j - 1
+    rotations = quaternions_to_rotation_matrices(delta_quaternion)
+    terms = rotations @ _right_jacobians(rotation_vectors)
+    terms *= (Ts * gyro_bias_scale)[:, None, None]
+    angle_gyro_bias_jacobian = -rotations[-1].T @ terms.sum(axis=0)
+
+    return Preintegration(Ts=Ts,
+                          acceleration=acceleration,
+                          omega=omega,
+                          delta_velocity=delta_velocity,
+                          delta_position=delta_position,
+                          delta_quaternion=delta_quaternion,
+                          acc_bias_decay=acc_bias_decay,
+                          gyro_bias_decay=gyro_bias_decay,
+                          velocity_acc_bias_jacobian=velocity_bias[-1] * np.eye(3),
+                          position_acc_bias_jacobian=position_bias[-1] * np.eye(3),
+                          angle_gyro_bias_jacobian=angle_gyro_bias_jacobian)
+
+
+# %% Filter
+@dataclass
+class PreintegratedESKF(ESKF):
+    """ESKF that predicts all the IMU samples between two updates in one call
+
+    The nominal states come from preintegrate, and the error state matrices
+    of all the steps are discretized at once by a BatchESKF stacked over the
+    steps, linearized at the same nominal states as the sample by sample
+    filter. Only the 15x15 covariance recursion runs per sample.
+    """
+    # Two-sample coning correction of the attitude, see preintegrate
+    coning: bool = False
+
+    # Discretizes the stacked steps of an interval
+    batch: BatchESKF = field(init=False, repr=False)
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.batch = BatchESKF(self.sigma_acc,
+                               self.sigma_gyro,
+                               self.sigma_acc_bias,
+                               self.sigma_gyro_bias,
+                               self.p_acc,
+                               self.p_gyro,
+                               S_a=self.S_a,
+                               S_g=self.S_g,
+                               debug=False,
+                               discretization=self.discretization,
+                               discretization_order=self.discretization_order)
+
+    def predict_interval(self,
+                         x_nominal: np.ndarray,
+                         P: np.ndarray,
+                         z_acc: np.ndarray,
+                         z_gyro: np.ndarray,
+                         Ts: np.ndarray,
+                         x_out: np.ndarray = None,
+                         P_out: np.ndarray = None,
+                         prescaled: bool = False,
+                         ) -> Tuple[np.ndarray, np.ndarray]:
+        """Predict n steps ahead without updates
+
+        Parameters
+        ----------
+        x_nominal : np.ndarray
+            Nominal state at the start of the interval, (16,).
+        P : np.ndarray
+            Error state covariance at the start of the interval (15,15).
+        z_acc, z_gyro : np.ndarray
+            IMU measurements of each step (n,3), paired as in ESKF.predict.
+        Ts : np.ndarray
+            Sampling times of the steps (n,).
+        x_out, P_out : np.ndarray, optional
+            Arrays (n,16) and (n,15,15) to write the predictions into. The
+            default is None.
+        prescaled : bool, optional
+            z_acc and z_gyro are already multiplied by S_a and S_g, see
+            ESKF.correct_imu. The default is False.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]: The predictions after every step,
+            (x_nominal_predicted (n,16), P_predicted (n,15,15))
+        """
+        assert x_nominal.shape == (
+            16,
+            ), f"PreintegratedESKF.predict_interval: x_nominal shape incorrect {x_nominal.shape}"
+        assert P.shape == (
+            15,
+            15,
+            ), f"PreintegratedESKF.predict_interval: P shape incorrect {P.shape}"
+
+        Ts = np.asarray(Ts, dtype=np.float64)
+        if not prescaled:
+            z_acc = z_acc @ self.S_a.T
+            z_gyro = z_gyro @ self.S_g.T
+
+        preintegration = preintegrate(z_acc,
+                                      z_gyro,
+                                      Ts,
+                                      x_nominal[IDX.acc_bias],
+                                      x_nominal[IDX.gyro_bias],
+                                      self.p_acc,
+                                      self.p_gyro,
+                                      self.coning)
+        x_nominal_predicted = preintegration.states(x_nominal, out=x_out)
+
+        #Step j is linearized at the state before it, as in ESKF.predict
+        x_linearization = np.concatenate((x_nominal[None], x_nominal_predicted[:-1]))
+        Ad, GQGd = self.batch.discrete_error_matrices(x_linearization,
+                                                      preintegration.acceleration,
+                                                      preintegration.omega,
+                                                      Ts[:, None, None])
+
+        if P_out is None:
+            P_out = np.empty((len(Ts), 15, 15))
+        AdP = self.workspace.AdP
+        for j in range(len(Ts)):
+            np.matmul(Ad[j], P, out=AdP)
+            np.matmul(AdP, Ad[j].T, out=P_out[j])
+            P_out[j] += GQGd[j]
+            P = P_out[j]
+
+        return x_nominal_predicted, P_out
+
+    def predict_segment(self,
+                        x_est: np.ndarray,
+                        P_est: np.ndarray,
+                        x_pred: np.ndarray,
+                        P_pred: np.ndarray,
+                        z_acc: np.ndarray,
+                        z_gyro: np.ndarray,
+                        Ts_IMU: np.ndarray,
+                        start: int,
+                        stop: int,
+                        prescaled: bool = False,
+                        ) -> None:
+        """Run the samples start, ..., stop - 1 without updates in place,
+        as ESKF.predict_segment, with one predict_interval
+
+        Parameters
+        ----------
+        x_est, x_pred : np.ndarray
+            Nominal state estimates and predictions (N,16).
+        P_est, P_pred : np.ndarray
+            Error state covariance estimates and predictions (N,15,15).
+        z_acc, z_gyro : np.ndarray
+            IMU measurements (N,3).
+        Ts_IMU : np.ndarray
+            Sampling times (N,).
+        start, stop : int
+            The samples to run. x_est[start] and P_est[start] must be set.
+        prescaled : bool, optional
+            z_acc and z_gyro are already multiplied by S_a and S_g, see
+            ESKF.correct_imu. The default is False.
+        """
+        #Every sample but the last of the arrays is predicted one step ahead
+        steps = min(stop, len(P_est) - 1) - start
+        if steps > 0:
+            self.predict_interval(x_est[start],
+                                  P_est[start],
+                                  z_acc[start:start + steps],
+                                  z_gyro[start + 1:start + steps + 1],
+                                  Ts_IMU[start:start + steps],
+                                  x_out=x_pred[start + 1:start + steps + 1],
+                                  P_out=P_pred[start + 1:start + steps + 1],
+                                  prescaled=prescaled)
+            self.validate_predictions(x_pred, P_pred, start + 1, start + steps + 1)
+
+        x_est[start + 1:stop] = x_pred[start + 1:stop]
+        P_est[start + 1:stop] = P_pred[start + 1:stop]
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage profiling of the filter.
+
+The ESKF stages are wrapped with @profiled(name) and the runner loop with
+span(name). They record their wall time into the active Profiler, and cost
+one global lookup when there is none:
+
+    profiler = Profiler()
+    run_eskf(..., profiler=profiler)   # or: with profiler: run_eskf(...)
+    print(profiler.report())
+    profiler.dump("profile.json")
+
+Spans nest, e.g. predict_covariance contains discrete_error_matrices, so the
+totals of nested spans overlap.
+"""
+import functools
+import json
+from time import perf_counter
+from typing import Dict
+
+import numpy as np
+
+# Profiler recording the spans, None when profiling is off
+_active = None
+
+
+class Profiler:
+    """Durations of the named spans run while it is active
+
+    durations maps the span names to the list of their durations [s].
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *exception):
+        global _active
+        _active = self._previous
+        self._previous = None
+
+    def add(self, name: str, duration: float) -> None:
+        self.durations.setdefault(name, []).append(duration)
+
+    def statistics(self) -> Dict[str, Dict[str, float]]:
+        """Count, total, mean, p50, p99 and max [s] of each span, the
+        largest total first"""
+        statistics = {}
+        for name, durations in self.durations.items():
+            durations = np.asarray(durations)
+            p50, p99 = np.percentile(durations, [50, 99])
+            statistics[name] = {"count": len(durations),
+                                "total": float(durations.sum()),
+                                "mean": float(durations.mean()),
+                                "p50": float(p50),
+                                "p99": float(p99),
+                                "max": float(durations.max())}
+        return dict(sorted(statistics.items(), key=lambda item: -item[1]["total"]))
+
+    def histogram(self, name: str, bins: int = 20):
+        """Counts and edges [s] of the durations of a span in logarithmic bins"""
+        durations = np.asarray(self.durations[name])
+        edges = np.geomspace(durations.min(), durations.max() * (1 + 1e-9), bins + 1)
+        return np.histogram(durations, edges)
+
+    def report(self) -> str:
+        """Table of the statistics, with the share of the largest total,
+        usually the whole run"""
+        statistics = self.statistics()
+        if not statistics:
+            return "No spans recorded"
+        largest = next(iter(statistics.values()))["total"]
+        lines = [f"{'span':>24} {'count':>8} {'total [ms]':>11} {'share':>7} "
+                 f"{'mean [us]':>10} {'p50 [us]':>10} {'p99 [us]':>10} {'max [us]':>10}"]
+        for name, span_statistics in statistics.items():
+            lines.append(f"{name:>24} {span_statistics['count']:>8} "
+                         f"{span_statistics['total']*1e3:>11.1f} "
+                         f"{span_statistics['total']/largest:>7.1%} "
+                         f"{span_statistics['mean']*1e6:>10.1f} "
+                         f"{span_statistics['p50']*1e6:>10.1f} "
+                         f"{span_statistics['p99']*1e6:>10.1f} "
+                         f"{span_statistics['max']*1e6:>10.1f}")
+        return "\n".join(lines)
+
+    def dump(self, path: str) -> None:
+        """Write the statistics to a JSON file"""
+        with open(path, "w") as file:
+            json.dump(self.statistics(), file, indent=2)
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exception):
+        self.profiler.add(self.name, perf_counter() - self.start)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exception):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str):
+    """Context manager recording the time of its body as span name"""
+    if _active is None:
+        return _NULL_SPAN
+    return _Span(_active, name)
+
+
+def profiled(name: str):
+    """Decorator recording the time of each call as span name"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            profiler = _active
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.add(name, perf_counter() - start)
+        return wrapper
+    return decorator
@@ -1,8 +1,10 @@
 import numpy as np
-import utils
 import scipy.linalg as la
 
-def quaternion_product(ql: np.ndarray, qr: np.ndarray) -> np.ndarray:
+from numba_support import njit
+
+def quaternion_product(ql: np.ndarray, qr: np.ndarray,
+                       out: np.ndarray = None) -> np.ndarray:
     """Perform quaternion product according to either (10.21) or (10.34).
 
     Args:
@@ -12,55 +14,56 @@ def quaternion_product(ql: np.ndarray, qr: np.ndarray) -> np.ndarray:
         qr (np.ndarray): Right quaternion of the product of either shape (3,)
         (pure quaternion) or (4,)
 
+        out (np.ndarray, optional): Array of shape (4,) to write the result
+        into. Defaults to None, which allocates a new array.
+
     Raises:
         RuntimeError: Left or right quaternion are of the wrong shape
-        AssertionError: Resulting quaternion is of wrong shape
 
     Returns:
         np.ndarray: Quaternion product of ql and qr of shape (4,)s
     """
     if ql.shape == (4,):
-        eta_left = ql[0]
-        epsilon_left = ql[1:].reshape((3, 1))
+        eta_left, x_left, y_left, z_left = ql
     elif ql.shape == (3,):
         eta_left = 0
-        epsilon_left = ql.reshape((3, 1))
+        x_left, y_left, z_left = ql
     else:
         raise RuntimeError(
             f"utils.quaternion_product: Quaternion multiplication error, left quaternion shape incorrect: {ql.shape}"
         )
 
     if qr.shape == (4,):
-        q_right = qr.copy()
+        eta_right, x_right, y_right, z_right = qr
     elif qr.shape == (3,):
-        q_right = np.concatenate(([0], qr))
+        eta_right = 0
+        x_right, y_right, z_right = qr
     else:
         raise RuntimeError(
             f"utils.quaternion_product: Quaternion multiplication error, right quaternion wrong shape: {qr.shape}"
         )
 
-    epsilon_block = np.block(
-        [[0, -epsilon_left.T],
-         [epsilon_left, utils.cross_product_matrix(epsilon_left)]])
-
-    quaternion = (eta_left * np.eye(4) + epsilon_block) @ q_right
+    if out is None:
+        out = np.empty(4)
 
-    # Ensure result is of correct shape
-    quaternion = quaternion.ravel()
-    assert quaternion.shape == (
-        4,
-    ), f"utils.quaternion_product: Quaternion multiplication error, result quaternion wrong shape: {quaternion.shape}"
-    return quaternion
+    # (eta_l * I + [[0, -eps_l.T], [eps_l, S(eps_l)]]) @ qr written out
+    out[0] = eta_left * eta_right - x_left * x_right - y_left * y_right - z_left * z_right
+    out[1] = eta_left * x_right + eta_right * x_left + y_left * z_right - z_left * y_right
+    out[2] = eta_left * y_right + eta_right * y_left + z_left * x_right - x_left * z_right
+    out[3] = eta_left * z_right + eta_right * z_left + x_left * y_right - y_left * x_right
+    return out
 
 
 def quaternion_to_rotation_matrix(
-    quaternion: np.ndarray, debug: bool = True
+    quaternion: np.ndarray, debug: bool = True, out: np.ndarray = None
 ) -> np.ndarray:
     """Convert a quaternion to a rotation matrix
 
     Args:
         quaternion (np.ndarray): Quaternion of either shape (3,) (pure quaternion) or (4,)
         debug (bool, optional): Debug flag, could speed up by setting to False. Defaults to True.
+        out (np.ndarray, optional): Array of shape (3, 3) to write the result
+        into. Defaults to None, which allocates a new array.
 
     Raises:
         RuntimeError: Quaternion is of the wrong shape
@@ -70,19 +73,29 @@ def quaternion_to_rotation_matrix(
         np.ndarray: Rotation matrix of shape (3, 3)
     """
     if quaternion.shape == (4,):
-        eta = quaternion[0]
-        epsilon = quaternion[1:]
+        eta, x, y, z = quaternion
     elif quaternion.shape == (3,):
         eta = 0
-        epsilon = quaternion.copy()
+        x, y, z = quaternion
     else:
         raise RuntimeError(
             f"quaternion.quaternion_to_rotation_matrix: Quaternion to multiplication error, quaternion shape incorrect: {quaternion.shape}"
         )
 
-    epsilon_cross_matrix = utils.cross_product_matrix(epsilon)
-    R = (np.eye(3) + 2 * eta * epsilon_cross_matrix
-         + 2 * epsilon_cross_matrix @ epsilon_cross_matrix)
+    if out is None:
+        out = np.empty((3, 3))
+    R = out
+
+    # I + 2 * eta * S(eps) + 2 * S(eps) @ S(eps) written out
+    R[0, 0] = 1 - 2 * (y * y + z * z)
+    R[0, 1] = 2 * (x * y - eta * z)
+    R[0, 2] = 2 * (x * z + eta * y)
+    R[1, 0] = 2 * (x * y + eta * z)
+    R[1, 1] = 1 - 2 * (x * x + z * z)
+    R[1, 2] = 2 * (y * z - eta * x)
+    R[2, 0] = 2 * (x * z - eta * y)
+    R[2, 1] = 2 * (y * z + eta * x)
+    R[2, 2] = 1 - 2 * (x * x + y * y)
 
     if debug:
         assert np.allclose(
@@ -109,23 +122,7 @@ def quaternion_to_euler(quaternion: np.ndarray) -> np.ndarray:
         4,
     ), f"quaternion.quaternion_to_euler: Quaternion shape incorrect {quaternion.shape}"
 
-    q = quaternion
-    q_2 = q**2
-
-    phi = np.arctan2(2 * (q[3]*q[2] + q[0]*q[1]),
-                     q_2[0] - q_2[1] - q_2[2] + q_2[3])
-
-    theta = np.arcsin(2 * (q[0]*q[2] - q[1]*q[3]))
-
-    psi = np.arctan2(2 * (q[1]*q[2] + q[0]*q[3]),
-                     q_2[0] + q_2[1] - q_2[2] - q_2[3])
-
-    euler_angles = np.array([phi, theta, psi])
-    assert euler_angles.shape == (
-        3,
-    ), f"quaternion.quaternion_to_euler: Euler angles shape incorrect: {euler_angles.shape}"
-
-    return euler_angles
+    return quaternions_to_euler(quaternion)
 
 ######################## NEEDS INPUT IN RADIANS #############
 def euler_to_quaternion(euler_angles: np.ndarray) -> np.ndarray:
@@ -142,24 +139,135 @@ def euler_to_quaternion(euler_angles: np.ndarray) -> np.ndarray:
         3,
     ), f"quaternion.euler_to_quaternion: euler_angles shape wrong {euler_angles.shape}"
 
-    half_angles = 0.5 * euler_angles
-    c_phi2, c_theta2, c_psi2 = np.cos(half_angles)
-    s_phi2, s_theta2, s_psi2 = np.sin(half_angles)
-
-    quaternion = np.array(
-        [
-            c_phi2 * c_theta2 * c_psi2 + s_phi2 * s_theta2 * s_psi2,
-            s_phi2 * c_theta2 * c_psi2 - c_phi2 * s_theta2 * s_psi2,
-            c_phi2 * s_theta2 * c_psi2 + s_phi2 * c_theta2 * s_psi2,
-            c_phi2 * c_theta2 * s_psi2 - s_phi2 * s_theta2 * c_psi2,
-        ]
+    return euler_to_quaternions(euler_angles)
+
+
+# %% Batch functions
+"""
+The functions below take stacks of quaternions (...,4) and vectors or Euler
+angles (...,3), e.g. whole trajectories (N,4), and broadcast like other
+numpy functions. Their arithmetic is that of the functions for single
+quaternions above, so both give the same results to the last bit.
+quaternion_product and quaternion_to_rotation_matrix keep their own code,
+since the filter calls them once per sample and the stacked code costs a
+few microseconds more for a single quaternion.
+"""
+
+
+def cross_product_matrices(vectors: np.ndarray) -> np.ndarray:
+    """Skew symmetric matrices of a stack of vectors (...,3) -> (...,3,3)"""
+    S = np.zeros((*vectors.shape[:-1], 3, 3))
+    S[..., 0, 1] = -vectors[..., 2]
+    S[..., 0, 2] = vectors[..., 1]
+    S[..., 1, 0] = vectors[..., 2]
+    S[..., 1, 2] = -vectors[..., 0]
+    S[..., 2, 0] = -vectors[..., 1]
+    S[..., 2, 1] = vectors[..., 0]
+    return S
+
+
+def _components(quaternions: np.ndarray, name: str):
+    """eta, x, y, z of quaternions (...,4) or pure quaternions (...,3)"""
+    if quaternions.shape[-1] == 4:
+        return quaternions[..., 0], quaternions[..., 1], quaternions[..., 2], quaternions[..., 3]
+    if quaternions.shape[-1] == 3:
+        return 0, quaternions[..., 0], quaternions[..., 1], quaternions[..., 2]
+    raise RuntimeError(
+        f"quaternion.{name}: quaternion shape incorrect: {quaternions.shape}"
     )
 
-    assert quaternion.shape == (
-        4,
-    ), f"quaternion.euler_to_quaternion: Quaternion shape incorrect {quaternion.shape}"
 
-    return quaternion
+def quaternion_products(ql: np.ndarray, qr: np.ndarray,
+                        out: np.ndarray = None) -> np.ndarray:
+    """Quaternion products of two stacks of quaternions, see quaternion_product
+
+    Args:
+        ql (np.ndarray): Left quaternions (...,4), or pure quaternions (...,3)
+        qr (np.ndarray): Right quaternions (...,4), or pure quaternions (...,3)
+        out (np.ndarray, optional): Array (...,4) of the broadcast shape to
+        write the products into. Defaults to None.
+
+    Returns:
+        np.ndarray: Products (...,4)
+    """
+    eta_left, x_left, y_left, z_left = _components(ql, "quaternion_products")
+    eta_right, x_right, y_right, z_right = _components(qr, "quaternion_products")
+
+    if out is None:
+        out = np.empty((*np.broadcast_shapes(ql.shape[:-1], qr.shape[:-1]), 4))
+    out[..., 0] = eta_left * eta_right - x_left * x_right - y_left * y_right - z_left * z_right
+    out[..., 1] = eta_left * x_right + eta_right * x_left + y_left * z_right - z_left * y_right
+    out[..., 2] = eta_left * y_right + eta_right * y_left + z_left * x_right - x_left * z_right
+    out[..., 3] = eta_left * z_right + eta_right * z_left + x_left * y_right - y_left * x_right
+    return out
+
+
+def quaternion_conjugates(quaternions: np.ndarray) -> np.ndarray:
+    """Conjugates (inverses of unit quaternions) of quaternions (...,4)"""
+    conjugates = quaternions.copy()
+    conjugates[..., 1:] *= -1
+    return conjugates
+
+
+def normalize_quaternions(quaternions: np.ndarray,
+                          out: np.ndarray = None) -> np.ndarray:
+    """Quaternions (...,4) scaled to unit norm, as in ESKF.predict_nominal"""
+    norms = np.sqrt(np.sum(quaternions * quaternions, axis=-1, keepdims=True))
+    return np.divide(quaternions, norms, out=out)
+
+
+def quaternions_to_rotation_matrices(quaternions: np.ndarray,
+                                     out: np.ndarray = None) -> np.ndarray:
+    """Rotation matrices of unit quaternions (...,4) -> (...,3,3), see
+    quaternion_to_rotation_matrix"""
+    eta, x, y, z = _components(quaternions, "quaternions_to_rotation_matrices")
+
+    if out is None:
+        out = np.empty((*quaternions.shape[:-1], 3, 3))
+    R = out
+    R[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    R[..., 0, 1] = 2 * (x * y - eta * z)
+    R[..., 0, 2] = 2 * (x * z + eta * y)
+    R[..., 1, 0] = 2 * (x * y + eta * z)
+    R[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    R[..., 1, 2] = 2 * (y * z - eta * x)
+    R[..., 2, 0] = 2 * (x * z - eta * y)
+    R[..., 2, 1] = 2 * (y * z + eta * x)
+    R[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    return R
+
+
+def quaternions_to_euler(quaternions: np.ndarray) -> np.ndarray:
+    """Euler angles (...,3) of quaternions (...,4), see quaternion_to_euler"""
+    q = quaternions
+    q_2 = q**2
+
+    euler_angles = np.empty((*q.shape[:-1], 3))
+    euler_angles[..., 0] = np.arctan2(2 * (q[..., 3]*q[..., 2] + q[..., 0]*q[..., 1]),
+                                      q_2[..., 0] - q_2[..., 1] - q_2[..., 2] + q_2[..., 3])
+
+    euler_angles[..., 1] = np.arcsin(2 * (q[..., 0]*q[..., 2] - q[..., 1]*q[..., 3]))
+
+    euler_angles[..., 2] = np.arctan2(2 * (q[..., 1]*q[..., 2] + q[..., 0]*q[..., 3]),
+                                      q_2[..., 0] + q_2[..., 1] - q_2[..., 2] - q_2[..., 3])
+    return euler_angles
+
+
+def euler_to_quaternions(euler_angles: np.ndarray) -> np.ndarray:
+    """Quaternions (...,4) of Euler angles (...,3) in radians, see
+    euler_to_quaternion"""
+    half_angles = 0.5 * euler_angles
+    cosines = np.cos(half_angles)
+    sines = np.sin(half_angles)
+    c_phi2, c_theta2, c_psi2 = cosines[..., 0], cosines[..., 1], cosines[..., 2]
+    s_phi2, s_theta2, s_psi2 = sines[..., 0], sines[..., 1], sines[..., 2]
+
+    quaternions = np.empty((*euler_angles.shape[:-1], 4))
+    quaternions[..., 0] = c_phi2 * c_theta2 * c_psi2 + s_phi2 * s_theta2 * s_psi2
+    quaternions[..., 1] = s_phi2 * c_theta2 * c_psi2 - c_phi2 * s_theta2 * s_psi2
+    quaternions[..., 2] = c_phi2 * s_theta2 * c_psi2 + s_phi2 * c_theta2 * s_psi2
+    quaternions[..., 3] = c_phi2 * c_theta2 * s_psi2 - s_phi2 * s_theta2 * c_psi2
+    return quaternions
 
 
 # %% Rotation matrix
@@ -237,4 +345,33 @@ def transf_mat(euler_angles: np.ndarray) -> np.ndarray:
         (0,       sph/ct,    cph/ct)
         ))
     
-    return T
\ No newline at end of file
+    return T
+
+
+# %% Euler angle integration
+@njit(cache=True)
+def integrate_euler_rates(euler_init, omega_b, Ts):
+    """
+    Integrates the Euler angles with the body rates omega_b (N,3) over
+    steps of Ts, eq 2.39 Fossen 21, eul[k+1] = eul[k] + T(eul[k]) omega_b[k] Ts
+    with T = transf_mat(eul[k]) written out
+
+    Returns the angles (N+1,3), euler_init first
+    """
+    N = omega_b.shape[0]
+    eul = np.empty((N + 1, 3))
+    eul[0] = euler_init
+    for k in range(N):
+        phi = eul[k, 0]
+        theta = eul[k, 1]
+        cph = np.cos(phi)
+        sph = np.sin(phi)
+        ct = np.cos(theta)
+        tt = np.tan(theta)
+        omega_x = omega_b[k, 0]
+        omega_y = omega_b[k, 1]
+        omega_z = omega_b[k, 2]
+        eul[k + 1, 0] = phi + (omega_x + sph*tt*omega_y + cph*tt*omega_z) * Ts
+        eul[k + 1, 1] = theta + (cph*omega_y - sph*omega_z) * Ts
+        eul[k + 1, 2] = eul[k, 2] + (sph/ct*omega_y + cph/ct*omega_z) * Ts
+    return eul
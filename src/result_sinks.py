@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Result sinks for the blocks of stream_eskf.
+
+A sink receives the blocks of a run in order and keeps what it needs of
+them. run_eskf(..., sink=...) returns (x_pred, x_est, P_est, GNSSk) with the
+arrays from sink.result(). The default FullSink keeps everything in memory.
+The other sinks keep the nominal states the same way and store the
+covariances more compactly:
+
+    FullSink              P_est (N,15,15)
+    DiagonalSink          P_est (N,15), the variances the sigma plots use
+    PackedTriangularSink  P_est (N,120), the upper triangle
+    MemmapSink            P_est (N,15,15) in .npy files on disk
+    DecimatedSink         every k-th sample of any other sink
+
+covariance_diagonals gives the (N,15) variances of every layout.
+"""
+import os
+from dataclasses import replace
+from typing import Tuple
+
+import numpy as np
+
+# Upper triangle of a 15x15 covariance, row by row
+TRIANGLE_IDX = np.triu_indices(15)
+
+
+def covariance_diagonals(P_est: np.ndarray) -> np.ndarray:
+    """Variances (N,15) of covariances stored as (N,15,15), (N,120) or (N,15)"""
+    if P_est.shape[1:] == (15, 15):
+        return np.diagonal(P_est, axis1=1, axis2=2)
+    if P_est.shape[1:] == (len(TRIANGLE_IDX[0]),):
+        return P_est[:, TRIANGLE_IDX[0] == TRIANGLE_IDX[1]]
+    assert P_est.shape[1:] == (15,), (
+        f"covariance_diagonals: unknown covariance layout {P_est.shape}")
+    return P_est
+
+
+def unpack_covariances(packed: np.ndarray) -> np.ndarray:
+    """Symmetric covariances (N,15,15) from the upper triangles (N,120),
+    the lower triangles of the filter covariances only agree to round-off"""
+    P = np.empty((len(packed), 15, 15))
+    P[:, TRIANGLE_IDX[0], TRIANGLE_IDX[1]] = packed
+    P[:, TRIANGLE_IDX[1], TRIANGLE_IDX[0]] = packed
+    return P
+
+
+class FullSink:
+    """Keeps x_pred, x_est (N,16) and P_est (N,15,15) in memory
+
+    Subclasses change how the covariances are stored with covariance_shape
+    and pack, and where the arrays live with allocate.
+    """
+    covariance_shape = (15, 15)
+
+    def open(self, N: int) -> None:
+        """Allocate the histories of a run of N samples"""
+        self.x_pred = self.allocate("x_pred", (N, 16))
+        self.x_est = self.allocate("x_est", (N, 16))
+        self.P_est = self.allocate("P_est", (N, *self.covariance_shape))
+
+    def allocate(self, name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        return np.zeros(shape)
+
+    def pack(self, P: np.ndarray) -> np.ndarray:
+        """The stored form of the covariances of a block (n,15,15)"""
+        return P
+
+    def write(self, block) -> None:
+        """Store an ESKFBlock, the block arrays are not kept"""
+        rows = slice(block.start, block.stop)
+        self.x_pred[rows] = block.x_pred
+        self.x_est[rows] = block.x_est
+        self.P_est[rows] = self.pack(block.P_est)
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(x_pred, x_est, P_est) of the run"""
+        return self.x_pred, self.x_est, self.P_est
+
+    def cache_key(self) -> tuple:
+        """The constructor arguments, which with the class identify the sink
+        in the run keys of sweep.py, unlike the histories of a used sink"""
+        return ()
+
+
+class DiagonalSink(FullSink):
+    """Keeps only the variances, P_est (N,15)"""
+    covariance_shape = (15,)
+
+    def pack(self, P: np.ndarray) -> np.ndarray:
+        return np.diagonal(P, axis1=1, axis2=2)
+
+
+class PackedTriangularSink(FullSink):
+    """Keeps the upper triangles, P_est (N,120), see unpack_covariances"""
+    covariance_shape = (len(TRIANGLE_IDX[0]),)
+
+    def pack(self, P: np.ndarray) -> np.ndarray:
+        return P[:, TRIANGLE_IDX[0], TRIANGLE_IDX[1]]
+
+
+class MemmapSink(FullSink):
+    """Streams the full histories to x_pred.npy, x_est.npy and P_est.npy in
+    directory, through numpy.memmap
+
+    The result arrays are the memory maps, and the files can be opened again
+    with np.load(..., mmap_mode="r"). With resume=True existing files are
+    opened for writing instead of overwritten, to continue a run from a
+    checkpoint, see stream_eskf.
+    """
+
+    def __init__(self, directory: str, resume: bool = False):
+        self.directory = directory
+        self.resume = resume
+
+    def cache_key(self) -> tuple:
+        return (self.directory, self.resume)
+
+    def allocate(self, name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name + ".npy")
+        if self.resume and os.path.exists(path):
+            history = np.load(path, mmap_mode="r+")
+            assert history.shape == shape, (
+                f"MemmapSink: {path} has shape {history.shape}, expected {shape}")
+            return history
+        return np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=shape)
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        for history in (self.x_pred, self.x_est, self.P_est):
+            history.flush()
+        return super().result()
+
+
+class DecimatedSink:
+    """Passes the samples 0, every, 2 every, ... on to another sink, whose
+    row j is then sample j * every"""
+
+    def __init__(self, sink: FullSink, every: int):
+        assert every > 0, f"DecimatedSink: every must be positive: {every}"
+        self.sink = sink
+        self.every = every
+
+    def open(self, N: int) -> None:
+        self.sink.open(-(-N // self.every))
+
+    def write(self, block) -> None:
+        first = -block.start % self.every
+        rows = slice(first, block.stop - block.start, self.every)
+        count = len(range(*rows.indices(block.stop - block.start)))
+        if count == 0:
+            return
+        start = (block.start + first) // self.every
+        self.sink.write(replace(block,
+                                start=start,
+                                stop=start + count,
+                                x_pred=block.x_pred[rows],
+                                x_est=block.x_est[rows],
+                                P_est=block.P_est[rows]))
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return self.sink.result()
+
+    def cache_key(self) -> tuple:
+        return (self.sink, self.every)
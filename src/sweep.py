@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps of run_eskf with a result cache.
+
+run_sweep runs a list of configurations, e.g. from parameter_grid, over a
+process pool with run_monte_carlo. Each configuration is a dict of run_eskf
+keyword arguments that replace those of base_arguments. The results are
+stored in cache_folder under a hash of the dataset, the function and all
+its arguments, so running the sweep again, or a larger one, only computes
+the configurations that are not in the cache yet.
+
+The hash does not cover the code of the filter, so clear the cache folder
+after changing it.
+"""
+from dataclasses import dataclass
+import hashlib
+import itertools
+import os
+from typing import Any, Callable, Dict, List, Sequence
+
+import numpy as np
+
+from eskf_runner import run_eskf
+from monte_carlo import run_monte_carlo
+
+
+@dataclass
+class SweepPoint:
+    """Result of one configuration of run_sweep"""
+    # The configuration and the hash of its run, the name of its cache file
+    configuration: Dict[str, Any]
+    key: str
+    # What function returned, (x_pred, x_est, P_est, GNSSk) for run_eskf
+    result: Any
+    # Whether the result came from the cache
+    cached: bool
+    # Wall time of the run [s], None for cached results
+    elapsed: float = None
+
+
+def parameter_grid(**axes) -> List[Dict[str, Any]]:
+    """Configurations of every combination of the values of the axes, e.g.
+    parameter_grid(num_beacons=[4, 6], p_std=[p_small, p_large]), the last
+    axis varying fastest"""
+    names = list(axes)
+    return [dict(zip(names, values))
+            for values in itertools.product(*(axes[name] for name in names))]
+
+
+def _update_hash(digest, value) -> None:
+    """Feeds a canonical encoding of value to digest"""
+    if isinstance(value, (np.ndarray, np.generic)):
+        value = np.ascontiguousarray(value)
+        digest.update(f"ndarray {value.dtype.str} {value.shape};".encode())
+        digest.update(value.tobytes())
+    elif isinstance(value, dict):
+        digest.update(f"dict {len(value)};".encode())
+        for key in sorted(value):
+            _update_hash(digest, key)
+            _update_hash(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__} {len(value)};".encode())
+        for item in value:
+            _update_hash(digest, item)
+    elif value is None or isinstance(value, (bool, int, float, str, bytes, np.dtype)):
+        digest.update(f"{type(value).__name__} {value!r};".encode())
+    elif hasattr(value, "__qualname__"):
+        # Classes and functions by name
+        digest.update(f"{value.__module__}.{value.__qualname__};".encode())
+    elif hasattr(value, "cache_key"):
+        # Result sinks by their class and constructor arguments, the
+        # histories a used sink holds do not change the results of a run
+        _update_hash(digest, type(value))
+        _update_hash(digest, value.cache_key())
+    else:
+        _update_hash(digest, type(value))
+        _update_hash(digest, vars(value))
+
+
+def dataset_key(loaded_data: Dict[str, Any]) -> str:
+    """Hash of the data of loaded_data, without the header entries
+    (__header__, ...) of scipy.io.loadmat, which hold the creation time"""
+    digest = hashlib.sha256()
+    _update_hash(digest, {key: value for key, value in loaded_data.items()
+                          if not key.startswith("__")})
+    return digest.hexdigest()
+
+
+def run_key(data_key: str, function: Callable, run_arguments: Dict[str, Any]) -> str:
+    """Hash of a run of function on the dataset with hash data_key"""
+    digest = hashlib.sha256()
+    _update_hash(digest, (data_key, function, run_arguments))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Results stored as folder/<key>.npz
+
+    Results are tuples of arrays and numbers, such as those of run_eskf.
+    They are written to a temporary file first and moved into place, so an
+    interrupted sweep leaves no broken entries.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".npz")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def load(self, key: str) -> tuple:
+        with np.load(self.path(key)) as data:
+            values = [data[f"result_{i}"] for i in range(len(data.files))]
+        return tuple(value.item() if value.ndim == 0 else value for value in values)
+
+    def save(self, key: str, result: tuple) -> None:
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.path(key)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, **{f"result_{i}": value for i, value in enumerate(result)})
+        os.replace(temporary, path)
+
+
+def run_sweep(loaded_data: Dict[str, Any],
+              configurations: Sequence[Dict[str, Any]],
+              base_arguments: Dict[str, Any],
+              cache_folder: str,
+              processes: int = None,
+              function: Callable = run_eskf) -> List[SweepPoint]:
+    """
+    Description:
+        Runs function(loaded_data=loaded_data, **base_arguments,
+        **configuration) for every configuration that is not in the cache,
+        in parallel, and caches the results
+
+    Parameters
+    ----------
+    loaded_data : Loaded data matrix, as for run_eskf
+    configurations : Keyword arguments that differ between the runs, e.g.
+        parameter_grid(num_beacons=[4, 6, 8])
+    base_arguments : Keyword arguments of all runs, everything but loaded_data.
+        A compact sink, e.g. DiagonalSink(), keeps the cache small
+    cache_folder : Folder of the result cache
+    processes : int, optional
+        Number of worker processes, see run_monte_carlo
+    function : callable, optional
+        Module level function to run. The default is run_eskf.
+
+    Returns
+    -------
+    points : list of SweepPoint
+        In the order of configurations
+
+    """
+    cache = ResultCache(cache_folder)
+    data_key = dataset_key(loaded_data)
+    runs = [dict(base_arguments, **configuration) for configuration in configurations]
+    keys = [run_key(data_key, function, run_arguments) for run_arguments in runs]
+
+    # Configurations repeated in the sweep run once
+    missing = list(dict.fromkeys(key for key in keys if key not in cache))
+    computed = {}
+    if missing:
+        missing_runs = [runs[keys.index(key)] for key in missing]
+        for key, run in zip(missing, run_monte_carlo(loaded_data, missing_runs,
+                                                     processes=processes,
+                                                     function=function)):
+            cache.save(key, run.result)
+            computed[key] = run
+
+    points = []
+    for configuration, key in zip(configurations, keys):
+        if key in computed:
+            run = computed[key]
+            points.append(SweepPoint(configuration, key, run.result, False, run.elapsed))
+        else:
+            points.append(SweepPoint(configuration, key, cache.load(key), True))
+    return points
@@ -6,4 +6,24 @@ Created on Sat Apr 17 14:20:10 2021
 """
 
 import case_checker
-
+import discretization_checker
+import pseudorange_checker
+import index_checker
+import numba_checker
+import imu_preprocessing_checker
+import preintegration_checker
+import schedule_checker
+import stream_checker
+import result_sink_checker
+import checkpoint_checker
+import monte_carlo_checker
+import sweep_checker
+import benchmark_suite_checker
+import profiling_checker
+import validation_checker
+import quaternion_batch_checker
+import imu_model_checker
+import cov_interval_checker
+import batch_checker
+import sqrt_checker
+import euler_integration_checker
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the stacked runs of run_eskf_batch are serial run_eskf runs
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_runner import run_eskf, run_eskf_batch
+from synthetic_log import ESKF_PARAMETERS, P_STD, initial_state, make_data
+
+
+class TestBatchESKF(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(8)
+        self.data = make_data(rng)
+        self.N = self.data["timeIMU"].shape[1]
+        # A different initial state for each run
+        x_init, self.P_init = initial_state()
+        self.x_init = np.tile(x_init, (3, 1))
+        self.x_init[:, :6] += rng.normal(0, [1, 1, 1, 0.5, 0.5, 0.5], (3, 6))
+        attitude = rng.normal([1, 0, 0, 0], 0.1, (3, 4))
+        self.x_init[:, 6:10] = attitude / np.linalg.norm(attitude, axis=1, keepdims=True)
+        self.parameters = ESKF_PARAMETERS
+        self.p_std = P_STD
+
+    def test_same_as_serial(self):
+        for pseudoranges in ((True, False), (False, True)):
+            # The discretization of run_eskf
+            x_est, P_est_diag, GNSSk = run_eskf_batch(
+                self.N, self.data, self.parameters, self.x_init, self.P_init,
+                self.p_std, 4, *pseudoranges, num_runs=len(self.x_init),
+                doGNSS=True, debug=False, discretization="van_loan")
+            self.assertEqual(x_est.shape, (self.N, 3, 16))
+            for run, x_init in enumerate(self.x_init):
+                serial = run_eskf(self.N, self.data, self.parameters, x_init, self.P_init,
+                                  self.p_std, 4, *pseudoranges, doGNSS=True, debug=False)
+                self.assertEqual(GNSSk, serial[3])
+                np.testing.assert_allclose(x_est[:, run], serial[1], rtol=0, atol=1e-10)
+                np.testing.assert_allclose(P_est_diag[:, run],
+                                           np.diagonal(serial[2], axis1=1, axis2=2),
+                                           rtol=1e-9, atol=1e-15)
+
+
+if __name__ == '__main__':
+    unittest.main()
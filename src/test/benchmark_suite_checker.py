@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the JSON results of the benchmark suite and the baseline comparison
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+sys.path.append(os.path.join(parentdir, "benchmarks"))
+
+import json
+import tempfile
+
+import numpy as np
+import unittest
+
+from bench_suite import Benchmark, compare, main, micro_benchmarks, run_suite
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+
+    def test_results(self):
+        benchmarks = micro_benchmarks(np.random.default_rng(0))
+        names = [benchmark.name for benchmark in benchmarks]
+        self.assertEqual(len(names), len(set(names)))
+
+        results = run_suite([Benchmark("sum", lambda: sum(range(100)), 10)],
+                            repeat=2, verbose=False)
+        results = json.loads(json.dumps(results))
+        self.assertLessEqual(results["results"]["sum"]["min"],
+                             results["results"]["sum"]["median"])
+        self.assertIn("numpy", results["environment"])
+
+    def test_compare(self):
+        baseline = {"results": {"a": {"min": 1.0}, "b": {"min": 1.0}, "c": {"min": 1.0}}}
+        results = {"results": {"a": {"min": 1.2}, "b": {"min": 1.5}, "d": {"min": 9.0}}}
+        regressions = compare(results, baseline, tolerance=0.25)
+        self.assertEqual([regression["name"] for regression in regressions], ["b"])
+        self.assertAlmostEqual(regressions[0]["ratio"], 1.5)
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as folder:
+            baseline = os.path.join(folder, "baseline.json")
+            arguments = ["--quick", "--repeat", "1", "--filter", "quaternion_product"]
+            self.assertEqual(main(arguments + ["--save-baseline", baseline]), 0)
+            with open(baseline) as file:
+                stored = json.load(file)
+            self.assertEqual(list(stored["results"]), ["quaternion_product"])
+
+            # Make the baseline 10 times faster than the code
+            stored["results"]["quaternion_product"]["min"] /= 10
+            with open(baseline, "w") as file:
+                json.dump(stored, file)
+            self.assertEqual(main(arguments + ["--baseline", baseline]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
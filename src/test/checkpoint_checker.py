@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that a run resumed from a checkpoint matches an uninterrupted run
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import tempfile
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_runner import run_eskf, stream_eskf
+from checkpoint import load_checkpoint
+from result_sinks import MemmapSink
+from synthetic_log import simulated_run
+
+
+class CrashingSink(MemmapSink):
+    """MemmapSink that fails when it gets to sample crash"""
+
+    def __init__(self, directory, crash):
+        super().__init__(directory)
+        self.crash = crash
+
+    def write(self, block):
+        if block.stop > self.crash:
+            raise RuntimeError("crash")
+        super().write(block)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.arguments = simulated_run(8, T=6.05)
+
+    def test_resume(self):
+        for sqrt_covariance in (False, True):
+            full = run_eskf(**self.arguments, doGNSS=True, debug=False,
+                            sqrt_covariance=sqrt_covariance)
+
+            with tempfile.TemporaryDirectory() as directory:
+                checkpoint = os.path.join(directory, "run.npz")
+                with self.assertRaises(RuntimeError):
+                    run_eskf(**self.arguments, doGNSS=True, debug=False,
+                             sqrt_covariance=sqrt_covariance,
+                             sink=CrashingSink(directory, crash=480),
+                             checkpoint=checkpoint, checkpoint_interval=2.)
+                self.assertEqual(load_checkpoint(checkpoint).sample, 450)
+
+                resumed = run_eskf(**self.arguments, doGNSS=True, debug=False,
+                                   sqrt_covariance=sqrt_covariance,
+                                   sink=MemmapSink(directory, resume=True),
+                                   checkpoint=checkpoint, checkpoint_interval=2.,
+                                   resume=True)
+                for history, resumed_history in zip(full, resumed):
+                    np.testing.assert_array_equal(resumed_history, history)
+                del resumed
+
+    def test_rng_state(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "run.npz")
+            rng = np.random.default_rng(9)
+            rng.normal(size=5)
+            state = rng.bit_generator.state
+            for _ in stream_eskf(**self.arguments, doGNSS=True, debug=False,
+                                 checkpoint=checkpoint, checkpoint_interval=1.,
+                                 rng=rng):
+                pass
+            self.assertEqual(load_checkpoint(checkpoint).rng_state, state)
+
+            rng.normal(size=5)
+            next(stream_eskf(**self.arguments, doGNSS=True, debug=False,
+                             checkpoint=checkpoint, resume=True, rng=rng))
+            self.assertEqual(rng.bit_generator.state, state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that propagating the covariance once per interval gives the covariance
+of the per sample recursion at the updates
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_runner import run_eskf, update_schedule
+from synthetic_log import make_data, run_arguments
+
+
+class TestCovarianceInterval(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_data(np.random.default_rng(12))
+        # Rotating at up to 2 rad/s, so the transitions of the samples of an
+        # interval differ
+        self.data["z_gyro"] = self.data["z_gyro"] + np.array([[2.], [-1.], [0.5]])
+        self.N = self.data["timeIMU"].shape[1]
+        self.updates, _ = update_schedule(self.data["timeIMU"].ravel(),
+                                          self.data["timeGNSS"].ravel(), self.N)
+
+    def test_updates(self):
+        for use_batch_pseudoranges in (True, False):
+            arguments = dict(loaded_data=self.data,
+                             **run_arguments(self.data,
+                                             use_batch_pseudoranges=use_batch_pseudoranges,
+                                             use_iterative_pseudoranges=not use_batch_pseudoranges))
+            for sqrt_covariance in (False, True):
+                reference = run_eskf(**arguments, doGNSS=True,
+                                     debug=False, sqrt_covariance=sqrt_covariance)
+                for cov_interval in (10, 100):
+                    x_pred, x_est, P_est, GNSSk = run_eskf(**arguments,
+                                                           doGNSS=True, debug=False,
+                                                           sqrt_covariance=sqrt_covariance,
+                                                           cov_interval=cov_interval)
+                    self.assertEqual(GNSSk, reference[3])
+                    # The nominal states do not depend on the interval
+                    np.testing.assert_array_equal(x_pred[:self.updates[0] + 1],
+                                                  reference[0][:self.updates[0] + 1])
+                    np.testing.assert_allclose(x_est[self.updates],
+                                               reference[1][self.updates],
+                                               rtol=0, atol=1e-10)
+                    np.testing.assert_allclose(P_est[self.updates],
+                                               reference[2][self.updates],
+                                               rtol=1e-9, atol=1e-15)
+
+
+if __name__ == '__main__':
+    unittest.main()
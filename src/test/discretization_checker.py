@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the series discretization of the error state dynamics against Van Loan
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_pseudoranges import (
+    ESKF,
+    van_loan_discretization,
+    taylor_discretization,
+    taylor_discretization_error_bound,
+)
+
+
+class TestDiscretization(unittest.TestCase):
+
+    def setUp(self):
+        self.eskf = ESKF(0.0583, 2.2e-6, 2.4e-3, 1.7e-6,
+                         p_acc=1e-6, p_gyro=1e-6, debug=False)
+        self.x_nominal = np.zeros(16)
+        quaternion = np.array([0.9, 0.1, -0.3, 0.2])
+        self.x_nominal[6:10] = quaternion / np.linalg.norm(quaternion)
+        self.acceleration = np.array([0.1, -0.2, -9.8])
+        self.omega = np.array([0.05, 0.02, 0.03])
+        self.Ts = 0.01
+
+    def test_taylor_within_bound(self):
+        A = self.eskf.Aerr(self.x_nominal, self.acceleration, self.omega)
+        G = self.eskf.Gerr(self.x_nominal)
+        GQGT = G @ self.eskf.Q_err @ G.T
+
+        Ad_vl, GQGd_vl = van_loan_discretization(A, GQGT, self.Ts)
+        for order in range(1, 7):
+            Ad, GQGd = taylor_discretization(A, GQGT, self.Ts, order)
+            Ad_bound, GQGd_bound = taylor_discretization_error_bound(
+                A, GQGT, self.Ts, order)
+
+            self.assertLessEqual(np.linalg.norm(Ad - Ad_vl, 1), Ad_bound)
+            self.assertLessEqual(np.linalg.norm(GQGd - GQGd_vl, 1), GQGd_bound)
+
+    def test_eskf_switch(self):
+        eskf_taylor = ESKF(0.0583, 2.2e-6, 2.4e-3, 1.7e-6,
+                           p_acc=1e-6, p_gyro=1e-6, debug=False,
+                           discretization="taylor")
+        Ad_vl, GQGd_vl = self.eskf.discrete_error_matrices(
+            self.x_nominal, self.acceleration, self.omega, self.Ts)
+        Ad, GQGd = eskf_taylor.discrete_error_matrices(
+            self.x_nominal, self.acceleration, self.omega, self.Ts)
+
+        np.testing.assert_allclose(Ad, Ad_vl, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(GQGd, GQGd_vl, rtol=1e-9, atol=1e-20)
+
+    def test_cached_noise_term(self):
+        # The cached GQGT * Ts is only reused while Ts stays the same
+        A = self.eskf.Aerr(self.x_nominal, self.acceleration, self.omega)
+        GQGT = self.eskf.GQGT_isotropic
+        for Ts in (self.Ts, self.Ts, 2 * self.Ts, self.Ts):
+            Ad, GQGd = self.eskf.discrete_error_matrices(
+                self.x_nominal, self.acceleration, self.omega, Ts)
+            Ad_vl, GQGd_vl = van_loan_discretization(A, GQGT, Ts)
+
+            np.testing.assert_array_equal(Ad, Ad_vl)
+            np.testing.assert_array_equal(GQGd, GQGd_vl)
+
+if __name__ == '__main__': unittest.main()
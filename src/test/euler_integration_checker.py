@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the Euler angle integration kernel of the data generator against the
+recursion with transf_mat
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from quaternion import integrate_euler_rates, transf_mat
+
+
+class TestEulerIntegration(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(16)
+        self.omega = rng.normal(0, 0.2, (2000, 3))
+        self.euler_init = np.array([0.1, -0.2, 0.3])
+        self.Ts = 0.01
+
+        self.expected = np.empty((len(self.omega) + 1, 3))
+        self.expected[0] = self.euler_init
+        for k, omega in enumerate(self.omega):
+            self.expected[k + 1] = (self.expected[k]
+                                    + transf_mat(self.expected[k]) @ omega * self.Ts)
+
+    def test_same_as_transf_mat(self):
+        kernels = [integrate_euler_rates]
+        # The plain Python version the kernel falls back to without Numba
+        if hasattr(integrate_euler_rates, "py_func"):
+            kernels.append(integrate_euler_rates.py_func)
+        for kernel in kernels:
+            eul = kernel(self.euler_init, self.omega, self.Ts)
+            self.assertEqual(eul.shape, (len(self.omega) + 1, 3))
+            np.testing.assert_allclose(eul, self.expected, rtol=0, atol=1e-13)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the batch IMU sensor model against the per sample model
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+from unittest import mock
+
+from IMU import z_acc, z_acc_batch, z_gyro, z_gyro_batch
+
+
+class TestIMUModel(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(9)
+        self.acc = rng.normal(0, 0.5, (200, 3))
+        self.omega = rng.normal(0, 0.05, (200, 3))
+        self.acc_bias = np.array([-0.00875, -0.00875, 0.00690]) + rng.normal(0, 0.004, (200, 3))
+        self.gyro_bias = np.array([-9.5e-4, -7.3e-4, 3.7e-4])
+        self.g = np.array([0, 0, 9.82])
+
+    def test_same_as_single(self):
+        # Without noise the batch model is the per sample model
+        with mock.patch("numpy.random.normal", return_value=0.):
+            acc_single = np.array([z_acc(None, self.g, acc, bias)
+                                   for acc, bias in zip(self.acc, self.acc_bias)])
+            gyro_single = np.array([z_gyro(omega, self.gyro_bias) for omega in self.omega])
+
+        rng = np.random.default_rng(0)
+        np.testing.assert_array_equal(
+            z_acc_batch(self.acc, self.g, rng, self.acc_bias, noise_std=0.), acc_single)
+        np.testing.assert_array_equal(
+            z_gyro_batch(self.omega, rng, self.gyro_bias, noise_std=0.), gyro_single)
+
+    def test_seeded_noise(self):
+        noise = np.random.default_rng(3).normal(0, 0.001, (200, 3))
+        expected = np.round((self.acc - self.g) + self.acc_bias + noise, 7)
+        np.testing.assert_array_equal(
+            z_acc_batch(self.acc, self.g, np.random.default_rng(3), self.acc_bias), expected)
+
+        first = z_gyro_batch(self.omega, np.random.default_rng(5), noise_std=[1e-3, 2e-3, 0])
+        np.testing.assert_array_equal(
+            first, z_gyro_batch(self.omega, np.random.default_rng(5), noise_std=[1e-3, 2e-3, 0]))
+        np.testing.assert_array_equal(first[:, 2], np.round(self.omega[:, 2], 7))
+
+    def test_scale_factor(self):
+        scale_factor = np.eye(3) + np.random.default_rng(2).normal(0, 1e-2, (3, 3))
+        z = z_gyro_batch(self.omega, np.random.default_rng(1), self.gyro_bias,
+                         noise_std=0., scale_factor=scale_factor, decimals=None)
+        # The filter corrects with S_g, the inverse of the scale factor
+        S_g = np.linalg.inv(scale_factor)
+        np.testing.assert_allclose((z - self.gyro_bias) @ S_g.T, self.omega, atol=1e-15)
+
+        with self.assertRaises(AssertionError):
+            z_acc_batch(self.acc[0], self.g, np.random.default_rng(1))
+        with self.assertRaises(AssertionError):
+            z_acc_batch(self.acc, self.g, np.random.default_rng(1), scale_factor=np.eye(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
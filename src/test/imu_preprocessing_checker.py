@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the vectorized IMU preprocessing against per sample corrections
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_pseudoranges import ESKF
+from imu_preprocessing import preprocess_imu
+
+
+class TestIMUPreprocessing(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        self.time = np.cumsum(rng.uniform(0.009, 0.011, 40))
+        # Transposed like the loaded data in run_eskf
+        self.z_acc = rng.normal(0, 1, (3, 40)).T
+        self.z_gyro = rng.normal(0, 0.1, (3, 40)).T
+        self.S_a = np.eye(3) + rng.normal(0, 1e-2, (3, 3))
+        self.S_g = np.eye(3) + rng.normal(0, 1e-2, (3, 3))
+
+    def test_scaling_and_sampling_times(self):
+        imu = preprocess_imu(self.time, self.z_acc, self.z_gyro,
+                             self.S_a, self.S_g, start=5)
+
+        self.assertEqual(len(imu), 35)
+        for array in (imu.time, imu.Ts, imu.acceleration, imu.rate):
+            self.assertTrue(array.flags.c_contiguous)
+            self.assertEqual(array.dtype, np.float64)
+
+        Ts_IMU = [0, *np.diff(self.time)][5:]
+        np.testing.assert_allclose(imu.Ts, Ts_IMU, rtol=0, atol=1e-15)
+        for k in range(len(imu)):
+            np.testing.assert_allclose(imu.acceleration[k], self.S_a @ self.z_acc[5 + k],
+                                       rtol=0, atol=1e-14)
+            np.testing.assert_allclose(imu.rate[k], self.S_g @ self.z_gyro[5 + k],
+                                       rtol=0, atol=1e-14)
+
+    def test_increments(self):
+        imu = preprocess_imu(self.time, self.z_acc, self.z_gyro, self.S_a, self.S_g)
+        delta_velocity, delta_angle = imu.increments()
+        np.testing.assert_allclose(delta_velocity[3], imu.acceleration[3] * imu.Ts[3])
+        np.testing.assert_allclose(delta_angle[3], imu.rate[4] * imu.Ts[3])
+
+        boundaries = np.array([0, 10, 25])
+        Ts, interval_velocity, interval_angle = imu.interval_increments(boundaries)
+        np.testing.assert_allclose(Ts[1], self.time[24] - self.time[9])
+        np.testing.assert_allclose(interval_velocity[2], delta_velocity[25:].sum(axis=0))
+        np.testing.assert_allclose(interval_angle[0], delta_angle[:10].sum(axis=0))
+
+    def test_prescaled_predict(self):
+        eskf = ESKF(0.0583, 2.2e-6, 2.4e-3, 1.7e-6, S_a=self.S_a, S_g=self.S_g,
+                    debug=False)
+        imu = preprocess_imu(self.time, self.z_acc, self.z_gyro, self.S_a, self.S_g)
+        x_nominal = np.zeros(16)
+        x_nominal[6] = 1
+        x_nominal[10:] = 1e-3
+        P = np.eye(15) * 1e-2
+
+        x_pred, P_pred = eskf.predict(x_nominal, P, self.z_acc[2], self.z_gyro[3],
+                                      imu.Ts[2])
+        x_prescaled, P_prescaled = eskf.predict(x_nominal, P, imu.acceleration[2],
+                                                imu.rate[3], imu.Ts[2], prescaled=True)
+        np.testing.assert_allclose(x_prescaled, x_pred, rtol=0, atol=1e-14)
+        np.testing.assert_allclose(P_prescaled, P_pred, rtol=0, atol=1e-14)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that compiled indices select the same entries as the CatSlice indices
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from cat_slice import CatSlice, IndexPlan, compile_index
+from eskf_pseudoranges import (
+    IDX,
+    POS_IDX,
+    VEL_IDX,
+    ACC_BIAS_IDX,
+    GYRO_BIAS_IDX,
+    ERR_ATT_IDX,
+    ERR_ACC_BIAS_IDX,
+    ERR_GYRO_BIAS_IDX,
+)
+
+
+class TestIndexPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.arange(16.)
+        self.A = np.arange(225.).reshape(15, 15)
+
+    def test_contiguous_is_view(self):
+        index = compile_index(POS_IDX + VEL_IDX)
+        self.assertEqual(index, slice(0, 6, 1))
+        self.assertTrue(np.shares_memory(self.x[index], self.x))
+        
+        block = compile_index(VEL_IDX * ERR_ATT_IDX)
+        self.assertTrue(np.shares_memory(self.A[block], self.A))
+
+    def test_same_entries(self):
+        for index in (POS_IDX, POS_IDX + VEL_IDX + ACC_BIAS_IDX + GYRO_BIAS_IDX,
+                      CatSlice(input_array=[1, 4, 9]), CatSlice(start=2, stop=3)):
+            np.testing.assert_array_equal(self.x[compile_index(index)], self.x[index])
+        
+        for block in (VEL_IDX * ERR_ACC_BIAS_IDX, ERR_GYRO_BIAS_IDX ** 2,
+                      (POS_IDX + ERR_ACC_BIAS_IDX) * VEL_IDX):
+            np.testing.assert_array_equal(self.A[compile_index(block)], self.A[block])
+
+    def test_plan(self):
+        plan = IndexPlan(pos=POS_IDX, vel_err_att=VEL_IDX * ERR_ATT_IDX)
+        np.testing.assert_array_equal(self.x[plan.pos], self.x[POS_IDX])
+        np.testing.assert_array_equal(self.A[plan.vel_err_att],
+                                      self.A[VEL_IDX * ERR_ATT_IDX])
+        
+        np.testing.assert_array_equal(
+            self.x[IDX.additive],
+            self.x[POS_IDX + VEL_IDX + ACC_BIAS_IDX + GYRO_BIAS_IDX])
+        np.testing.assert_array_equal(
+            self.x[IDX.err_additive],
+            self.x[POS_IDX + VEL_IDX + ERR_ACC_BIAS_IDX + ERR_GYRO_BIAS_IDX])
+
+
+if __name__ == '__main__':
+    unittest.main()
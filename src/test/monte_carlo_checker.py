@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the process pool Monte Carlo runs against serial run_eskf
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+from multiprocessing import get_all_start_methods, shared_memory
+
+import numpy as np
+import numpy.testing
+import unittest
+import warnings
+
+from eskf_runner import run_eskf
+from monte_carlo import (
+    BLAS_THREAD_VARIABLES,
+    THREADPOOLCTL_AVAILABLE,
+    SharedData,
+    run_monte_carlo,
+)
+from result_sinks import DiagonalSink
+from synthetic_log import make_data, run_arguments
+
+
+def worker_state(loaded_data):
+    """What a worker sees of the data and its environment"""
+    return ({key: value.flags.writeable for key, value in loaded_data.items()
+             if isinstance(value, np.ndarray)},
+            {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES},
+            loaded_data["timeIMU"].sum())
+
+
+class TestMonteCarlo(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_data(np.random.default_rng(9))
+        self.run_arguments = dict(run_arguments(self.data), doGNSS=True, debug=False)
+
+    def test_runs(self):
+        # The offset runs start 50 samples into the data
+        runs = [dict(self.run_arguments, N=self.run_arguments["N"] - 60,
+                     offset=offset, sink=DiagonalSink())
+                for offset in (0., 0.5, 0., 0.5)]
+        results = run_monte_carlo(self.data, runs, processes=2)
+
+        self.assertEqual([run.index for run in results], [0, 1, 2, 3])
+        for run, run_arguments in zip(results, runs):
+            self.assertGreater(run.elapsed, 0)
+            expected = run_eskf(loaded_data=self.data, **run_arguments)
+            for value, expected_value in zip(run.result, expected):
+                np.testing.assert_array_equal(value, expected_value)
+
+    def test_workers(self):
+        results = run_monte_carlo(self.data, [{}] * 2, processes=2,
+                                  function=worker_state)
+        for run in results:
+            writeable, environment, time_sum = run.result
+            self.assertEqual(set(writeable), set(self.data))
+            self.assertFalse(any(writeable.values()))
+            self.assertEqual(set(environment.values()), {"1"})
+            self.assertEqual(time_sum, self.data["timeIMU"].sum())
+
+    @unittest.skipIf(THREADPOOLCTL_AVAILABLE or "fork" not in get_all_start_methods(),
+                     "forked workers are pinned with threadpoolctl")
+    def test_unpinned_warning(self):
+        with self.assertWarns(RuntimeWarning):
+            run_monte_carlo(self.data, [{}], processes=1, function=worker_state,
+                            start_method="fork")
+        # The default falls back to spawned workers, which are pinned
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            run_monte_carlo(self.data, [{}], processes=1, function=worker_state)
+
+    def test_close(self):
+        with SharedData(self.data) as shared:
+            names = [name for name, _, _ in shared.arrays.values()]
+        for name in names:
+            with self.assertRaises(FileNotFoundError):
+                shared_memory.SharedMemory(name=name)
+
+
+if __name__ == '__main__':
+    unittest.main()
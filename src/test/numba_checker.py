@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the compiled NumbaESKF kernels against the NumPy ESKF
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_pseudoranges import ESKF
+from eskf_numba import NumbaESKF, NUMBA_AVAILABLE
+
+
+@unittest.skipUnless(NUMBA_AVAILABLE, "numba is not installed")
+class TestNumbaESKF(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        parameters = (0.0583, 2.2e-6, 2.4e-3, 1.7e-6, 1e-6, 1e-6)
+        S_a = np.eye(3) + rng.normal(0, 1e-3, (3, 3))
+        S_g = np.eye(3) + rng.normal(0, 1e-3, (3, 3))
+        self.eskf = ESKF(*parameters, S_a=S_a, S_g=S_g, debug=False,
+                         discretization="taylor")
+        self.numba_eskf = NumbaESKF(*parameters, S_a=S_a, S_g=S_g, debug=False)
+
+        self.x_nominal = np.zeros(16)
+        self.x_nominal[:6] = [10, 40, 1, 1, 2, 0]
+        quaternion = rng.normal(size=4)
+        self.x_nominal[6:10] = quaternion / np.linalg.norm(quaternion)
+        self.x_nominal[10:] = rng.normal(0, 1e-3, 6)
+
+        A = rng.normal(size=(15, 15))
+        self.P = A @ A.T * 1e-2 + np.eye(15) * 1e-3
+
+        self.z_acc = rng.normal(0, 0.5, (50, 3)) + np.array([0, 0, -9.82])
+        self.z_gyro = rng.normal(0, 0.05, (50, 3))
+        self.Ts_IMU = np.full(50, 0.01)
+        self.b_loc = rng.uniform([-30, -10, -1], [30, 70, 5], (6, 3))
+        self.R_beacons = np.eye(6) * 0.03**2
+        self.z_GNSS = self.x_nominal[:3] + rng.normal(0, 0.05, 3)
+
+    def test_predict(self):
+        x_pred, P_pred = self.eskf.predict(self.x_nominal, self.P,
+                                           self.z_acc[0], self.z_gyro[0], 0.01)
+        x_numba, P_numba = self.numba_eskf.predict(self.x_nominal, self.P,
+                                                   self.z_acc[0], self.z_gyro[0], 0.01)
+        np.testing.assert_allclose(x_numba, x_pred, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(P_numba, P_pred, rtol=0, atol=1e-12)
+
+    def test_predict_segment(self):
+        N = len(self.z_acc)
+        x_est, x_pred = np.zeros((N, 16)), np.zeros((N, 16))
+        P_est, P_pred = np.zeros((N, 15, 15)), np.zeros((N, 15, 15))
+        x_est[0], P_est[0] = self.x_nominal, self.P
+        self.numba_eskf.predict_segment(x_est, P_est, x_pred, P_pred,
+                                        self.z_acc, self.z_gyro, self.Ts_IMU, 0, N)
+
+        x, P = self.x_nominal, self.P
+        for k in range(N - 1):
+            x, P = self.eskf.predict(x, P, self.z_acc[k], self.z_gyro[k + 1],
+                                     self.Ts_IMU[k])
+            np.testing.assert_allclose(x_est[k + 1], x, rtol=0, atol=1e-10)
+            np.testing.assert_allclose(P_est[k + 1], P, rtol=1e-10, atol=1e-12)
+
+    def test_pseudoranges(self):
+        for method in ("batch_pseudorange", "iterative_pseudorange"):
+            delta_x, P_update = getattr(self.eskf, method)(
+                self.x_nominal, self.z_GNSS, self.P, None, self.b_loc, self.R_beacons)
+            delta_x_numba, P_numba = getattr(self.numba_eskf, method)(
+                self.x_nominal, self.z_GNSS, self.P, None, self.b_loc, self.R_beacons)
+            np.testing.assert_allclose(delta_x_numba, np.ravel(delta_x), rtol=0, atol=1e-10)
+            np.testing.assert_allclose(P_numba, P_update, rtol=0, atol=1e-10)
+
+    def test_inject(self):
+        delta_x = np.random.default_rng(2).normal(0, 1e-2, 15)
+        x_injected, P_injected = self.eskf.inject(self.x_nominal, delta_x, self.P)
+        x_numba, P_numba = self.numba_eskf.inject(self.x_nominal, delta_x, self.P)
+        np.testing.assert_allclose(x_numba, x_injected, rtol=0, atol=1e-14)
+        np.testing.assert_allclose(P_numba, P_injected, rtol=0, atol=1e-14)
+
+
+if __name__ == '__main__':
+    unittest.main()
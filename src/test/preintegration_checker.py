@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the preintegrated interval prediction against sample by sample ESKF.predict
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_pseudoranges import ESKF
+from preintegration import PreintegratedESKF, preintegrate
+
+
+class TestPreintegration(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.parameters = (0.0583, 2.2e-6, 2.4e-3, 1.7e-6, 1e-3, 2e-3)
+        self.S_a = np.eye(3) + rng.normal(0, 1e-3, (3, 3))
+        self.S_g = np.eye(3) + rng.normal(0, 1e-3, (3, 3))
+
+        self.x_nominal = np.zeros(16)
+        self.x_nominal[:6] = [10, 40, 1, 1, 2, 0]
+        quaternion = rng.normal(size=4)
+        self.x_nominal[6:10] = quaternion / np.linalg.norm(quaternion)
+        self.x_nominal[10:] = rng.normal(0, 1e-2, 6)
+
+        A = rng.normal(size=(15, 15))
+        self.P = A @ A.T * 1e-2 + np.eye(15) * 1e-3
+
+        # Rotating fast, as in the maneuvers of the simulated data
+        self.z_acc = rng.normal(0, 0.5, (41, 3)) + np.array([0, 0, -9.82])
+        self.z_gyro = rng.normal(0, 0.5, (41, 3))
+        self.Ts = rng.uniform(0.009, 0.011, 40)
+
+    def test_predict_interval(self):
+        for discretization in ("van_loan", "taylor"):
+            eskf = ESKF(*self.parameters, S_a=self.S_a, S_g=self.S_g,
+                        debug=False, discretization=discretization)
+            preintegrated_eskf = PreintegratedESKF(*self.parameters,
+                                                   S_a=self.S_a, S_g=self.S_g,
+                                                   debug=False,
+                                                   discretization=discretization)
+
+            x_interval, P_interval = preintegrated_eskf.predict_interval(
+                self.x_nominal, self.P, self.z_acc[:-1], self.z_gyro[1:], self.Ts)
+
+            x, P = self.x_nominal, self.P
+            for k in range(len(self.Ts)):
+                x, P = eskf.predict(x, P, self.z_acc[k], self.z_gyro[k + 1], self.Ts[k])
+                np.testing.assert_allclose(x_interval[k], x, rtol=0, atol=1e-11)
+                np.testing.assert_allclose(P_interval[k], P, rtol=1e-9, atol=1e-12)
+
+    def test_bias_jacobians(self):
+        acceleration = self.z_acc[:-1] @ self.S_a.T
+        rate = self.z_gyro[1:] @ self.S_g.T
+        acc_bias, gyro_bias = self.x_nominal[10:13], self.x_nominal[13:]
+        preintegration = preintegrate(acceleration, rate, self.Ts,
+                                      acc_bias, gyro_bias, 1e-3, 2e-3)
+
+        rng = np.random.default_rng(4)
+        delta_acc_bias = rng.normal(0, 1e-4, 3)
+        delta_gyro_bias = rng.normal(0, 1e-4, 3)
+        exact = preintegrate(acceleration, rate, self.Ts,
+                             acc_bias + delta_acc_bias, gyro_bias + delta_gyro_bias,
+                             1e-3, 2e-3)
+
+        delta_velocity, delta_position, delta_quaternion = preintegration.corrected(
+            delta_acc_bias, delta_gyro_bias)
+        np.testing.assert_allclose(delta_velocity, exact.delta_velocity[-1],
+                                   rtol=0, atol=1e-13)
+        np.testing.assert_allclose(delta_position, exact.delta_position[-1],
+                                   rtol=0, atol=1e-13)
+        # Second order in the bias change
+        np.testing.assert_allclose(delta_quaternion, exact.delta_quaternion[-1],
+                                   rtol=0, atol=1e-9)
+
+    def test_coning(self):
+        # Coning motion, the rotation rate vector precesses about z
+        frequency, half_angle = 2 * np.pi, 0.1
+
+        def rate(time):
+            return np.column_stack((
+                -frequency * np.sin(half_angle) * np.sin(frequency * time),
+                frequency * np.sin(half_angle) * np.cos(frequency * time),
+                np.zeros_like(time)))
+
+        def angle(time):
+            return np.column_stack((
+                np.sin(half_angle) * np.cos(frequency * time),
+                np.sin(half_angle) * np.sin(frequency * time),
+                np.zeros_like(time)))
+
+        # Delta angle samples at 100 Hz against a 100 kHz reference
+        time = np.arange(101) * 0.01
+        Ts = np.diff(time)
+        rate_average = np.diff(angle(time), axis=0) / Ts[:, None]
+        time_fine = np.arange(100000) * 1e-5 + 0.5e-5
+        zeros = np.zeros(3)
+
+        fine = preintegrate(np.zeros((100000, 3)), rate(time_fine),
+                            np.full(100000, 1e-5), zeros, zeros)
+        plain = preintegrate(np.zeros((100, 3)), rate_average, Ts, zeros, zeros)
+        coning = preintegrate(np.zeros((100, 3)), rate_average, Ts, zeros, zeros,
+                              coning=True)
+
+        error_plain = np.abs(plain.delta_quaternion[-1] - fine.delta_quaternion[-1]).max()
+        error_coning = np.abs(coning.delta_quaternion[-1] - fine.delta_quaternion[-1]).max()
+        self.assertLess(error_coning, error_plain / 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the spans recorded by the profiler around the filter stages
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import json
+import tempfile
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_runner import run_eskf
+import profiling
+from profiling import Profiler, profiled, span
+from synthetic_log import simulated_run
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_spans(self):
+        @profiled("inner")
+        def inner():
+            return 1
+
+        outer = Profiler()
+        self.assertEqual(inner(), 1)
+        with outer:
+            with span("outer"):
+                inner()
+                nested = Profiler()
+                with nested:
+                    inner()
+                inner()
+        self.assertIsNone(profiling._active)
+        self.assertEqual(len(outer.durations["inner"]), 2)
+        self.assertEqual(len(nested.durations["inner"]), 1)
+
+        statistics = outer.statistics()
+        self.assertEqual(list(statistics), ["outer", "inner"])
+        self.assertEqual(statistics["inner"]["count"], 2)
+        self.assertLessEqual(statistics["inner"]["p50"], statistics["inner"]["p99"])
+        counts, edges = outer.histogram("inner", bins=4)
+        self.assertEqual(counts.sum(), 2)
+
+    def test_run(self):
+        arguments = simulated_run(11)
+
+        expected = run_eskf(**arguments, doGNSS=True, debug=False)
+        profiler = Profiler()
+        result = run_eskf(**arguments, doGNSS=True, debug=False, profiler=profiler)
+        for value, expected_value in zip(result, expected):
+            np.testing.assert_array_equal(value, expected_value)
+
+        statistics = profiler.statistics()
+        self.assertEqual(next(iter(statistics)), "run_eskf")
+        self.assertEqual(statistics["predict_nominal"]["count"], arguments["N"] - 1)
+        self.assertEqual(statistics["predict_covariance"]["count"], arguments["N"] - 1)
+        self.assertEqual(statistics["update_GNSS_position"]["count"], 3)
+        self.assertEqual(statistics["inject"]["count"], 3)
+        self.assertIn("predict_segment", profiler.report())
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "profile.json")
+            profiler.dump(path)
+            with open(path) as file:
+                self.assertEqual(json.load(file)["run_eskf"]["count"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
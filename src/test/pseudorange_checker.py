@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the column-sparse pseudorange updates against the full Joseph form
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import scipy.linalg as la
+import unittest
+
+from eskf_pseudoranges import ESKF
+
+
+def full_batch_update(pos_est, pos_meas, P, b_loc, R):
+    est_ranges = la.norm(b_loc - pos_est, axis=1)
+    v = la.norm(b_loc - pos_meas, axis=1) - est_ranges
+    H = np.zeros((len(b_loc), 15))
+    H[:, :3] = -(b_loc - pos_est) / est_ranges[:, None]
+    W = P @ H.T @ la.inv(H @ P @ H.T + R)
+    Jo = np.eye(15) - W @ H
+    return W @ v, Jo @ P @ Jo.T + W @ R @ W.T
+
+
+def full_iterative_update(pos_est, pos_meas, P, b_loc):
+    H = np.zeros((1, 15))
+    delta_x = np.zeros((15, 1))
+    for i in range(len(b_loc)):
+        z_hat_temp = la.norm(pos_est - b_loc[i])
+        H[0, :3] = (pos_est - b_loc[i]) / z_hat_temp
+        z_hat = z_hat_temp + H @ delta_x
+        z = la.norm(pos_meas - b_loc[i])
+        W = P @ H.T / (H @ P @ H.T + 1)
+        delta_x = delta_x + W * (z - z_hat)
+        Jo = np.eye(15) - W @ H
+        P = Jo @ P @ Jo.T + W * W.T
+    P_update = Jo @ P @ Jo.T + W @ W.T
+    return delta_x, (P_update + P_update.T) / 2
+
+
+class TestPseudorange(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(4550)
+        self.eskf = ESKF(0.0583, 2.2e-6, 2.4e-3, 1.7e-6, debug=False)
+        self.x_nominal = np.zeros(16)
+        self.x_nominal[:3] = np.array([10, 40, 1])
+        self.x_nominal[6] = 1
+        self.z_GNSS = self.x_nominal[:3] + rng.normal(0, 0.05, 3)
+        self.b_loc = rng.uniform([-30, -10, -1], [30, 70, 5], (15, 3))
+        A = rng.normal(size=(15, 15))
+        self.P = A @ A.T * 1e-2 + np.eye(15) * 1e-3
+        self.R_beacons = np.eye(15) * 0.03**2
+
+    def test_batch(self):
+        delta_x, P_update = self.eskf.batch_pseudorange(
+            self.x_nominal, self.z_GNSS, self.P, None, self.b_loc, self.R_beacons)
+        delta_x_ref, P_ref = full_batch_update(
+            self.x_nominal[:3], self.z_GNSS, self.P, self.b_loc, self.R_beacons)
+
+        np.testing.assert_allclose(delta_x, delta_x_ref, rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(P_update, P_ref, rtol=1e-9, atol=1e-12)
+
+    def test_iterative(self):
+        delta_x, P_update = self.eskf.iterative_pseudorange(
+            self.x_nominal, self.z_GNSS, self.P, None, self.b_loc, self.R_beacons)
+        delta_x_ref, P_ref = full_iterative_update(
+            self.x_nominal[:3], self.z_GNSS, self.P, self.b_loc)
+
+        np.testing.assert_allclose(delta_x, delta_x_ref, rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(P_update, P_ref, rtol=1e-9, atol=1e-12)
+
+if __name__ == '__main__': unittest.main()
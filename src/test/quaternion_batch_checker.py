@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the batch quaternion functions against the functions for single quaternions
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from quaternion import (
+    cross_product_matrices,
+    euler_to_quaternion,
+    euler_to_quaternions,
+    normalize_quaternions,
+    quaternion_conjugates,
+    quaternion_product,
+    quaternion_products,
+    quaternion_to_euler,
+    quaternion_to_rotation_matrix,
+    quaternions_to_euler,
+    quaternions_to_rotation_matrices,
+)
+
+
+class TestQuaternionBatch(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(14)
+        quaternions = rng.normal(size=(50, 4))
+        self.q = quaternions / np.linalg.norm(quaternions, axis=1, keepdims=True)
+        self.p = rng.normal(size=(50, 4))
+        self.vectors = rng.normal(size=(50, 3))
+        self.euler = rng.uniform([-np.pi, -np.pi / 2, -np.pi], [np.pi, np.pi / 2, np.pi],
+                                 (50, 3))
+
+    def test_same_as_single(self):
+        products = quaternion_products(self.q, self.p)
+        pure_products = quaternion_products(self.vectors, self.q)
+        rotations = quaternions_to_rotation_matrices(self.q)
+        euler = quaternions_to_euler(self.q)
+        quaternions = euler_to_quaternions(self.euler)
+        for k in range(len(self.q)):
+            np.testing.assert_array_equal(products[k], quaternion_product(self.q[k], self.p[k]))
+            np.testing.assert_array_equal(pure_products[k],
+                                          quaternion_product(self.vectors[k], self.q[k]))
+            np.testing.assert_array_equal(rotations[k],
+                                          quaternion_to_rotation_matrix(self.q[k]))
+            np.testing.assert_array_equal(euler[k], quaternion_to_euler(self.q[k]))
+            np.testing.assert_array_equal(quaternions[k], euler_to_quaternion(self.euler[k]))
+
+    def test_broadcasting(self):
+        products = quaternion_products(self.q[:, None], self.q[None, :5])
+        self.assertEqual(products.shape, (50, 5, 4))
+        np.testing.assert_array_equal(products[7, 3], quaternion_product(self.q[7], self.q[3]))
+        np.testing.assert_array_equal(quaternion_products(self.q, self.q[0]),
+                                      quaternion_products(self.q, np.tile(self.q[0], (50, 1))))
+        with self.assertRaises(RuntimeError):
+            quaternion_products(self.q, np.zeros((50, 5)))
+
+    def test_conjugate_and_normalize(self):
+        identity = quaternion_products(self.q, quaternion_conjugates(self.q))
+        np.testing.assert_allclose(identity, np.tile([1., 0, 0, 0], (50, 1)), atol=1e-15)
+        normalized = normalize_quaternions(self.p)
+        np.testing.assert_allclose(np.linalg.norm(normalized, axis=1), 1, rtol=0, atol=1e-15)
+        np.testing.assert_allclose(normalized * np.linalg.norm(self.p, axis=1)[:, None],
+                                   self.p, rtol=1e-15)
+
+    def test_rotations(self):
+        rotations = quaternions_to_rotation_matrices(self.q)
+        np.testing.assert_allclose(rotations @ np.swapaxes(rotations, 1, 2),
+                                   np.broadcast_to(np.eye(3), (50, 3, 3)), atol=1e-15)
+        np.testing.assert_allclose(cross_product_matrices(self.vectors) @ self.vectors[..., None],
+                                   np.zeros((50, 3, 1)), atol=1e-15)
+        np.testing.assert_allclose(quaternions_to_euler(euler_to_quaternions(self.euler)),
+                                   self.euler, atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
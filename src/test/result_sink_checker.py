@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the result sinks of run_eskf against the full histories
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import tempfile
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_runner import run_eskf
+from result_sinks import (
+    DecimatedSink,
+    DiagonalSink,
+    MemmapSink,
+    PackedTriangularSink,
+    covariance_diagonals,
+    unpack_covariances,
+)
+from synthetic_log import simulated_run
+
+
+class TestResultSinks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.arguments = simulated_run(7)
+        cls.full = run_eskf(**cls.arguments, doGNSS=True, debug=False)
+
+    def run_with(self, sink):
+        return run_eskf(**self.arguments, doGNSS=True, debug=False, sink=sink)
+
+    def test_diagonal(self):
+        x_pred, x_est, P_est, GNSSk = self.run_with(DiagonalSink())
+        np.testing.assert_array_equal(x_est, self.full[1])
+        np.testing.assert_array_equal(P_est, covariance_diagonals(self.full[2]))
+        self.assertEqual(GNSSk, self.full[3])
+
+    def test_packed_triangular(self):
+        P_est = self.run_with(PackedTriangularSink())[2]
+        self.assertEqual(P_est.shape, (len(self.full[2]), 120))
+        P_unpacked = unpack_covariances(P_est)
+        np.testing.assert_array_equal(np.triu(P_unpacked), np.triu(self.full[2]))
+        # The filter covariances are only symmetric to round-off
+        np.testing.assert_allclose(P_unpacked, self.full[2], rtol=1e-9, atol=1e-12)
+        np.testing.assert_array_equal(covariance_diagonals(P_est),
+                                      covariance_diagonals(self.full[2]))
+
+    def test_decimated(self):
+        for every in (1, 7, 100):
+            x_pred, x_est, P_est, _ = self.run_with(DecimatedSink(DiagonalSink(), every))
+            np.testing.assert_array_equal(x_pred, self.full[0][::every])
+            np.testing.assert_array_equal(x_est, self.full[1][::every])
+            np.testing.assert_array_equal(P_est,
+                                          covariance_diagonals(self.full[2])[::every])
+
+    def test_memmap(self):
+        with tempfile.TemporaryDirectory() as directory:
+            x_pred, x_est, P_est, _ = self.run_with(MemmapSink(directory))
+            np.testing.assert_array_equal(P_est, self.full[2])
+            del x_pred, x_est, P_est
+
+            P_est = np.load(os.path.join(directory, "P_est.npy"), mmap_mode="r")
+            np.testing.assert_array_equal(P_est, self.full[2])
+            del P_est
+
+
+if __name__ == '__main__':
+    unittest.main()
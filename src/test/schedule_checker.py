@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the GNSS update schedule of run_eskf against the per sample timestamp comparison
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_runner import update_schedule
+
+
+def per_sample_schedule(timeIMU, timeGNSS, N, first_epoch):
+    """The update test of the original run_eskf loop"""
+    samples, epochs = [], []
+    GNSSk = first_epoch
+    for k in range(N):
+        if GNSSk < len(timeGNSS) and timeIMU[k] >= timeGNSS[GNSSk]:
+            samples.append(k)
+            epochs.append(GNSSk)
+            GNSSk += 1
+    return np.array(samples, dtype=int), np.array(epochs, dtype=int)
+
+
+class TestUpdateSchedule(unittest.TestCase):
+
+    def test_against_per_sample(self):
+        rng = np.random.default_rng(5)
+        timeIMU = np.cumsum(rng.uniform(0.009, 0.011, 1000))
+        timeGNSS = np.sort(np.r_[np.arange(0.5, 10, 1.0),
+                                 # Epochs sharing an IMU sample, and a burst
+                                 # of them before the first sample
+                                 3.5001, 3.5002, -1, -0.5])
+
+        for N, first_epoch in ((1000, 0), (700, 0), (1000, 5), (1000, len(timeGNSS))):
+            samples, epochs = update_schedule(timeIMU, timeGNSS, N, first_epoch)
+            expected_samples, expected_epochs = per_sample_schedule(timeIMU, timeGNSS,
+                                                                    N, first_epoch)
+            np.testing.assert_array_equal(samples, expected_samples)
+            np.testing.assert_array_equal(epochs, expected_epochs)
+            self.assertTrue(np.all(np.diff(samples) > 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
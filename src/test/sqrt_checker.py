@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the square-root filter reproduces the full covariance filter
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_pseudoranges import ESKF, POS_IDX, VEL_IDX, ATT_IDX
+from eskf_sqrt import SqrtESKF
+
+# Largest relative difference between L @ L.T and P, in the Frobenius norm
+# and of each variance
+TOLERANCES = {np.float64: 1e-12, np.float32: 1e-5}
+VARIANCE_TOLERANCES = {np.float64: 1e-10, np.float32: 1e-4}
+
+
+class TestSqrtESKF(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(15)
+        self.x_nominal = np.zeros(16)
+        self.x_nominal[POS_IDX] = [10, 40, 1]
+        self.x_nominal[VEL_IDX] = [1, 0, 0]
+        quaternion = rng.normal(size=4)
+        self.x_nominal[ATT_IDX] = quaternion / np.linalg.norm(quaternion)
+        A = rng.normal(size=(15, 15)) * np.sqrt([9.] * 3 + [4.] * 3 + [0.25] * 3
+                                                + [1e-4] * 3 + [1e-6] * 3)[:, None]
+        self.P = A @ A.T / 15 + np.diag([1e-2] * 9 + [1e-6] * 3 + [1e-8] * 3)
+
+        self.acceleration = rng.normal(0, 0.5, 3) + np.array([0, 0, -9.82])
+        self.omega = rng.normal(0, 0.5, 3)
+        self.delta_x = rng.normal(0, 1e-2, 15)
+        self.b_loc = rng.uniform([-30, -10, -1], [30, 70, 5], (6, 3))
+        self.z_GNSS = self.x_nominal[POS_IDX] + rng.normal(0, 0.5, 3)
+        self.R_beacons = np.eye(6) * 0.03**2
+        self.parameters = [0.0583, 2.2e-6, 2.4e-3, 1.7e-6, 1e-6, 1e-6]
+
+    def assertCovariance(self, L, P, dtype):
+        self.assertEqual(L.dtype, dtype)
+        np.testing.assert_array_equal(L, np.tril(L))
+        covariance = SqrtESKF.covariance(L)
+        error = np.linalg.norm(covariance - P) / np.linalg.norm(P)
+        self.assertLess(error, TOLERANCES[dtype])
+        np.testing.assert_allclose(np.diag(covariance), np.diag(P),
+                                   rtol=VARIANCE_TOLERANCES[dtype], atol=0)
+
+    def test_same_as_full(self):
+        eskf = ESKF(*self.parameters, debug=False)
+        for dtype in (np.float64, np.float32):
+            with self.subTest(dtype=dtype):
+                sqrt_eskf = SqrtESKF(*self.parameters, debug=False, dtype=dtype)
+                L = SqrtESKF.factor(self.P, dtype)
+                self.assertCovariance(L, self.P, dtype)
+
+                P_pred = eskf.predict_covariance(self.x_nominal, self.P,
+                                                 self.acceleration, self.omega, 0.01)
+                L_pred = sqrt_eskf.predict_covariance(self.x_nominal, L,
+                                                      self.acceleration, self.omega, 0.01)
+                self.assertCovariance(L_pred, P_pred, dtype)
+
+                for update in ("batch_pseudorange", "iterative_pseudorange"):
+                    arguments = (self.x_nominal, self.z_GNSS)
+                    beacons = (None, self.b_loc, self.R_beacons)
+                    delta_x, P_update = getattr(eskf, update)(*arguments, P_pred, *beacons)
+                    delta_x_sqrt, L_update = getattr(sqrt_eskf, update)(*arguments, L_pred,
+                                                                        *beacons)
+                    self.assertCovariance(L_update, P_update, dtype)
+                    np.testing.assert_allclose(delta_x_sqrt, np.ravel(delta_x),
+                                               rtol=0, atol=VARIANCE_TOLERANCES[dtype])
+
+                x_injected, P_injected = eskf.inject(self.x_nominal, self.delta_x, self.P)
+                x_injected_sqrt, L_injected = sqrt_eskf.inject(self.x_nominal, self.delta_x, L)
+                np.testing.assert_array_equal(x_injected_sqrt, x_injected)
+                self.assertCovariance(L_injected, P_injected, dtype)
+
+                x_chained, P_chained = eskf.update_GNSS_position(
+                    self.x_nominal, P_pred, self.z_GNSS, np.eye(3), self.R_beacons, self.b_loc,
+                    True, False, np.zeros(3))
+                x_chained_sqrt, L_chained = sqrt_eskf.update_GNSS_position(
+                    self.x_nominal, L_pred, self.z_GNSS, np.eye(3), self.R_beacons, self.b_loc,
+                    True, False, np.zeros(3))
+                np.testing.assert_allclose(x_chained_sqrt, x_chained,
+                                           rtol=0, atol=VARIANCE_TOLERANCES[dtype])
+                self.assertCovariance(L_chained, P_chained, dtype)
+
+
+if __name__ == '__main__':
+    unittest.main()
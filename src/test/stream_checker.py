@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the blocks of stream_eskf put together are the run_eskf histories
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_runner import run_eskf, stream_eskf
+from synthetic_log import simulated_run
+
+
+class TestStreamESKF(unittest.TestCase):
+
+    def setUp(self):
+        self.arguments = simulated_run(6)
+
+    def test_blocks(self):
+        for doGNSS in (True, False):
+            for cov_interval in (1, 3):
+                x_pred, x_est, P_est, GNSSk = run_eskf(**self.arguments,
+                                                       doGNSS=doGNSS,
+                                                       debug=False,
+                                                       cov_interval=cov_interval)
+                start = 0
+                for block in stream_eskf(**self.arguments, doGNSS=doGNSS,
+                                         debug=False, cov_interval=cov_interval,
+                                         block_size=7):
+                    self.assertEqual(block.start, start)
+                    self.assertLessEqual(block.stop - block.start, 9)
+                    np.testing.assert_array_equal(block.x_pred, x_pred[block.start:block.stop])
+                    np.testing.assert_array_equal(block.x_est, x_est[block.start:block.stop])
+                    np.testing.assert_array_equal(block.P_est, P_est[block.start:block.stop])
+                    start = block.stop
+                self.assertEqual(start, self.arguments["N"])
+                self.assertEqual(block.GNSSk, GNSSk)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that parameter sweeps compute each configuration once and reuse the cache
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import tempfile
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_runner import run_eskf
+from result_sinks import DecimatedSink, DiagonalSink, FullSink
+from synthetic_log import make_data, run_arguments
+from sweep import dataset_key, parameter_grid, run_key, run_sweep
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_data(np.random.default_rng(10))
+        self.base_arguments = dict(run_arguments(self.data), doGNSS=True, debug=False,
+                                   sink=DiagonalSink())
+
+    def test_grid(self):
+        grid = parameter_grid(num_beacons=[4, 6], cov_interval=[1, 3, 5])
+        self.assertEqual(len(grid), 6)
+        self.assertEqual(grid[1], {"num_beacons": 4, "cov_interval": 3})
+
+    def test_keys(self):
+        data_key = dataset_key(self.data)
+        self.assertEqual(data_key, dataset_key(dict(self.data, __header__=b"other")))
+        changed = dict(self.data, z_GNSS=self.data["z_GNSS"] + 1e-12)
+        self.assertNotEqual(data_key, dataset_key(changed))
+
+        key = run_key(data_key, run_eskf, self.base_arguments)
+        self.assertEqual(key, run_key(data_key, run_eskf, dict(self.base_arguments)))
+        for change in (dict(num_beacons=5),
+                       dict(p_std=np.array([.01, .01, .02])),
+                       dict(sink=None),
+                       dict(sink=FullSink()),
+                       dict(sink=DecimatedSink(DiagonalSink(), 2))):
+            self.assertNotEqual(key, run_key(data_key, run_eskf,
+                                             dict(self.base_arguments, **change)))
+
+        # The histories a used sink holds do not enter the key
+        run_eskf(loaded_data=self.data, **self.base_arguments)
+        self.assertEqual(key, run_key(data_key, run_eskf, self.base_arguments))
+
+    def test_cache(self):
+        configurations = parameter_grid(num_beacons=[4, 6],
+                                        p_std=[np.array([.01, .01, .03]),
+                                               np.array([.1, .1, .3])])
+        with tempfile.TemporaryDirectory() as folder:
+            first = run_sweep(self.data, configurations, self.base_arguments,
+                              folder, processes=2)
+            self.assertFalse(any(point.cached for point in first))
+            self.assertEqual(len(os.listdir(folder)), 4)
+
+            # One new configuration, in the middle of the sweep
+            configurations.insert(2, dict(num_beacons=5, p_std=np.array([.01, .01, .03])))
+            second = run_sweep(self.data, configurations, self.base_arguments,
+                               folder, processes=2)
+            self.assertEqual([point.cached for point in second],
+                             [True, True, False, True, True])
+
+            for point in second:
+                expected = run_eskf(loaded_data=self.data,
+                                    **dict(self.base_arguments, **point.configuration))
+                for value, expected_value in zip(point.result, expected):
+                    np.testing.assert_array_equal(value, expected_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Small simulated logs in the layout of the loaded data matrix, and the filter
+setup the checkers run them with. The benchmarks take their logs from here too.
+
+    data = make_data(np.random.default_rng(0), T=30.)
+    run_eskf(loaded_data=data, **run_arguments(data), doGNSS=True)
+
+or, for a run_eskf call on a fresh log,
+
+    run_eskf(**simulated_run(0), doGNSS=True)
+"""
+
+import numpy as np
+
+# eskf_parameters and p_std of the runs
+ESKF_PARAMETERS = [0.0583, 2.2e-6, 2.4e-3, 1.7e-6, 1e-6, 1e-6]
+P_STD = np.array([.01, .01, .03])
+
+
+def make_data(rng, T=3.05):
+    """Small simulated log, 100 Hz IMU and 1 Hz GNSS"""
+    timeIMU = np.arange(0, T, 0.01)
+    timeGNSS = np.arange(0.5, T, 1.0)
+    z_acc = rng.normal(0, 1e-2, (len(timeIMU), 3)) - np.array([0, 0, 9.82])
+    z_gyro = rng.normal(0, 1e-3, (len(timeIMU), 3))
+    z_GNSS = np.column_stack((10 + 0 * timeGNSS, 2 * timeGNSS, 1 + 0 * timeGNSS))
+    beacon_location = rng.uniform([-30, -10, -1], [30, 70, 5], (6, 3))
+    return {"z_acc": z_acc.T, "z_gyro": z_gyro.T, "z_GNSS": z_GNSS.T,
+            "S_a": np.eye(3), "S_g": np.eye(3),
+            "beacon_location": beacon_location, "leverarm": np.zeros((1, 3)),
+            "timeGNSS": timeGNSS[None], "timeIMU": timeIMU[None]}
+
+
+def initial_state():
+    """Initial nominal state (16,), at rest heading east from the start of
+    the GNSS track, and error state covariance (15,15)"""
+    x_init = np.zeros(16)
+    x_init[:6] = [10, 0, 1, 0, 2, 0]
+    x_init[6] = 1
+    P_init = np.diag([9.] * 3 + [4.] * 3 + [0.25] * 3 + [1e-4] * 3 + [1e-6] * 3)
+    return x_init, P_init
+
+
+def run_arguments(data, num_beacons=4, use_batch_pseudoranges=True,
+                  use_iterative_pseudoranges=False):
+    """Keyword arguments of run_eskf for all of data but loaded_data itself"""
+    x_init, P_init = initial_state()
+    return dict(N=data["timeIMU"].shape[1],
+                eskf_parameters=ESKF_PARAMETERS,
+                x_pred_init=x_init,
+                P_pred_init=P_init,
+                p_std=P_STD,
+                num_beacons=num_beacons,
+                use_batch_pseudoranges=use_batch_pseudoranges,
+                use_iterative_pseudoranges=use_iterative_pseudoranges)
+
+
+def simulated_run(seed, T=3.05, **flags):
+    """All keyword arguments of run_eskf, loaded_data included, for a log
+    made from np.random.default_rng(seed). flags are passed to run_arguments"""
+    data = make_data(np.random.default_rng(seed), T=T)
+    return dict(loaded_data=data, **run_arguments(data, **flags))
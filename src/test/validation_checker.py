@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the tiered, sampled numeric validation of the ESKF
+"""
+
+
+import os, sys
+currentdir = os.path.dirname(os.path.realpath(__file__)) #test
+parentdir = os.path.dirname(currentdir)  #src
+sys.path.append(parentdir)
+
+import numpy as np
+import numpy.testing
+import unittest
+
+from eskf_pseudoranges import ESKF
+from eskf_runner import run_eskf
+from eskf_sqrt import SqrtESKF
+from synthetic_log import ESKF_PARAMETERS, simulated_run
+
+
+class TestValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.parameters = ESKF_PARAMETERS
+        rng = np.random.default_rng(12)
+        self.x = np.zeros((10, 16))
+        self.x[:, 6] = 1
+        A = rng.normal(size=(15, 15))
+        self.P = np.repeat((A @ A.T * 1e-2 + np.eye(15) * 1e-3)[None], 10, axis=0)
+
+    def test_levels(self):
+        self.assertEqual(ESKF(*self.parameters, debug=True).validation, "full")
+        self.assertEqual(ESKF(*self.parameters, debug=False).validation, "off")
+        with self.assertRaises(AssertionError):
+            ESKF(*self.parameters, debug=False, validation="some")
+
+        P = self.P[0].copy()
+        P[0, 1] += 1e-6
+        off = ESKF(*self.parameters, debug=False)
+        off.validate(self.x[0], P, "test")
+        cheap = ESKF(*self.parameters, debug=False, validation="cheap")
+        with self.assertRaises(AssertionError):
+            cheap.validate(self.x[0], P, "test")
+
+        P = self.P[0].copy()
+        P[3, 3] = -1e-9
+        with self.assertRaises(AssertionError):
+            cheap.validate(self.x[0], P, "test")
+        strict = ESKF(*self.parameters, debug=False, validation="cheap", min_variance=1.)
+        with self.assertRaises(AssertionError):
+            strict.validate(self.x[0], self.P[0], "test")
+
+        # Quaternion off the unit sphere
+        x = self.x[0].copy()
+        x[6] = 1 + 1e-6
+        with self.assertRaises(AssertionError):
+            cheap.validate(x, self.P[0], "test")
+
+        sqrt_eskf = SqrtESKF(*self.parameters, debug=False, validation="cheap")
+        sqrt_eskf.validate(self.x[0], SqrtESKF.factor(self.P[0]), "test")
+
+    def test_sampling(self):
+        eskf = ESKF(*self.parameters, debug=False, validation="cheap",
+                    validation_interval=3)
+        x = self.x.copy()
+        # Steps 0, 3, 6 and 9 are checked, the others are not
+        x[[1, 2, 4, 5, 7, 8], 0] = np.nan
+        eskf.validate_predictions(x, self.P, 0, 4)
+        eskf.validate_predictions(x, self.P, 4, 10)
+        self.assertEqual(eskf.validation_step, 10)
+        x[9, 0] = np.nan
+        eskf.validation_step = 0
+        with self.assertRaises(AssertionError):
+            eskf.validate_predictions(x, self.P, 0, 10)
+
+    def test_runs(self):
+        arguments = simulated_run(13)
+        for options in (dict(),
+                        dict(backend="numba"),
+                        dict(backend="preintegration"),
+                        dict(cov_interval=3),
+                        dict(sqrt_covariance=True)):
+            expected = run_eskf(**arguments, doGNSS=True, debug=False, **options)
+            for validation, interval in (("cheap", 7), ("full", 1)):
+                result = run_eskf(**arguments, doGNSS=True, debug=False,
+                                  validation=validation,
+                                  validation_interval=interval, **options)
+                for value, expected_value in zip(result, expected):
+                    np.testing.assert_array_equal(value, expected_value)
+
+
+if __name__ == '__main__':
+    unittest.main()